@@ -0,0 +1,298 @@
+'''
+Cleans up the attachment directories in the background and keeps them under a disk quota.
+
+The attachment store only evicts when a new attachment is committed, and files written next
+to it are only removed when everything goes well: an attachment emailed with
+`get_attachment` stays behind if sending it fails, and so does a half written download if
+the bot stops in the middle of it. The janitor sweeps the directories every
+`interval_seconds`:
+
+1. The store evicts what is past its own age and size limits.
+2. Files in the store's directory that the store doesn't know about and that nothing is
+   using are orphans. Orphans older than `orphan_age_seconds` are deleted.
+3. If the store's directory and the cache directories (e.g. shrunk images) together are
+   still larger than `max_bytes`, the oldest cache entries are deleted, then the store
+   evicts its least recently used attachments, until they fit.
+4. Oversized attachments linked from Discord (the `link` action of the attachment policy)
+   are deleted `linked_max_age_days` after they were linked, so their links stop working
+   then. They don't count towards `max_bytes`.
+
+Attachments used within the store's `grace_seconds` are never deleted, and neither are
+files marked with in_use().
+'''
+
+import os
+import shutil
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from attachmentstore import AttachmentStore
+from scheduler import BULK
+
+
+class AttachmentJanitor:
+    '''
+    Deletes attachment files that nothing will use again and enforces the disk quota
+
+    Attributes:
+        `store`: The attachment store whose directory is swept
+        `cache_dirs`: Directories of caches that can be trimmed to make room
+        `linked_dirs`: Directories of linked attachments that expire
+        `interval`: Seconds between sweeps
+    '''
+
+    _instances = {}
+
+    def __init__(self, store: AttachmentStore, cache_dirs: list = None, conf: dict = None, linked_dirs: list = None):
+        '''
+        Args:
+            store (AttachmentStore): The attachment store whose directory is swept
+            cache_dirs (list, optional): Directories of caches that can be trimmed to make room.
+                                         Each entry directly inside them is one cached item.
+                                         Defaults to None.
+            conf (dict, optional): The `att_janitor` section of deci_config. Defaults to None.
+            linked_dirs (list, optional): Directories of linked attachments, which are deleted
+                                          once they're older than linked_max_age_days.
+                                          Defaults to None.
+        '''
+
+        self.store = store
+        self.cache_dirs = list(cache_dirs or [])
+        self.linked_dirs = list(linked_dirs or [])
+        self._in_use = Counter()
+        self.sweeps = 0
+        self.reclaimed = Counter()
+        self.last_sweep = {}
+        self.configure(conf)
+
+    @classmethod
+    def get(cls, store: AttachmentStore, cache_dirs: list = None, conf: dict = None,
+            linked_dirs: list = None) -> 'AttachmentJanitor':
+        '''
+        Returns the shared AttachmentJanitor for store, creating it the first time and
+        updating its settings from conf
+        '''
+
+        if store.root not in cls._instances:
+            cls._instances[store.root] = cls(store, cache_dirs, conf, linked_dirs)
+        else:
+            cls._instances[store.root].configure(conf)
+        return cls._instances[store.root]
+
+    def configure(self, conf: dict = None) -> None:
+        '''
+        Changes the settings
+        '''
+
+        conf = conf or {}
+        self.enabled = conf.get('enabled', True)
+        self.interval = conf.get('interval_seconds', 600)
+        self.orphan_age = conf.get('orphan_age_seconds', 3600)
+        self.max_bytes = conf.get('max_bytes', 1024 * 1024 * 1024)
+        self.linked_max_age = conf.get('linked_max_age_days', 30) * 24 * 3600
+
+    @contextmanager
+    def in_use(self, path: str):
+        '''
+        Keeps the file at path from being deleted as an orphan for the duration of the `with` block
+        '''
+
+        path = os.path.abspath(path)
+        self._in_use[path] += 1
+        try:
+            yield path
+        finally:
+            self._in_use[path] -= 1
+            if self._in_use[path] <= 0:
+                del self._in_use[path]
+
+    async def sweep(self, workers=None) -> dict:
+        '''
+        Evicts old attachments, deletes orphans and enforces the quota. The directories are
+        walked in a bulk worker thread if workers is given.
+
+        Args:
+            workers (WorkerPool, optional): The pool to walk the directories in. Defaults to None.
+
+        Returns:
+            dict: The bytes reclaimed from `evicted` attachments, `orphans`, `cache` entries and
+                  expired `linked` attachments, the number of `orphan_files`, the `total_bytes`
+                  left and the `max_bytes`
+        '''
+
+        async def blocking(func, *args):
+            if workers is None:
+                return func(*args)
+            return await workers.run(BULK, func, *args)
+
+        # The store's index is only touched from the event loop
+        evicted = self.store.evict()
+        keep = {os.path.abspath(p) for p in self.store.paths()} | set(self._in_use)
+        orphan_files, orphan_bytes, store_dir_bytes = await blocking(self._remove_orphans, keep)
+        cache_bytes = await blocking(lambda: sum(_usage(d) for d in self.cache_dirs))
+
+        total = store_dir_bytes + cache_bytes
+        cache_freed = 0
+        if self.max_bytes and total > self.max_bytes:
+            cache_freed = await blocking(self._trim_caches, total - self.max_bytes)
+            total -= cache_freed
+        if self.max_bytes and total > self.max_bytes:
+            freed = self.store.evict(max(self.store.size() - (total - self.max_bytes), 0))
+            evicted += freed
+            total -= freed
+        linked = await blocking(self._expire_linked)
+
+        swept = {
+            'evicted': evicted,
+            'orphans': orphan_bytes,
+            'cache': cache_freed,
+            'linked': linked,
+            'orphan_files': orphan_files,
+            'reclaimed_bytes': evicted + orphan_bytes + cache_freed + linked,
+            'total_bytes': total,
+            'max_bytes': self.max_bytes
+        }
+        self.sweeps += 1
+        self.reclaimed.update({'evicted': evicted, 'orphans': orphan_bytes, 'cache': cache_freed,
+                               'linked': linked, 'orphan_files': orphan_files})
+        self.last_sweep = dict(swept, time=time.time())
+        return swept
+
+    def _remove_orphans(self, keep: set) -> tuple:
+        '''
+        Deletes the files in the store's directory that aren't in keep and are older than
+        orphan_age, and the empty directories left behind
+
+        Returns:
+            tuple: (number of files deleted, bytes deleted, bytes left in the directory)
+        '''
+
+        cutoff = time.time() - self.orphan_age
+        root = os.path.abspath(self.store.root)
+        files = freed = left = 0
+        for dir_path, dir_names, filenames in os.walk(root, topdown=False):
+            for filename in filenames:
+                path = os.path.join(dir_path, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if path in keep or stat.st_mtime >= cutoff:
+                    left += stat.st_size
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    left += stat.st_size
+                    continue
+                files += 1
+                freed += stat.st_size
+            # The store creates a directory just before moving an attachment into it, so leave new ones alone
+            if dir_path != root:
+                try:
+                    if not os.listdir(dir_path) and os.path.getmtime(dir_path) < cutoff:
+                        os.rmdir(dir_path)
+                except OSError:
+                    pass
+        return files, freed, left
+
+    def _trim_caches(self, excess: int) -> int:
+        '''
+        Deletes the least recently used cache entries until excess bytes are freed. Entries
+        used within the store's grace_seconds are kept.
+
+        Returns:
+            int: Number of bytes freed
+        '''
+
+        cutoff = time.time() - self.store.grace
+        entries = []
+        for cache_dir in self.cache_dirs:
+            if not os.path.isdir(cache_dir):
+                continue
+            for name in os.listdir(cache_dir):
+                path = os.path.join(cache_dir, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    continue
+                if mtime < cutoff:
+                    entries.append((mtime, path))
+
+        freed = 0
+        for _, path in sorted(entries):
+            if freed >= excess:
+                break
+            size = _usage(path)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+            freed += size
+        return freed
+
+    def _expire_linked(self) -> int:
+        '''
+        Deletes the linked attachments older than linked_max_age
+
+        Returns:
+            int: Number of bytes freed
+        '''
+
+        cutoff = time.time() - self.linked_max_age
+        freed = 0
+        for linked_dir in self.linked_dirs:
+            if not os.path.isdir(linked_dir):
+                continue
+            for name in os.listdir(linked_dir):
+                path = os.path.join(linked_dir, name)
+                try:
+                    stat = os.stat(path)
+                    if not os.path.isfile(path) or stat.st_mtime >= cutoff:
+                        continue
+                    os.remove(path)
+                except OSError:
+                    continue
+                freed += stat.st_size
+        return freed
+
+    def stats(self) -> dict:
+        '''
+        Returns the totals since the janitor started and the result of the last sweep
+        '''
+
+        return {
+            'sweeps': self.sweeps,
+            'reclaimed_bytes': sum(self.reclaimed[k] for k in ('evicted', 'orphans', 'cache', 'linked')),
+            'evicted_bytes': self.reclaimed['evicted'],
+            'orphan_bytes': self.reclaimed['orphans'],
+            'orphan_files': self.reclaimed['orphan_files'],
+            'cache_bytes': self.reclaimed['cache'],
+            'linked_bytes': self.reclaimed['linked'],
+            'in_use': len(self._in_use),
+            'last_sweep': self.last_sweep
+        }
+
+
+def _usage(path: str) -> int:
+    '''
+    Returns the total size of the file or directory at path
+    '''
+
+    if not os.path.isdir(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+    size = 0
+    for dir_path, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dir_path, filename))
+            except OSError:
+                continue
+    return size
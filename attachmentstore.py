@@ -0,0 +1,218 @@
+'''
+A content-addressed store for email attachments.
+
+Each attachment is kept at `<root>/<hash>/<filename>`, where hash is the sha256 of its
+contents. Identical payloads are only written once, attachments with the same filename
+but different contents never overwrite each other, and the original filename is kept
+for the email and Discord uploads. Inline images that keep coming back (signatures and
+logos) are recognised by their hash and skipped. Old entries are evicted once the store
+grows past its size or age limits.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+class _HashingWriter:
+    '''
+    A binary file that hashes everything written to it
+    '''
+
+    def __init__(self, dir_path: str):
+        self._fp = tempfile.NamedTemporaryFile(dir=dir_path, prefix='.incoming_', delete=False)
+        self.name = self._fp.name
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self._hash.update(data)
+        self.size += len(data)
+        return self._fp.write(data)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def close(self) -> None:
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+        if exc[0] is not None and os.path.exists(self.name):
+            os.remove(self.name)
+
+
+class AttachmentStore:
+    '''
+    Stores attachments by the hash of their contents
+
+    Attributes:
+        `root`: Directory the attachments are stored in
+        `index_path`: File path to the json index of the stored attachments
+    '''
+
+    _instances = {}
+
+    def __init__(self, root: str, index_path: str, conf: dict = None):
+        '''
+        Opens the store
+
+        Args:
+            root (str): Directory the attachments are stored in
+            index_path (str): File path to the json index of the stored attachments
+            conf (dict, optional): The `att_store` section of deci_config. Defaults to None.
+        '''
+
+        conf = conf or {}
+        self.root = root
+        self.index_path = index_path
+        self.max_bytes = conf.get('max_bytes', 500 * 1024 * 1024)
+        self.max_age = conf.get('max_age_days', 30) * 24 * 3600
+        self.grace = conf.get('grace_seconds', 3600)
+        self.repeat_threshold = conf.get('signature_repeat_threshold', 3)
+        self.skip_hashes = set(conf.get('skip_hashes', []))
+        os.makedirs(root, exist_ok=True)
+        if os.path.exists(index_path):
+            with open(index_path) as fp:
+                self._index = json.load(fp)
+        else:
+            self._index = {}
+
+    @classmethod
+    def get(cls, root: str, index_path: str, conf: dict = None) -> 'AttachmentStore':
+        '''
+        Returns the shared AttachmentStore for root, opening it the first time
+        '''
+
+        if root not in cls._instances:
+            cls._instances[root] = cls(root, index_path, conf)
+        return cls._instances[root]
+
+    def _save_index(self) -> None:
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, mode='w') as fp:
+            json.dump(self._index, fp)
+        os.replace(tmp_path, self.index_path)
+
+    def writer(self) -> _HashingWriter:
+        '''
+        Returns a file to write a new attachment into. Pass it to commit() once it's closed.
+        '''
+
+        return _HashingWriter(self.root)
+
+    def commit(self, writer: _HashingWriter, filename: str, inline_image: bool = False) -> str:
+        '''
+        Moves a written attachment into the store, or drops it if the store already has it
+
+        Args:
+            writer (_HashingWriter): The closed writer the attachment was written into
+            filename (str): The attachment's filename
+            inline_image (bool, optional): Whether the attachment is an inline image, which
+                                           is skipped once it has been seen too many times.
+                                           Defaults to False.
+
+        Returns:
+            str: File path of the stored attachment, or None if it should be skipped
+        '''
+
+        digest = writer.hexdigest()
+        filename = os.path.basename(filename) or digest
+        entry = self._index.setdefault(digest, {'size': writer.size, 'uses': 0, 'filenames': []})
+        entry['uses'] += 1
+        entry['last_used'] = time.time()
+        skip = digest in self.skip_hashes or (inline_image and self.repeat_threshold
+                                              and entry['uses'] > self.repeat_threshold)
+
+        path = os.path.join(self.root, digest[:32], filename)
+        if skip or os.path.exists(path):
+            os.remove(writer.name)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(writer.name, path)
+            if filename not in entry['filenames']:
+                entry['filenames'].append(filename)
+        self._save_index()
+        self.evict()
+
+        return None if skip else path
+
+    def remove(self, path: str) -> bool:
+        '''
+        Deletes an attachment that was just committed and turned out not to be needed, unless
+        it was also committed for another email
+
+        Returns:
+            bool: Whether it was deleted
+        '''
+
+        digest_dir, filename = os.path.split(path)
+        digest = next((d for d in self._index if d[:32] == os.path.basename(digest_dir)), None)
+        entry = self._index.get(digest)
+        if entry is None or entry['uses'] > 1 or filename not in entry['filenames']:
+            return False
+        shutil.rmtree(digest_dir, ignore_errors=True)
+        del self._index[digest]
+        self._save_index()
+        return True
+
+    def paths(self) -> set:
+        '''
+        Returns the file paths of every attachment in the store
+        '''
+
+        return {os.path.join(self.root, digest[:32], filename)
+                for digest, entry in self._index.items() for filename in entry['filenames']}
+
+    def size(self) -> int:
+        '''
+        Returns the total size of the attachments in the store
+        '''
+
+        return sum(e['size'] * len(e['filenames']) for e in self._index.values())
+
+    def evict(self, max_bytes: int = None) -> int:
+        '''
+        Removes the least recently used attachments that are older than max_age_days,
+        or while the store is larger than max_bytes. Attachments used within the last
+        grace_seconds are never removed.
+
+        Args:
+            max_bytes (int, optional): Size to evict down to, if lower than the store's own
+                                       max_bytes. Defaults to None.
+
+        Returns:
+            int: Number of bytes freed
+        '''
+
+        now = time.time()
+        max_bytes = self.max_bytes if max_bytes is None else min(max_bytes, self.max_bytes)
+        total = self.size()
+        freed = 0
+        for digest, entry in sorted(self._index.items(), key=lambda kv: kv[1]['last_used']):
+            if not entry['filenames']:
+                continue
+            age = now - entry['last_used']
+            if age < self.grace:
+                break
+            if age < self.max_age and total <= max_bytes:
+                break
+            size = entry['size'] * len(entry['filenames'])
+            shutil.rmtree(os.path.join(self.root, digest[:32]), ignore_errors=True)
+            if digest in self.skip_hashes or entry['uses'] > self.repeat_threshold:
+                # Keep the counts of signature images so they stay skipped
+                entry['filenames'] = []
+            else:
+                del self._index[digest]
+            total -= size
+            freed += size
+        if freed:
+            self._save_index()
+
+        return freed
@@ -0,0 +1,192 @@
+'''
+An append-only journal of how far each incoming email has made it through delivery.
+
+Every step of the delivery of an email (fetched, rendered, emailed, posted to Discord)
+is appended to the journal as one JSON line and flushed to disk before the next step
+starts. After a crash the journal is replayed so that only the steps that never
+finished are run again. Failed deliveries are retried with an exponential backoff until
+they've failed `max_attempts` times.
+'''
+
+import json
+import os
+import time
+
+
+class DeliveryJournal:
+    '''
+    Tracks the delivery progress of emails by uid
+
+    Attributes:
+        `path`: File path to the journal
+        `max_attempts`: Number of failed attempts after which an email is given up on
+    '''
+
+    TERMINAL_STAGES = {'done', 'abandoned'}
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        '''
+        Opens the journal at path, replaying and compacting any existing entries
+
+        Args:
+            path (str): File path to the journal
+            max_attempts (int, optional): Number of failed attempts after which an email
+                                          is given up on. Defaults to 3.
+        '''
+
+        self.path = path
+        self.max_attempts = max_attempts
+        self._state = {}
+        # When each uid last failed, since this journal was opened
+        self._failed_at = {}
+        self._lines = 0
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn write from a crash, everything before it is still valid
+                        continue
+                    self._apply(entry)
+        self.compact()
+
+    def _apply(self, entry: dict) -> None:
+        '''
+        Applies one journal entry to the in-memory state
+        '''
+
+        uid = int(entry.pop('uid'))
+        stage = entry.pop('stage')
+        stages = self._state.setdefault(uid, {})
+        if stage == 'failed':
+            stages['failed'] = stages.get('failed', 0) + 1
+        else:
+            stages[stage] = entry
+
+    def _append(self, entries: list) -> None:
+        '''
+        Appends entries to the journal file and makes sure they're on disk
+        '''
+
+        with open(self.path, mode='a', encoding='utf-8') as fp:
+            for entry in entries:
+                fp.write(json.dumps(entry) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        self._lines += len(entries)
+
+    def record(self, uid: int, stage: str, **data) -> None:
+        '''
+        Records that uid has completed stage
+
+        Args:
+            uid (int): The uid of the email
+            stage (str): The completed stage. E.g. `fetched`, `rendered`, `emailed`, `posted`
+            data: Anything needed to resume the following stages
+        '''
+
+        entry = {'uid': uid, 'stage': stage, **data}
+        self._append([entry])
+        self._apply(dict(entry))
+        if stage == 'failed':
+            self._failed_at[uid] = time.time()
+            if self._state[uid]['failed'] >= self.max_attempts:
+                self.record(uid, 'abandoned')
+
+    def record_all(self, uids: list, stage: str) -> None:
+        '''
+        Records that every uid in uids has completed stage, with a single write to disk
+
+        Args:
+            uids (list): The uids of the emails
+            stage (str): The completed stage
+        '''
+
+        entries = [{'uid': uid, 'stage': stage} for uid in uids]
+        if not entries:
+            return
+        self._append(entries)
+        for entry in entries:
+            self._apply(dict(entry))
+
+    def has(self, uid: int) -> bool:
+        '''
+        Returns whether uid has been recorded at all
+        '''
+
+        return uid in self._state
+
+    def done(self, uid: int, stage: str) -> bool:
+        '''
+        Returns whether uid has completed stage
+        '''
+
+        return stage in self._state.get(uid, {})
+
+    def data(self, uid: int, stage: str) -> dict:
+        '''
+        Returns the data recorded with stage for uid, or None if the stage isn't complete
+        '''
+
+        return self._state.get(uid, {}).get(stage)
+
+    def is_complete(self, uid: int) -> bool:
+        '''
+        Returns whether uid has reached a terminal stage
+        '''
+
+        return not self.TERMINAL_STAGES.isdisjoint(self._state.get(uid, {}))
+
+    def incomplete(self) -> list:
+        '''
+        Returns the uids whose delivery hasn't finished yet, oldest first
+        '''
+
+        return sorted(uid for uid in self._state if not self.is_complete(uid))
+
+    def retry_due(self, backoff: float) -> list:
+        '''
+        Returns the incomplete uids that are due another attempt, oldest first
+
+        After its nth failed attempt an email waits backoff * 2 ** (n - 1) seconds. Emails
+        that failed before the journal was opened, or never failed, are due straight away.
+
+        Args:
+            backoff (float): Seconds to wait after the first failed attempt
+        '''
+
+        now = time.time()
+        return [uid for uid in self.incomplete()
+                if now >= self._failed_at.get(uid, 0) + backoff * 2 ** (self._state[uid].get('failed', 1) - 1)]
+
+    def compact(self) -> None:
+        '''
+        Rewrites the journal with only the entries of incomplete emails
+        '''
+
+        entries = []
+        for uid in self.incomplete():
+            for stage, data in self._state[uid].items():
+                if stage == 'failed':
+                    entries += [{'uid': uid, 'stage': 'failed'}] * data
+                else:
+                    entries.append({'uid': uid, 'stage': stage, **data})
+        self._state = {uid: self._state[uid] for uid in self.incomplete()}
+        self._failed_at = {uid: t for uid, t in self._failed_at.items() if uid in self._state}
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, mode='w', encoding='utf-8') as fp:
+            for entry in entries:
+                fp.write(json.dumps(entry) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.path)
+        self._lines = len(entries)
+
+    def __len__(self) -> int:
+        '''
+        Returns the number of lines currently in the journal file
+        '''
+
+        return self._lines
@@ -0,0 +1,197 @@
+'''
+Batches Discord embeds bound for the same channel into as few messages as possible.
+
+Each email posted in embed mode becomes one embed. Embeds submitted for a channel within
+`window` seconds of the first one are posted together, up to 10 per message (and 6000
+characters in total, Discord's limits), so a burst of emails takes one API call per ten
+emails instead of one or more per email. Messages are posted in the order their embeds were
+submitted, and every submitter gets back the message its embed was posted in.
+
+Also converts the html colours of the mailing lists to the integer colours embeds use.
+'''
+
+import asyncio
+import re
+
+MAX_EMBEDS = 10
+MAX_EMBED_CHARS = 6000
+
+# The css colour names, as name:hex pairs
+_CSS_COLOURS = dict(pair.split(':') for pair in '''
+aliceblue:f0f8ff antiquewhite:faebd7 aqua:00ffff aquamarine:7fffd4 azure:f0ffff beige:f5f5dc bisque:ffe4c4
+black:000000 blanchedalmond:ffebcd blue:0000ff blueviolet:8a2be2 brown:a52a2a burlywood:deb887 cadetblue:5f9ea0
+chartreuse:7fff00 chocolate:d2691e coral:ff7f50 cornflowerblue:6495ed cornsilk:fff8dc crimson:dc143c cyan:00ffff
+darkblue:00008b darkcyan:008b8b darkgoldenrod:b8860b darkgray:a9a9a9 darkgreen:006400 darkgrey:a9a9a9
+darkkhaki:bdb76b darkmagenta:8b008b darkolivegreen:556b2f darkorange:ff8c00 darkorchid:9932cc darkred:8b0000
+darksalmon:e9967a darkseagreen:8fbc8f darkslateblue:483d8b darkslategray:2f4f4f darkslategrey:2f4f4f
+darkturquoise:00ced1 darkviolet:9400d3 deeppink:ff1493 deepskyblue:00bfff dimgray:696969 dimgrey:696969
+dodgerblue:1e90ff firebrick:b22222 floralwhite:fffaf0 forestgreen:228b22 fuchsia:ff00ff gainsboro:dcdcdc
+ghostwhite:f8f8ff gold:ffd700 goldenrod:daa520 gray:808080 green:008000 greenyellow:adff2f grey:808080
+honeydew:f0fff0 hotpink:ff69b4 indianred:cd5c5c indigo:4b0082 ivory:fffff0 khaki:f0e68c lavender:e6e6fa
+lavenderblush:fff0f5 lawngreen:7cfc00 lemonchiffon:fffacd lightblue:add8e6 lightcoral:f08080 lightcyan:e0ffff
+lightgoldenrodyellow:fafad2 lightgray:d3d3d3 lightgreen:90ee90 lightgrey:d3d3d3 lightpink:ffb6c1
+lightsalmon:ffa07a lightseagreen:20b2aa lightskyblue:87cefa lightslategray:778899 lightslategrey:778899
+lightsteelblue:b0c4de lightyellow:ffffe0 lime:00ff00 limegreen:32cd32 linen:faf0e6 magenta:ff00ff maroon:800000
+mediumaquamarine:66cdaa mediumblue:0000cd mediumorchid:ba55d3 mediumpurple:9370db mediumseagreen:3cb371
+mediumslateblue:7b68ee mediumspringgreen:00fa9a mediumturquoise:48d1cc mediumvioletred:c71585
+midnightblue:191970 mintcream:f5fffa mistyrose:ffe4e1 moccasin:ffe4b5 navajowhite:ffdead navy:000080
+oldlace:fdf5e6 olive:808000 olivedrab:6b8e23 orange:ffa500 orangered:ff4500 orchid:da70d6 palegoldenrod:eee8aa
+palegreen:98fb98 paleturquoise:afeeee palevioletred:db7093 papayawhip:ffefd5 peachpuff:ffdab9 peru:cd853f
+pink:ffc0cb plum:dda0dd powderblue:b0e0e6 purple:800080 rebeccapurple:663399 red:ff0000 rosybrown:bc8f8f
+royalblue:4169e1 saddlebrown:8b4513 salmon:fa8072 sandybrown:f4a460 seagreen:2e8b57 seashell:fff5ee
+sienna:a0522d silver:c0c0c0 skyblue:87ceeb slateblue:6a5acd slategray:708090 slategrey:708090 snow:fffafa
+springgreen:00ff7f steelblue:4682b4 tan:d2b48c teal:008080 thistle:d8bfd8 tomato:ff6347 turquoise:40e0d0
+violet:ee82ee wheat:f5deb3 white:ffffff whitesmoke:f5f5f5 yellow:ffff00 yellowgreen:9acd32
+'''.split())
+
+_RGB_RE = re.compile(r'rgba?\(\s*(\d{1,3})\s*,\s*(\d{1,3})\s*,\s*(\d{1,3})\s*(?:,[^)]*)?\)', re.I)
+
+
+def html_colour_value(colour: str) -> int:
+    '''
+    Converts an html colour (a css colour name, `#rgb`, `#rrggbb` or `rgb(r, g, b)`) to
+    the integer value of the colour
+
+    Returns:
+        int: The colour as 0xRRGGBB. None if colour isn't one of those forms.
+    '''
+
+    if not isinstance(colour, str):
+        return None
+    colour = colour.strip().lower()
+    colour = '#' + _CSS_COLOURS.get(colour, colour.lstrip('#'))
+    if re.fullmatch(r'#[0-9a-f]{6}', colour):
+        return int(colour[1:], 16)
+    if re.fullmatch(r'#[0-9a-f]{3}', colour):
+        return int(''.join(c * 2 for c in colour[1:]), 16)
+    match = _RGB_RE.fullmatch(colour[1:])
+    if match:
+        r, g, b = (min(int(i), 255) for i in match.groups())
+        return (r << 16) + (g << 8) + b
+    return None
+
+
+class _Batch:
+    '''
+    The embeds waiting to be posted in one channel
+    '''
+
+    def __init__(self, channel, reference=None):
+        self.channel = channel
+        self.reference = reference
+        self.embeds = []
+        self.futures = []
+        self.chars = 0
+        self.timer = None
+
+    def add(self, embed) -> asyncio.Future:
+        self.embeds.append(embed)
+        self.chars += len(embed)
+        future = asyncio.get_event_loop().create_future()
+        self.futures.append(future)
+        return future
+
+
+class EmbedBatcher:
+    '''
+    Collects embeds per channel and posts them in batches
+    '''
+
+    def __init__(self, send, max_embeds: int = MAX_EMBEDS, max_chars: int = MAX_EMBED_CHARS):
+        '''
+        Creates the batcher
+
+        Args:
+            send (Callable): Coroutine function taking (channel, list of embeds, reference)
+                             that posts one message and returns it
+            max_embeds (int, optional): Most embeds per message. Defaults to 10.
+            max_chars (int, optional): Most characters per message, over all its embeds.
+                                       Defaults to 6000.
+        '''
+
+        self._send = send
+        self.max_embeds = max_embeds
+        self.max_chars = max_chars
+        self._pending = {}
+        self._locks = {}
+        self._tasks = set()
+
+    async def submit(self, channel, embed, window: float = 2.0, reference=None):
+        '''
+        Adds embed to the next message posted in channel and waits until it's posted
+
+        Args:
+            channel (discord.TextChannel): The channel to post in
+            embed (discord.Embed): The embed
+            window (float, optional): Seconds to wait for more embeds before posting. Defaults to 2.0.
+            reference (discord.MessageReference, optional): Message to reply to. Replies are
+                                                           posted on their own. Defaults to None.
+
+        Returns:
+            discord.Message: The message that the embed was posted in
+        '''
+
+        key = channel.id
+        batch = self._pending.get(key)
+        if batch is not None and (reference is not None
+                                  or len(batch.embeds) >= self.max_embeds
+                                  or batch.chars + len(embed) > self.max_chars):
+            self._flush(key)
+
+        if reference is not None:
+            batch = _Batch(channel, reference)
+            future = batch.add(embed)
+            self._post(batch)
+            return await future
+
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = _Batch(channel)
+            self._pending[key] = batch
+            batch.timer = asyncio.get_event_loop().call_later(max(window, 0), self._flush, key)
+        future = batch.add(embed)
+        if len(batch.embeds) >= self.max_embeds or window <= 0:
+            self._flush(key)
+        return await future
+
+    async def flush_all(self) -> None:
+        '''
+        Posts every pending batch now and waits until they're all posted
+        '''
+
+        for key in list(self._pending):
+            self._flush(key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _flush(self, key) -> None:
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        self._post(batch)
+
+    def _post(self, batch: _Batch) -> None:
+        '''
+        Posts batch in the background, after the batches flushed before it in the same channel
+        '''
+
+        lock = self._locks.setdefault(batch.channel.id, asyncio.Lock())
+
+        async def post():
+            async with lock:
+                try:
+                    message = await self._send(batch.channel, batch.embeds, batch.reference)
+                except Exception as e:
+                    for future in batch.futures:
+                        if not future.done():
+                            future.set_exception(e)
+                    return
+                for future in batch.futures:
+                    if not future.done():
+                        future.set_result(message)
+
+        task = asyncio.ensure_future(post())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
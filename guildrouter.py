@@ -0,0 +1,140 @@
+'''
+Decides which servers an incoming email is delivered to.
+
+The mailing lists are indexed both ways (email address to servers, server to email
+addresses) so a sender who is on several servers' mailing lists can be routed without
+scanning the whole list. When the sender is on more than one list, the first of these
+rules that matches picks the servers:
+
+1. Thread: the email replies to a message that was posted in one of the servers
+2. Alias: the email was sent to one of a server's `email_aliases` (e.g. `bot+chess@example.com`)
+3. Subject tag: the subject contains a server's `subject_tag` (e.g. `[chess]`)
+4. Fallback: `all` delivers to every server the sender is in, `reject` delivers to none
+'''
+
+import os
+import re
+from email.utils import getaddresses
+
+
+class GuildRouter:
+    '''
+    An index of which mailing lists each email address is on
+
+    Attributes:
+        `fallback`: What to do with emails that no rule matches. `all` or `reject`.
+    '''
+
+    _instances = {}
+
+    def __init__(self, members, fallback: str = 'all'):
+        '''
+        Builds the index
+
+        Args:
+            members (Iterable): (guild_id, email) pairs, one per mailing list entry
+            fallback (str, optional): `all` or `reject`. Defaults to 'all'.
+        '''
+
+        self.fallback = fallback
+        self._guilds = {}
+        self._emails = {}
+        for guild_id, email in members:
+            if not isinstance(email, str):
+                continue
+            guild_id = int(guild_id)
+            guilds = self._guilds.setdefault(email.strip().lower(), [])
+            if guild_id not in guilds:
+                guilds.append(guild_id)
+            emails = self._emails.setdefault(guild_id, [])
+            if email not in emails:
+                emails.append(email)
+
+    @classmethod
+    def get(cls, path: str, load, fallback: str = 'all') -> 'GuildRouter':
+        '''
+        Returns the index of the mailing list csv at path, rebuilding it only when the file changes
+
+        Args:
+            path (str): File path to the mailing list csv
+            load (Callable): Returns the (guild_id, email) pairs of the csv
+            fallback (str, optional): `all` or `reject`. Defaults to 'all'.
+        '''
+
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = cls._instances.get(path)
+        if cached is None or cached[0] != key:
+            cached = (key, cls(load(), fallback))
+            cls._instances[path] = cached
+        cached[1].fallback = fallback
+        return cached[1]
+
+    def guilds_of(self, email: str) -> list:
+        '''
+        Returns the IDs of the servers whose mailing lists email is on
+        '''
+
+        return list(self._guilds.get((email or '').strip().lower(), []))
+
+    def members_of(self, guild_id: int) -> list:
+        '''
+        Returns the email addresses on the mailing list of guild_id
+        '''
+
+        return list(self._emails.get(int(guild_id), []))
+
+    def recipients(self, guild_ids: list, exclude: str = None) -> list:
+        '''
+        Returns every email address on the mailing lists of guild_ids once, without exclude
+        '''
+
+        exclude = (exclude or '').strip().lower()
+        recipients = {}
+        for guild_id in guild_ids:
+            for email in self.members_of(guild_id):
+                if email.strip().lower() != exclude:
+                    recipients.setdefault(email.strip().lower(), email)
+        return list(recipients.values())
+
+    def route(self, sender_email: str, to_addrs: list, subject: str, guilds_conf: dict,
+              thread_guilds: list = None) -> list:
+        '''
+        Picks the servers that an email from sender_email is delivered to
+
+        Args:
+            sender_email (str): The email address of the sender
+            to_addrs (list): The To and Cc headers of the email
+            subject (str): The subject of the email
+            guilds_conf (dict): The contents of guilds_conf.json
+            thread_guilds (list, optional): The servers of the Discord messages that the email
+                                            replies to. Defaults to None.
+
+        Returns:
+            list: The IDs of the servers. Empty if the email shouldn't be delivered anywhere.
+        '''
+
+        candidates = self.guilds_of(sender_email)
+        if len(candidates) <= 1:
+            return candidates
+
+        # Replies go back to the servers the thread is in
+        matched = [g for g in candidates if g in {int(t) for t in thread_guilds or []}]
+        if matched:
+            return matched
+
+        # Addressed to a server's own alias
+        addresses = {addr.lower() for _, addr in getaddresses([a for a in to_addrs or [] if a])}
+        matched = [g for g in candidates
+                   if addresses & {a.lower() for a in guilds_conf.get(str(g), {}).get('email_aliases') or []}]
+        if matched:
+            return matched
+
+        # Tagged with a server's subject tag
+        matched = [g for g in candidates
+                   if guilds_conf.get(str(g), {}).get('subject_tag')
+                   and re.search(re.escape(guilds_conf[str(g)]['subject_tag']), subject or '', re.I)]
+        if matched:
+            return matched
+
+        return candidates if self.fallback == 'all' else []
@@ -0,0 +1,261 @@
+'''
+Profiles the bot's hot paths (fetching emails, handling Discord messages and sending
+emails and Discord messages) while the bot is running.
+
+Functions are marked with `@profiled()`. While profiling is stopped the wrapper only
+checks a flag before calling the function. While it's running:
+
+- Each call is run under cProfile and the results are added up per function. For
+  coroutines, the profiler is only enabled while the coroutine itself is running, so
+  time spent waiting on IMAP, SMTP or Discord in other tasks isn't counted against it.
+- A sampling thread records the call stacks of the threads that are inside a profiled
+  function, for flame graphs.
+
+stop() writes a `.pstats` file per profiled function and one collapsed-stack file
+(`frame;frame;frame count` per line) to the output directory.
+'''
+
+import asyncio
+import cProfile
+import functools
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime as dt
+
+
+class _ProfiledCoroutine:
+    '''
+    Drives a coroutine with a profiler enabled only while the coroutine is running
+    '''
+
+    def __init__(self, coro, profiler: 'HotPathProfiler', name: str):
+        self._coro = coro
+        self._profiler = profiler
+        self._name = name
+        self._prof = cProfile.Profile()
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def send(self, value):
+        return self._step(self._coro.send, value)
+
+    def throw(self, *exc):
+        return self._step(self._coro.throw, *exc)
+
+    def close(self):
+        self._coro.close()
+
+    def _step(self, method, *args):
+        try:
+            with self._profiler._enabled(self._prof, self._name):
+                return method(*args)
+        except BaseException:
+            # StopIteration included: the coroutine has finished
+            self._profiler._add_stats(self._name, self._prof)
+            raise
+
+
+class HotPathProfiler:
+    '''
+    Turns profiling of the functions marked with `profiled()` on and off at runtime
+
+    Attributes:
+        `running`: Whether profiling is currently on
+        `output_dir`: Directory the profiles are written to
+    '''
+
+    def __init__(self):
+        self.running = False
+        self.output_dir = None
+        self.sample_interval = 0.005
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {}
+        self._active_threads = {}
+        self._stacks = Counter()
+        self._started_at = None
+        self._sampler = None
+
+    def profiled(self, name: str = None):
+        '''
+        Decorator that marks a function or coroutine function as a hot path
+
+        Args:
+            name (str, optional): Name to file the profile under. Defaults to the function's name.
+        '''
+
+        def decorator(func):
+            func_name = name or func.__name__
+
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    if not self.running:
+                        return await func(*args, **kwargs)
+                    return await _ProfiledCoroutine(func(*args, **kwargs), self, func_name)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.running:
+                    return func(*args, **kwargs)
+                prof = cProfile.Profile()
+                try:
+                    with self._enabled(prof, func_name):
+                        return func(*args, **kwargs)
+                finally:
+                    self._add_stats(func_name, prof)
+            return wrapper
+
+        return decorator
+
+    def start(self, output_dir: str, sample_interval: float = None) -> bool:
+        '''
+        Starts profiling
+
+        Args:
+            output_dir (str): Directory to write the profiles to
+            sample_interval (float, optional): Seconds between stack samples. Defaults to 0.005.
+
+        Returns:
+            bool: False if profiling was already running
+        '''
+
+        with self._lock:
+            if self.running:
+                return False
+            self.output_dir = output_dir
+            if sample_interval:
+                self.sample_interval = sample_interval
+            self._stats = {}
+            self._stacks = Counter()
+            self._started_at = dt.now()
+            self.running = True
+            self._sampler = threading.Thread(target=self._sample, name='hotprofile-sampler', daemon=True)
+            self._sampler.start()
+        return True
+
+    def stop(self) -> list:
+        '''
+        Stops profiling and writes out the profiles
+
+        Returns:
+            list: File paths of the files written. Empty if profiling wasn't running.
+        '''
+
+        with self._lock:
+            if not self.running:
+                return []
+            self.running = False
+        self._sampler.join()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, 'profile_' + self._started_at.strftime('%Y%m%d_%H%M%S'))
+        paths = []
+        with self._lock:
+            for func_name, stats in sorted(self._stats.items()):
+                path = f'{prefix}_{func_name}.pstats'
+                stats.dump_stats(path)
+                paths.append(path)
+            if self._stacks:
+                path = prefix + '.collapsed'
+                with open(path, mode='w', encoding='utf-8') as fp:
+                    for stack, count in self._stacks.most_common():
+                        fp.write(f'{stack} {count}\n')
+                paths.append(path)
+        return paths
+
+    def summary(self, limit: int = 5) -> str:
+        '''
+        Returns the number of calls to and total time spent in each profiled function so far,
+        slowest first
+        '''
+
+        with self._lock:
+            totals = sorted(((stats.total_tt, stats.total_calls, func_name)
+                             for func_name, stats in self._stats.items()), reverse=True)
+        return '\n'.join(f'{func_name}: {total:.3f} s over {calls} function calls'
+                         for total, calls, func_name in totals[:limit])
+
+    def _enabled(self, prof: cProfile.Profile, func_name: str):
+        return _EnabledProfile(self, prof, func_name)
+
+    def _add_stats(self, func_name: str, prof: cProfile.Profile) -> None:
+        try:
+            stats = pstats.Stats(prof)
+        except TypeError:
+            # The profiler was never enabled (nested call), so there's nothing to add
+            return
+        with self._lock:
+            if func_name in self._stats:
+                self._stats[func_name].add(stats)
+            else:
+                self._stats[func_name] = stats
+
+    def _sample(self) -> None:
+        '''
+        Records the stacks of the threads inside a profiled function until profiling stops
+        '''
+
+        while self.running:
+            frames = sys._current_frames()
+            for thread_id, func_name in list(self._active_threads.items()):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    # Leave out the profiler's own wrappers
+                    if code.co_filename != __file__:
+                        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(func_name)
+                self._stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.sample_interval)
+
+
+class _EnabledProfile:
+    '''
+    Context manager that enables prof for the current thread, unless the thread is
+    already inside a profiled function (whose profile already covers this call)
+    '''
+
+    def __init__(self, profiler: HotPathProfiler, prof: cProfile.Profile, func_name: str):
+        self._profiler = profiler
+        self._prof = prof
+        self._func_name = func_name
+        self._owner = False
+
+    def __enter__(self):
+        local = self._profiler._local
+        if getattr(local, 'active', False):
+            return self
+        try:
+            self._prof.enable()
+        except ValueError:
+            # Another profiler is active in a different thread (Python 3.12+ only allows one)
+            return self
+        local.active = True
+        self._owner = True
+        self._profiler._active_threads[threading.get_ident()] = self._func_name
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self._owner:
+            self._prof.disable()
+            self._profiler._active_threads.pop(threading.get_ident(), None)
+            self._profiler._local.active = False
+
+
+PROFILER = HotPathProfiler()
+profiled = PROFILER.profiled
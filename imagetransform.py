@@ -0,0 +1,229 @@
+'''
+Downscales and recompresses large images before they're uploaded to Discord or attached
+to an email.
+
+Photos from phones are often several MB each, which makes uploads slow and often goes over
+Discord's upload limit. Images wider or taller than `max_dimension`, or larger than
+`max_bytes`, are shrunk to fit within `max_dimension` and saved again as JPEG (PNG if they
+have transparency). The result is only used if it's actually smaller than the original.
+
+Results are cached at `<cache_dir>/<hash>/<filename>`, where hash is the sha256 of the
+original image and the settings it was shrunk with, so an image that is sent again is only
+processed once and changing the settings doesn't serve results made with the old ones. Transforming is
+CPU bound and blocks, so run it in a worker thread.
+
+Needs Pillow. Without it, every image is passed through unchanged.
+'''
+
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp', '.heic'}
+
+# Marks a cached hash whose image is kept as it is
+_KEEP = '.keep'
+
+
+class ImageTransformer:
+    '''
+    Shrinks images over the size thresholds, caching the results by content hash
+
+    Attributes:
+        `cache_dir`: Directory the transformed images are cached in
+        `enabled`: Whether images are transformed at all
+        `max_source_bytes`: Largest image worth downloading to shrink, when it's too large to upload as it is
+    '''
+
+    _instances = {}
+
+    def __init__(self, cache_dir: str, conf: dict = None):
+        '''
+        Opens the cache
+
+        Args:
+            cache_dir (str): Directory the transformed images are cached in
+            conf (dict, optional): The `image_transform` section of deci_config. Defaults to None.
+        '''
+
+        self.cache_dir = cache_dir
+        self.processed = 0
+        self.cache_hits = 0
+        self.bytes_saved = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.configure(conf)
+
+    @classmethod
+    def get(cls, cache_dir: str, conf: dict = None) -> 'ImageTransformer':
+        '''
+        Returns the shared ImageTransformer for cache_dir, opening it the first time and
+        updating its settings from conf
+        '''
+
+        if cache_dir not in cls._instances:
+            cls._instances[cache_dir] = cls(cache_dir, conf)
+        else:
+            cls._instances[cache_dir].configure(conf)
+        return cls._instances[cache_dir]
+
+    def configure(self, conf: dict = None) -> None:
+        '''
+        Changes the settings. Images already cached are kept.
+        '''
+
+        conf = conf or {}
+        self.enabled = bool(conf.get('enabled', False)) and Image is not None
+        self.max_dimension = conf.get('max_dimension', 2048)
+        self.max_bytes = conf.get('max_bytes', 1024 * 1024)
+        self.jpeg_quality = conf.get('jpeg_quality', 85)
+        self.max_pixels = conf.get('max_pixels', 50_000_000)
+        self.max_source_bytes = conf.get('max_source_bytes', 25 * 1024 * 1024)
+        self.cache_max_age = conf.get('cache_max_age_days', 30) * 24 * 3600
+
+    @staticmethod
+    def is_image(filename: str) -> bool:
+        return os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS
+
+    def transform_path(self, path: str) -> str:
+        '''
+        Transforms the image at path if it's over the thresholds
+
+        Returns:
+            str: File path of the transformed image, or path if the image is kept as it is
+        '''
+
+        if not self.enabled or not self.is_image(path):
+            return path
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        result = self._transform(os.path.basename(path), data)
+        return path if result is None else result
+
+    def transform_file(self, filename: str, fp) -> tuple:
+        '''
+        Transforms an image held in a file object if it's over the thresholds. fp is closed
+        if it's replaced.
+
+        Returns:
+            tuple: (filename, file object) of the transformed image, or the ones passed in
+                   if the image is kept as it is
+        '''
+
+        if not self.enabled or not self.is_image(filename):
+            return filename, fp
+        fp.seek(0)
+        data = fp.read()
+        fp.seek(0)
+        result = self._transform(filename, data)
+        if result is None:
+            return filename, fp
+        fp.close()
+        # The cache keeps the filename the image was first seen with
+        return os.path.splitext(filename)[0] + os.path.splitext(result)[1], open(result, 'rb')
+
+    def _transform(self, filename: str, data: bytes) -> str:
+        '''
+        Returns the cached path of the transformed image, transforming it the first time.
+        None if the image is kept as it is.
+        '''
+
+        digest = hashlib.sha256(data)
+        digest.update(f'|{self.max_dimension}|{self.max_bytes}|{self.jpeg_quality}'.encode())
+        digest = digest.hexdigest()
+        entry_dir = os.path.join(self.cache_dir, digest[:32])
+        if os.path.isdir(entry_dir):
+            cached = os.listdir(entry_dir)
+            if cached:
+                self.cache_hits += 1
+                os.utime(entry_dir)
+                return None if cached[0] == _KEEP else os.path.join(entry_dir, cached[0])
+
+        self.processed += 1
+        out_name, out_data = self._shrink(filename, data)
+        if out_data is None or len(out_data) >= len(data):
+            out_name, out_data = _KEEP, b''
+        else:
+            self.bytes_saved += len(data) - len(out_data)
+
+        # Write into a new directory and move it into place, so a concurrent worker never sees half a file
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.incoming_')
+        with open(os.path.join(tmp_dir, out_name), 'wb') as fp:
+            fp.write(out_data)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another worker cached the same image first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+        return None if out_name == _KEEP else os.path.join(entry_dir, out_name)
+
+    def _shrink(self, filename: str, data: bytes) -> tuple:
+        '''
+        Downscales and recompresses an image if it's over the thresholds
+
+        Returns:
+            tuple: (new filename, new image data), or (filename, None) if the image isn't
+                   over the thresholds or can't be read
+        '''
+
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                width, height = img.size
+                if width * height > self.max_pixels:
+                    return filename, None
+                if max(width, height) <= self.max_dimension and len(data) <= self.max_bytes:
+                    return filename, None
+                if getattr(img, 'is_animated', False):
+                    return filename, None
+
+                # Phone photos are stored sideways with an EXIF orientation, which save() drops
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail((self.max_dimension, self.max_dimension), Image.LANCZOS)
+                out = io.BytesIO()
+                stem = os.path.splitext(filename)[0]
+                if img.mode in ('RGBA', 'LA') or 'transparency' in img.info:
+                    img.save(out, format='PNG', optimize=True)
+                    return stem + '.png', out.getvalue()
+                img.convert('RGB').save(out, format='JPEG', quality=self.jpeg_quality, optimize=True)
+                return stem + '.jpg', out.getvalue()
+        except Exception:
+            return filename, None
+
+    def evict(self) -> int:
+        '''
+        Removes cached images that haven't been used for cache_max_age_days
+
+        Returns:
+            int: Number of bytes freed
+        '''
+
+        cutoff = time.time() - self.cache_max_age
+        freed = 0
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            try:
+                if not os.path.isdir(entry_dir) or os.path.getmtime(entry_dir) >= cutoff:
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+            except OSError:
+                continue
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            freed += size
+        return freed
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'processed': self.processed,
+            'cache_hits': self.cache_hits,
+            'bytes_saved': self.bytes_saved
+        }
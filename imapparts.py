@@ -0,0 +1,397 @@
+'''
+Helpers for working with the individual MIME parts of an email on an IMAP server
+without downloading the whole message.
+
+The BODYSTRUCTURE of a message is parsed into a tree of `BodyPart`s. Text parts can
+then be fetched one at a time, and large attachments can be streamed to disk with
+partial `BODY.PEEK[section]<offset.length>` fetches so that they never have to be
+held in memory all at once.
+'''
+
+import asyncio
+import binascii
+import re
+from collections import namedtuple
+from email.header import decode_header, make_header
+
+import aioimaplib
+
+BodyPart = namedtuple('BodyPart', [
+    'section',      # IMAP section specifier, e.g. '1.2'
+    'maintype',     # e.g. 'text'
+    'subtype',      # e.g. 'html'
+    'params',       # dict of Content-Type parameters
+    'encoding',     # Content-Transfer-Encoding, lower case
+    'size',         # Size of the encoded part in octets
+    'disposition',  # Content-Disposition type, lower case, or None
+    'disp_params',  # dict of Content-Disposition parameters
+    'parts',        # list of child BodyParts (multipart only)
+])
+
+_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\}\r?\n?|([^\s()"{]+))', re.S)
+_FETCH_LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+
+
+def _tokenize(data: bytes) -> list:
+    '''
+    Converts an IMAP parenthesized list into nested python lists
+
+    Strings are returned as str, NIL as None and everything else as the raw atom str.
+
+    Args:
+        data (bytes): The raw parenthesized list
+
+    Returns:
+        list: The nested list representation of data
+    '''
+
+    stack = [[]]
+    pos = 0
+    while pos < len(data):
+        match = _TOKEN_RE.match(data, pos)
+        if match is None or match.end() == pos:
+            break
+        pos = match.end()
+        open_p, close_p, quoted, literal_len, atom = match.groups()
+        if open_p:
+            stack.append([])
+        elif close_p:
+            if len(stack) > 1:
+                done = stack.pop()
+                stack[-1].append(done)
+        elif quoted is not None:
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', quoted).decode('utf-8', 'replace'))
+        elif literal_len is not None:
+            n = int(literal_len)
+            stack[-1].append(data[pos:pos + n].decode('utf-8', 'replace'))
+            pos += n
+        elif atom is not None:
+            atom = atom.decode('ascii', 'replace')
+            stack[-1].append(None if atom.upper() == 'NIL' else atom)
+    while len(stack) > 1:
+        done = stack.pop()
+        stack[-1].append(done)
+
+    return stack[0]
+
+def _to_dict(pairs) -> dict:
+    '''
+    Converts an IMAP ("key" "value" ...) list into a dict with lower case keys
+    '''
+
+    if not isinstance(pairs, list):
+        return {}
+    return {str(k).lower(): v for k, v in zip(pairs[0::2], pairs[1::2]) if k is not None}
+
+def _disposition(field) -> tuple:
+    '''
+    Converts an IMAP disposition field into (disposition, disp_params)
+    '''
+
+    if isinstance(field, list) and field and isinstance(field[0], str):
+        return field[0].lower(), _to_dict(field[1] if len(field) > 1 else None)
+    return None, {}
+
+def _build_part(node: list, section: str) -> BodyPart:
+    '''
+    Builds a BodyPart from a tokenized body structure node
+
+    Args:
+        node (list): The tokenized node
+        section (str): The section specifier of the node
+
+    Returns:
+        BodyPart: The parsed part (and its children)
+    '''
+
+    # Multipart: (child)(child)... "subtype" [params disposition ...]
+    if node and isinstance(node[0], list):
+        # Only the leading lists are children, the rest is the extension data
+        children = []
+        for n in node:
+            if isinstance(n, list):
+                children.append(n)
+            else:
+                break
+        extra = node[len(children):]
+        prefix = '' if section == '' else section + '.'
+        parts = [_build_part(c, f'{prefix}{i + 1}') for i, c in enumerate(children)]
+        subtype = (extra[0] if extra else 'mixed') or 'mixed'
+        params = _to_dict(extra[1]) if len(extra) > 1 else {}
+        disposition, disp_params = _disposition(extra[2] if len(extra) > 2 else None)
+        return BodyPart(section or 'TEXT', 'multipart', subtype.lower(), params, '', 0,
+                        disposition, disp_params, parts)
+
+    # Single part: "type" "subtype" (params) id description encoding size ...
+    maintype = (node[0] or 'text').lower()
+    subtype = (node[1] or 'plain').lower() if len(node) > 1 else 'plain'
+    params = _to_dict(node[2]) if len(node) > 2 else {}
+    encoding = (node[5] or '7bit').lower() if len(node) > 5 else '7bit'
+    try:
+        size = int(node[6])
+    except (IndexError, TypeError, ValueError):
+        size = 0
+    ext_idx = 7
+    if maintype == 'text':
+        ext_idx += 1                                    # Number of lines
+    elif maintype == 'message' and subtype == 'rfc822':
+        ext_idx += 3                                    # Envelope, body and lines
+    disposition, disp_params = _disposition(node[ext_idx + 1] if len(node) > ext_idx + 1 else None)
+    return BodyPart(section or '1', maintype, subtype, params, encoding, size,
+                    disposition, disp_params, [])
+
+def parse_bodystructure(lines: list) -> BodyPart:
+    '''
+    Parses the response of a `UID FETCH <uid> (BODYSTRUCTURE)` command
+
+    Args:
+        lines (list): The lines of the imap response
+
+    Returns:
+        BodyPart: The root of the message's body structure, or None if it couldn't be found
+    '''
+
+    # Glue literals back onto the line that announced them
+    data = b''
+    for line in lines:
+        if isinstance(line, (bytes, bytearray)):
+            data += bytes(line)
+            if _FETCH_LITERAL_RE.search(data):
+                data += b'\r\n'
+    idx = data.upper().find(b'BODYSTRUCTURE')
+    if idx == -1:
+        return None
+    tokens = _tokenize(data[idx + len(b'BODYSTRUCTURE'):])
+    if not tokens or not isinstance(tokens[0], list):
+        return None
+
+    return _build_part(tokens[0], '')
+
+def walk(part: BodyPart):
+    '''
+    Iterates over part and all its descendants, depth first
+    '''
+
+    yield part
+    for child in part.parts:
+        yield from walk(child)
+
+def content_type(part: BodyPart) -> str:
+    '''
+    Returns the `maintype/subtype` of part
+    '''
+
+    return f'{part.maintype}/{part.subtype}'
+
+def filename(part: BodyPart) -> str:
+    '''
+    Returns the decoded filename of part, or None if it doesn't have one
+    '''
+
+    name = part.disp_params.get('filename') or part.params.get('name')
+    if name is None:
+        return None
+    try:
+        return str(make_header(decode_header(name)))
+    except Exception:
+        return name
+
+def decoded_size(part: BodyPart) -> int:
+    '''
+    Estimates the size of part once its transfer encoding has been removed
+    '''
+
+    if part.encoding == 'base64':
+        return part.size * 3 // 4
+    return part.size
+
+def select_body_part(part: BodyPart) -> BodyPart:
+    '''
+    Picks the part holding the body of the email, preferring the html representation
+
+    Uses the same rule as walking the parsed email: when a multipart has exactly two
+    children the second one is taken if it is html, otherwise the first child is taken.
+
+    Args:
+        part (BodyPart): The root of the body structure
+
+    Returns:
+        BodyPart: The (non-multipart) part containing the body of the email
+    '''
+
+    while part.maintype == 'multipart' and part.parts:
+        if len(part.parts) == 2 and part.parts[1].subtype == 'html':
+            part = part.parts[1]
+        else:
+            part = part.parts[0]
+    return part
+
+
+class StreamDecoder:
+    '''
+    Incrementally removes a Content-Transfer-Encoding from chunks of data
+    '''
+
+    def __init__(self, encoding: str):
+        self.encoding = (encoding or '').lower()
+        self._pending = b''
+
+    def feed(self, chunk: bytes) -> bytes:
+        '''
+        Decodes as much of chunk as possible, keeping any incomplete tail for later
+        '''
+
+        data = self._pending + bytes(chunk)
+        if self.encoding == 'base64':
+            data = b''.join(data.split())
+            cut = len(data) - len(data) % 4
+            self._pending = data[cut:]
+            return binascii.a2b_base64(data[:cut]) if cut else b''
+        elif self.encoding == 'quoted-printable':
+            cut = data.rfind(b'\n') + 1
+            self._pending = data[cut:]
+            return binascii.a2b_qp(data[:cut])
+        self._pending = b''
+        return data
+
+    def flush(self) -> bytes:
+        '''
+        Decodes whatever is left over once all chunks have been fed
+        '''
+
+        data, self._pending = self._pending, b''
+        if not data:
+            return b''
+        if self.encoding == 'base64':
+            data += b'=' * (-len(data) % 4)
+            try:
+                return binascii.a2b_base64(data)
+            except binascii.Error:
+                return b''
+        elif self.encoding == 'quoted-printable':
+            return binascii.a2b_qp(data)
+        return data
+
+
+async def fetch_section(imap_client: aioimaplib.IMAP4_SSL, uid: int, section: str, partial: tuple = None) -> bytes:
+    '''
+    Fetches a single section of an email without marking it as seen
+
+    Args:
+        imap_client (IMAP4_SSL): A logged in imap client with the mailbox selected
+        uid (int): The uid of the email
+        section (str): The section to fetch. E.g. `1.2`, `1.2.MIME`, `HEADER`
+        partial (tuple, optional): (offset, length) to only fetch part of the section.
+                                   Defaults to None.
+
+    Returns:
+        bytes: The contents of the section, or b'' if the server returned nothing
+    '''
+
+    item = f'BODY.PEEK[{section}]'
+    if partial is not None:
+        item += '<%d.%d>' % partial
+    response = await imap_client.uid('fetch', str(uid), item)
+    if response.result != 'OK':
+        return b''
+    for i, line in enumerate(response.lines[:-1]):
+        if isinstance(line, (bytes, bytearray)) and _FETCH_LITERAL_RE.search(bytes(line)):
+            return bytes(response.lines[i + 1])
+    return b''
+
+async def stream_section(imap_client: aioimaplib.IMAP4_SSL, uid: int, part: BodyPart, fp, chunk_size: int = 1 << 20) -> int:
+    '''
+    Streams a part of an email into fp using partial fetches, decoding it as it arrives
+
+    Args:
+        imap_client (IMAP4_SSL): A logged in imap client with the mailbox selected
+        uid (int): The uid of the email
+        part (BodyPart): The part to download
+        fp (file): A binary file object to write the decoded part into
+        chunk_size (int, optional): Number of octets to request per fetch. Defaults to 1 MiB.
+
+    Returns:
+        int: Number of decoded bytes written into fp
+    '''
+
+    decoder = StreamDecoder(part.encoding)
+    written = 0
+    offset = 0
+    while True:
+        chunk = await fetch_section(imap_client, uid, part.section, (offset, chunk_size))
+        if not chunk:
+            break
+        data = decoder.feed(chunk)
+        fp.write(data)
+        written += len(data)
+        offset += len(chunk)
+        if len(chunk) < chunk_size or (part.size and offset >= part.size):
+            break
+    data = decoder.flush()
+    fp.write(data)
+    written += len(data)
+
+    return written
+
+async def feed_section(imap_client: aioimaplib.IMAP4_SSL, uid: int, part: BodyPart, parser, chunk_size: int = 1 << 18,
+                       max_bytes: int = None) -> int:
+    '''
+    Feeds a part of an email into parser as it arrives, using partial fetches, without removing
+    its transfer encoding. Only one chunk is held in memory at a time besides what parser keeps.
+
+    Args:
+        imap_client (IMAP4_SSL): A logged in imap client with the mailbox selected
+        uid (int): The uid of the email
+        part (BodyPart): The part to download
+        parser (email.parser.BytesFeedParser): The parser to feed. Its headers should already be fed.
+        chunk_size (int, optional): Number of octets to request per fetch. Defaults to 256 KiB.
+        max_bytes (int, optional): Stop after this many octets. Defaults to None (no limit).
+
+    Returns:
+        int: Number of octets fed into parser
+    '''
+
+    offset = 0
+    while max_bytes is None or offset < max_bytes:
+        length = chunk_size if max_bytes is None else min(chunk_size, max_bytes - offset)
+        chunk = await fetch_section(imap_client, uid, part.section, (offset, length))
+        if not chunk:
+            break
+        parser.feed(chunk)
+        offset += len(chunk)
+        if len(chunk) < length or (part.size and offset >= part.size):
+            break
+
+    return offset
+
+
+class ImapClientPool:
+    '''
+    Shares a few logged in imap clients between concurrent tasks
+
+    Every `uid()` command is run on whichever client is free, so the helpers in this
+    module can be given the pool in place of a client. A client is never sent two
+    commands at once.
+    '''
+
+    def __init__(self, clients: list):
+        '''
+        Args:
+            clients (list): Logged in imap clients with the mailbox selected
+        '''
+
+        self.clients = list(clients)
+        self._free = asyncio.Queue()
+        for client in self.clients:
+            self._free.put_nowait(client)
+
+    async def uid(self, *args, **kwargs):
+        '''
+        Runs a UID command on a free client
+        '''
+
+        client = await self._free.get()
+        try:
+            return await client.uid(*args, **kwargs)
+        finally:
+            self._free.put_nowait(client)
@@ -0,0 +1,191 @@
+'''
+A request/response link between the bot's processes over a local Unix socket.
+
+In split mode the Discord bot and the email ingester run as separate processes. The bot
+listens on the socket and the ingester connects to it, reconnecting whenever the bot
+restarts. Either side can then call a method on the other: the ingester asks the bot to
+post rendered emails, and the bot asks the ingester for its pipeline stats or to fetch
+new emails.
+
+Each message is a 4 byte big-endian length followed by that many bytes of json:
+
+- Request: `{"id": 1, "method": "post", "params": {...}}`
+- Response: `{"id": 1, "result": ...}` or `{"id": 1, "error": "..."}`
+'''
+
+import asyncio
+import json
+import os
+import struct
+
+_LENGTH = struct.Struct('>I')
+
+
+class LinkError(ConnectionError):
+    '''
+    Raised when a call over the link fails: the other process isn't connected, went away
+    before answering, or raised an exception while handling the call
+    '''
+
+
+class Link:
+    '''
+    One end of the link
+
+    Attributes:
+        `handlers`: Coroutine functions by method name, called with the params of each request
+        `connected`: Whether the other process is currently connected
+    '''
+
+    def __init__(self, handlers: dict = None, max_message_bytes: int = 64 * 1024 * 1024):
+        '''
+        Creates the link. Call serve() on one side and connect() on the other.
+
+        Args:
+            handlers (dict, optional): Coroutine functions by method name. Defaults to None.
+            max_message_bytes (int, optional): Largest message accepted. Defaults to 64 MiB.
+        '''
+
+        self.handlers = dict(handlers or {})
+        self.max_message_bytes = max_message_bytes
+        self._writer = None
+        self._connected = asyncio.Event()
+        self._pending = {}
+        self._next_id = 0
+        self._server = None
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    async def serve(self, path: str) -> None:
+        '''
+        Listens on the Unix socket at path. A new connection replaces the previous one.
+        '''
+
+        if os.path.exists(path):
+            os.remove(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._server = await asyncio.start_unix_server(self._run_connection, path)
+
+    async def connect(self, path: str, retry_interval: float = 1.0) -> None:
+        '''
+        Connects to the Unix socket at path and keeps reconnecting whenever the connection
+        drops. Runs until cancelled.
+        '''
+
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(path)
+            except OSError:
+                await asyncio.sleep(retry_interval)
+                continue
+            await self._run_connection(reader, writer)
+            await asyncio.sleep(retry_interval)
+
+    async def close(self) -> None:
+        '''
+        Stops listening and closes the current connection
+        '''
+
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._writer is not None:
+            self._writer.close()
+
+    async def call(self, method: str, timeout: float = 60, **params):
+        '''
+        Calls method on the other process and waits for the result
+
+        Args:
+            method (str): The method name
+            timeout (float, optional): Seconds to wait for the other process to connect and
+                                       then to answer. Defaults to 60.
+            **params: The parameters of the method. Must be json serializable.
+
+        Raises:
+            LinkError: If the call failed
+
+        Returns:
+            The result of the method
+        '''
+
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise LinkError(f'{method}: the other process is not connected') from None
+
+        self._next_id += 1
+        call_id = self._next_id
+        future = asyncio.get_event_loop().create_future()
+        self._pending[call_id] = future
+        try:
+            self._send({'id': call_id, 'method': method, 'params': params})
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise LinkError(f'{method}: no answer after {timeout} s') from None
+        finally:
+            self._pending.pop(call_id, None)
+
+    def _send(self, message: dict, writer: asyncio.StreamWriter = None) -> None:
+        data = json.dumps(message).encode('utf-8')
+        (writer or self._writer).write(_LENGTH.pack(len(data)) + data)
+
+    async def _run_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''
+        Reads messages from a connection until it closes
+        '''
+
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = writer
+        self._connected.set()
+        tasks = set()
+        try:
+            while True:
+                header = await reader.readexactly(_LENGTH.size)
+                (length,) = _LENGTH.unpack(header)
+                if length > self.max_message_bytes:
+                    raise LinkError(f'message of {length} bytes is too large')
+                message = json.loads(await reader.readexactly(length))
+                if 'method' in message:
+                    task = asyncio.ensure_future(self._handle(message, writer))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                else:
+                    future = self._pending.get(message.get('id'))
+                    if future is None or future.done():
+                        continue
+                    if 'error' in message:
+                        future.set_exception(LinkError(message['error']))
+                    else:
+                        future.set_result(message.get('result'))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            # Only forget the connection if a newer one hasn't replaced it already
+            if self._writer is writer:
+                self._writer = None
+                self._connected.clear()
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(LinkError('the other process disconnected'))
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _handle(self, message: dict, writer: asyncio.StreamWriter) -> None:
+        '''
+        Runs the handler of a request and sends back its result
+        '''
+
+        handler = self.handlers.get(message['method'])
+        try:
+            if handler is None:
+                raise LinkError(f'unknown method `{message["method"]}`')
+            response = {'id': message['id'], 'result': await handler(**message.get('params', {}))}
+        except Exception as e:
+            response = {'id': message['id'], 'error': f'{type(e).__name__}: {e}'}
+        if not writer.is_closing():
+            self._send(response, writer)
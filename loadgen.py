@@ -0,0 +1,559 @@
+'''
+Offline load generator for the bot's Discord message handler and roster commands.
+
+Builds the bot with the real handlers (main.register_handlers()) but without logging in,
+then feeds fake Discord messages from many synthetic servers and users into `on_message`
+at a fixed rate. Emails go to a fake SMTP server and Discord replies go nowhere, each
+after a configurable delay, so nothing leaves the machine. Everything runs in a scratch
+copy of the bot's files. E.g.
+
+    python loadgen.py --guilds 50 --users 20 --rate 25 --duration 60
+    python loadgen.py --mix message=1 --attachments 0.5 --json results.json
+
+Reports per handler: latency percentiles, errors, and the files opened for reading and
+writing per message. Also reports how long the event loop was blocked, measured by a
+task that wakes up every few milliseconds and records how late it was.
+'''
+
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import discord as dc
+from discord.ext import commands
+import pandas as pd
+
+import main
+from hotprofile import PROFILER
+
+# The kinds of messages sent, with their default share of the load
+DEFAULT_MIX = {
+    'message': 0.5,
+    'chat': 0.1,
+    'add_me': 0.1,
+    'get_my_info': 0.15,
+    'edit_me': 0.1,
+    'remove_me': 0.05
+}
+
+_current_op = contextvars.ContextVar('current_op', default=None)
+_wait_for_script = contextvars.ContextVar('wait_for_script', default=None)
+
+
+def percentile(values: list, pct: float) -> float:
+    '''
+    Returns the pct-th percentile of values (nearest rank), or 0.0 if there are none
+    '''
+
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(max(int(round(pct / 100 * len(values) + 0.5)) - 1, 0), len(values) - 1)
+    return values[idx]
+
+
+class OpRecord:
+    '''
+    The outcome of one message fed to the bot
+    '''
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.latency = None
+        self.error = None
+        self.reads = 0
+        self.writes = 0
+
+
+class FakeUser:
+    '''
+    A Discord user or member
+    '''
+
+    bot = False
+
+    def __init__(self, user_id: int, name: str):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.mention = f'<@{user_id}>'
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeGuild:
+    '''
+    A Discord server
+    '''
+
+    def __init__(self, guild_id: int, name: str):
+        self.id = guild_id
+        self.name = name
+        self.filesize_limit = 8 * 1024 * 1024
+
+
+class FakeChannel:
+    '''
+    A Discord text channel. Sending waits `latency` seconds.
+    '''
+
+    def __init__(self, channel_id: int, name: str, guild: FakeGuild, harness: 'LoadGenerator'):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.mention = f'<#{channel_id}>'
+        self._harness = harness
+
+    async def send(self, content: str = None, **kwargs) -> 'FakeMessage':
+        # discord.py closes the files once they're uploaded
+        files = kwargs.get('files') or ([kwargs['file']] if kwargs.get('file') is not None else [])
+        try:
+            return await self._harness.discord_call(self, content)
+        finally:
+            for f in files:
+                f.close()
+
+
+class FakeAttachment:
+    '''
+    A Discord attachment whose contents are made up when it's saved
+    '''
+
+    def __init__(self, att_id: int, filename: str, size: int, harness: 'LoadGenerator'):
+        self.id = att_id
+        self.filename = filename
+        self.size = size
+        self.url = f'https://cdn.example.invalid/attachments/{att_id}/{filename}'
+        self._harness = harness
+
+    async def save(self, fp, *, seek_begin: bool = True, use_cached: bool = False) -> int:
+        await asyncio.sleep(self._harness.discord_latency)
+        fp.write(os.urandom(self.size))
+        if seek_begin:
+            fp.seek(0)
+        return self.size
+
+
+class FakeMessage:
+    '''
+    A Discord message. Replying and reacting wait `latency` seconds.
+    '''
+
+    def __init__(self, message_id: int, content: str, author: FakeUser, channel: FakeChannel,
+                 attachments: list = None):
+        self.id = message_id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild if channel is not None else None
+        self.attachments = attachments or []
+        self.reference = None
+        self.mentions = []
+        self.embeds = []
+
+    async def reply(self, content: str = None, **kwargs) -> 'FakeMessage':
+        return await self.channel._harness.discord_call(self.channel, content)
+
+    async def add_reaction(self, emoji) -> None:
+        await self.channel._harness.discord_call(self.channel, None)
+
+
+class FakeSMTP:
+    '''
+    An SMTP connection that takes `latency` seconds to send each email, blocking like smtplib does
+    '''
+
+    def __init__(self, harness: 'LoadGenerator'):
+        self._harness = harness
+
+    def sendmail(self, from_addr: str, to_addrs: list, msg: bytes) -> dict:
+        time.sleep(self._harness.smtp_latency)
+        self._harness.emails_sent += 1
+        self._harness.email_bytes += len(msg)
+        return {}
+
+    def quit(self) -> None:
+        pass
+
+
+class LoadGenerator:
+    '''
+    Drives the bot's handlers with synthetic messages and records how they behave
+    '''
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.discord_latency = args.discord_latency
+        self.smtp_latency = args.smtp_latency
+        self.random = random.Random(args.seed)
+        self.records = []
+        self.discord_calls = 0
+        self.emails_sent = 0
+        self.email_bytes = 0
+        self.blocked_s = 0.0
+        self.max_stall_s = 0.0
+        self.stalls = 0
+        self._next_id = 10 ** 17
+        self.guilds = []
+        self.channels = {}
+        self.workdir = None
+        self.bot = None
+        self.bot_user = None
+        self.dcts = None
+
+    def new_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    async def discord_call(self, channel: FakeChannel, content: str) -> FakeMessage:
+        '''
+        Stands in for every call to the Discord API
+        '''
+
+        self.discord_calls += 1
+        await asyncio.sleep(self.discord_latency)
+        return FakeMessage(self.new_id(), content or '', self.bot_user, channel)
+
+    def setup_files(self) -> None:
+        '''
+        Creates a scratch copy of deci_config.json, the server configs and the mailing lists,
+        and changes into it
+        '''
+
+        repo_dir = os.path.dirname(os.path.abspath(__file__))
+        self.workdir = os.path.abspath(self.args.workdir or tempfile.mkdtemp(prefix='deci_loadgen_'))
+        os.makedirs(self.workdir, exist_ok=True)
+        shutil.copy(os.path.join(repo_dir, 'deci_config.json'), self.workdir)
+        os.chdir(self.workdir)
+
+        deci_config = main.read_config_file('deci_config.json')
+        for path in deci_config['dir_paths'].values():
+            if os.path.dirname(path) == '' and '.' not in path:
+                os.makedirs(path, exist_ok=True)
+            elif os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+        for k in ['deferred_atts_dir', 'att_store_index_dir']:
+            with open(deci_config['dir_paths'][k], 'w') as fp:
+                fp.write('{}')
+
+        guilds_conf = {}
+        rows = []
+        for g in range(self.args.guilds):
+            guild = FakeGuild(self.new_id(), f'loadgen-{g}')
+            email_channel = FakeChannel(self.new_id(), 'email', guild, self)
+            chat_channel = FakeChannel(self.new_id(), 'general', guild, self)
+            users = [FakeUser(self.new_id(), f'user{g}_{u}') for u in range(self.args.users)]
+            self.guilds.append((guild, email_channel, chat_channel, users))
+            guilds_conf[str(guild.id)] = {
+                'name': guild.name,
+                'email_channel': str(email_channel.id),
+                'currentSubject': f'Load test {g}',
+                'email_aliases': [],
+                'subject_tag': None
+            }
+            # Half of each server starts on the mailing list
+            for user in users[:max(len(users) // 2, 1)]:
+                rows.append({'Server_ID': guild.id, 'User_ID': user.id, 'Name': user.name,
+                             'Email': f'{user.name}@example.invalid', 'Colour': 'DarkSlateGray'})
+        main.update_config_file(deci_config['dir_paths']['guilds_dir'], guilds_conf)
+        pd.DataFrame(rows, columns=['Server_ID', 'User_ID', 'Name', 'Email', 'Colour']).to_csv(
+            deci_config['dir_paths']['chain_users_dir'], index=False)
+        self.channels = {c.id: c for _, e, t, _ in self.guilds for c in (e, t)}
+
+    def setup_bot(self) -> commands.Bot:
+        '''
+        Builds the bot with the real handlers, with every call that would leave the machine stubbed
+        '''
+
+        os.environ.setdefault('DC_EMAIL_ADDR', 'loadgen@example.invalid')
+        os.environ.setdefault('DC_EMAIL_PASS', 'loadgen')
+        os.environ.setdefault('DISCORD_BOT', 'loadgen')
+        dcts = main.DeciConsts()
+        dcts.bot = commands.Bot(command_prefix=dcts.COMMAND_PREFIX, intents=dc.Intents.default())
+        bot = main.register_handlers(dcts)
+
+        # The bot never logs in, so give it a user and look channels up in the synthetic servers
+        self.bot_user = FakeUser(self.new_id(), 'deci-loadgen')
+        self.bot_user.bot = True
+        bot._connection.user = self.bot_user
+        bot.get_channel = self.channels.get
+        bot.get_guild = lambda guild_id: next((g for g, _, _, _ in self.guilds if g.id == guild_id), None)
+
+        async def wait_until_ready():
+            pass
+        bot.wait_until_ready = wait_until_ready
+
+        async def wait_for(event, *, check=None, timeout=None):
+            # Answers edit_user's questions from the script of the message being handled
+            script = _wait_for_script.get()
+            await asyncio.sleep(self.discord_latency)
+            if not script:
+                raise asyncio.TimeoutError()
+            return FakeMessage(self.new_id(), script.pop(0), None, None)
+        bot.wait_for = wait_for
+
+        async def on_command_error(ctx, error):
+            record = _current_op.get()
+            if record is not None:
+                record.error = repr(error)
+        bot.add_listener(on_command_error, 'on_command_error')
+
+        async def is_valid_html_colour(ctx, colour):
+            await asyncio.sleep(self.discord_latency)
+            return True
+        main.is_valid_html_colour = is_valid_html_colour
+        main.connect_smtp = lambda dcts: FakeSMTP(self)
+
+        self.bot = bot
+        self.dcts = dcts
+        return bot
+
+    def count_file_access(self, event: str, args: tuple) -> None:
+        '''
+        Audit hook that adds the files opened in the scratch directory to the current message's record
+        '''
+
+        if event != 'open':
+            return
+        record = _current_op.get()
+        if record is None:
+            return
+        path, mode, flags = args
+        if not isinstance(path, (str, bytes, os.PathLike)):
+            return
+        path = os.path.abspath(os.fsdecode(path))
+        if not path.startswith(self.workdir):
+            return
+        if mode is not None:
+            writing = any(c in mode for c in 'wax+')
+        else:
+            writing = bool(flags & (os.O_WRONLY | os.O_RDWR))
+        if writing:
+            record.writes += 1
+        else:
+            record.reads += 1
+
+    def make_message(self, kind: str) -> tuple:
+        '''
+        Makes a message of the given kind from a random user in a random server
+
+        Returns:
+            tuple: (The message, the replies to edit_user's questions)
+        '''
+
+        guild, email_channel, chat_channel, users = self.random.choice(self.guilds)
+        user = self.random.choice(users)
+        script = None
+        attachments = []
+        if kind == 'message':
+            channel = email_channel
+            content = ' '.join(self.random.choice(['lorem', 'ipsum', '**dolor**', 'sit', 'amet', '_consectetur_'])
+                               for _ in range(self.random.randint(5, self.args.words)))
+            if self.random.random() < self.args.attachments:
+                attachments = [FakeAttachment(self.new_id(), f'photo{i}.jpg', self.args.attachment_size, self)
+                               for i in range(self.random.randint(1, 3))]
+        elif kind == 'chat':
+            channel = chat_channel
+            content = 'just chatting'
+        else:
+            channel = chat_channel
+            if kind == 'add_me':
+                content = f'$add_me {user.name} {user.name}@example.invalid DarkSlateGray'
+            elif kind == 'edit_me':
+                content = '$edit_me'
+                script = ['Name', f'{user.name}_renamed']
+            else:
+                content = f'${kind}'
+        return FakeMessage(self.new_id(), content, user, channel, attachments), script
+
+    async def run_op(self, kind: str) -> None:
+        message, script = self.make_message(kind)
+        record = OpRecord(kind)
+        _current_op.set(record)
+        _wait_for_script.set(script)
+        start = time.perf_counter()
+        try:
+            await self.bot.on_message(message)
+        except Exception as e:
+            record.error = repr(e)
+        record.latency = time.perf_counter() - start
+        self.records.append(record)
+
+    async def watch_loop(self, interval: float = 0.005, threshold: float = 0.01) -> None:
+        '''
+        Records how late the event loop wakes this task up, until cancelled
+        '''
+
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag = loop.time() - start - interval
+            if lag > threshold:
+                self.blocked_s += lag
+                self.stalls += 1
+                self.max_stall_s = max(self.max_stall_s, lag)
+
+    async def run(self) -> float:
+        '''
+        Sends `rate` messages a second for `duration` seconds, without waiting for the bot to
+        keep up, then waits for every message to be handled
+
+        Returns:
+            float: The wall time in seconds
+        '''
+
+        mix = self.args.mix
+        kinds, weights = list(mix), list(mix.values())
+        count = max(int(self.args.rate * self.args.duration), 1)
+        watcher = asyncio.ensure_future(self.watch_loop())
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        tasks = []
+        for i in range(count):
+            delay = start + i / self.args.rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(self.run_op(self.random.choices(kinds, weights)[0])))
+        await asyncio.gather(*tasks)
+        # Let the command error events run
+        await asyncio.sleep(0.1)
+        elapsed = loop.time() - start
+        watcher.cancel()
+        return elapsed
+
+    def report(self, elapsed: float) -> dict:
+        '''
+        Summarizes the records per kind of message
+        '''
+
+        by_kind = defaultdict(list)
+        for record in self.records:
+            by_kind[record.kind].append(record)
+        handlers = {}
+        for kind, records in sorted(by_kind.items()):
+            latencies = [r.latency * 1000 for r in records]
+            handlers[kind] = {
+                'count': len(records),
+                'errors': sum(r.error is not None for r in records),
+                'p50_ms': percentile(latencies, 50),
+                'p90_ms': percentile(latencies, 90),
+                'p99_ms': percentile(latencies, 99),
+                'max_ms': max(latencies),
+                'reads_per_msg': sum(r.reads for r in records) / len(records),
+                'writes_per_msg': sum(r.writes for r in records) / len(records)
+            }
+        return {
+            'elapsed_s': elapsed,
+            'messages': len(self.records),
+            'handlers': handlers,
+            'event_loop': {
+                'blocked_s': self.blocked_s,
+                'blocked_pct': 100 * self.blocked_s / elapsed if elapsed else 0.0,
+                'stalls': self.stalls,
+                'max_stall_ms': self.max_stall_s * 1000
+            },
+            'discord_calls': self.discord_calls,
+            'emails_sent': self.emails_sent,
+            'email_bytes': self.email_bytes,
+            'errors': sorted({r.error for r in self.records if r.error is not None})[:10]
+        }
+
+
+def format_report(report: dict) -> str:
+    '''
+    Formats report as a table
+    '''
+
+    lines = [f'{report["messages"]} messages in {report["elapsed_s"]:.1f} s',
+             f'{"handler":<12} {"count":>6} {"errors":>6} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"max ms":>8} {"reads":>6} {"writes":>6}']
+    for kind, h in report['handlers'].items():
+        lines.append(f'{kind:<12} {h["count"]:>6} {h["errors"]:>6} {h["p50_ms"]:>8.1f} {h["p90_ms"]:>8.1f} '
+                     f'{h["p99_ms"]:>8.1f} {h["max_ms"]:>8.1f} {h["reads_per_msg"]:>6.1f} {h["writes_per_msg"]:>6.1f}')
+    loop_stats = report['event_loop']
+    lines.append(f'Event loop blocked for {loop_stats["blocked_s"]:.2f} s ({loop_stats["blocked_pct"]:.1f}%) '
+                 f'over {loop_stats["stalls"]} stalls, longest {loop_stats["max_stall_ms"]:.1f} ms')
+    lines.append(f'{report["discord_calls"]} Discord calls, {report["emails_sent"]} emails ({report["email_bytes"]} bytes)')
+    for error in report['errors']:
+        lines.append(f'Error: {error}')
+    return '\n'.join(lines)
+
+def parse_mix(value: str) -> dict:
+    '''
+    Parses `kind=weight,kind=weight` into a dict
+    '''
+
+    mix = {}
+    for item in value.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f'unknown message kind `{kind}`. Choose from {", ".join(DEFAULT_MIX)}')
+        mix[kind] = float(weight or 1)
+    return mix
+
+def main_cli(argv: list = None) -> dict:
+    '''
+    Command line entry point
+
+    Args:
+        argv (list, optional): The command line arguments. Defaults to sys.argv.
+
+    Returns:
+        dict: The report
+    '''
+
+    arg_parser = argparse.ArgumentParser(description='Drives the bot\'s message handler and roster commands with synthetic load')
+    arg_parser.add_argument('--guilds', type=int, default=20, help='Number of synthetic servers (default 20)')
+    arg_parser.add_argument('--users', type=int, default=10, help='Number of users per server (default 10)')
+    arg_parser.add_argument('--rate', type=float, default=20, help='Messages per second (default 20)')
+    arg_parser.add_argument('--duration', type=float, default=30, help='Seconds to send messages for (default 30)')
+    arg_parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                            help='Share of each kind of message, e.g. `message=5,get_my_info=1`. '
+                                 f'Kinds: {", ".join(DEFAULT_MIX)}')
+    arg_parser.add_argument('--words', type=int, default=80, help='Most words in an emailed message (default 80)')
+    arg_parser.add_argument('--attachments', type=float, default=0.1,
+                            help='Share of emailed messages with 1-3 attachments (default 0.1)')
+    arg_parser.add_argument('--attachment-size', type=int, default=256 * 1024, help='Bytes per attachment (default 256 KiB)')
+    arg_parser.add_argument('--discord-latency', type=float, default=0.05, help='Seconds per Discord API call (default 0.05)')
+    arg_parser.add_argument('--smtp-latency', type=float, default=0.1, help='Seconds per email sent (default 0.1)')
+    arg_parser.add_argument('--seed', type=int, default=0, help='Random seed (default 0)')
+    arg_parser.add_argument('--workdir', help='Scratch directory for the bot\'s files. Defaults to a new temporary directory')
+    arg_parser.add_argument('--json', metavar='OUTPUT', help='Also write the report as json to OUTPUT')
+    arg_parser.add_argument('--profile', action='store_true', help='Profile the handlers into the scratch log directory')
+    args = arg_parser.parse_args(argv)
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    harness = LoadGenerator(args)
+    harness.setup_files()
+    harness.setup_bot()
+    sys.addaudithook(harness.count_file_access)
+
+    deci_config = main.read_config_file('deci_config.json')
+    if args.profile:
+        PROFILER.start(deci_config['dir_paths']['log_file_dir'])
+    elapsed = asyncio.get_event_loop().run_until_complete(harness.run())
+    report = harness.report(elapsed)
+    print(format_report(report))
+    for path in PROFILER.stop():
+        print(f'Wrote {os.path.abspath(path)}')
+    print(f'Scratch files are in {harness.workdir}')
+    if json_path:
+        with open(json_path, mode='w', encoding='utf-8') as fp:
+            json.dump(report, fp, indent=4)
+    return report
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,228 @@
+'''
+Serves the emails in an mbox file or Maildir directory as if they were on an IMAP server.
+
+`LocalMailbox.uid()` answers the same `UID FETCH` commands that render_email() and the
+imapparts helpers send to aioimaplib (`BODYSTRUCTURE` and `BODY.PEEK[section]<offset.length>`),
+so local emails go through exactly the same rendering code as emails in the live inbox.
+The emails are numbered 1, 2, 3... in mailbox order and used as their uids.
+'''
+
+import mailbox
+import os
+import re
+from collections import OrderedDict
+from email import policy
+from email.generator import BytesGenerator
+from email.parser import BytesHeaderParser, BytesParser
+from email.utils import collapse_rfc2231_value
+from io import BytesIO
+
+from aioimaplib import Response
+
+_SECTION_RE = re.compile(r'BODY\.PEEK\[([^\]]*)\](?:<(\d+)\.(\d+)>)?', re.I)
+_CRLF_POLICY = policy.compat32.clone(linesep='\r\n')
+
+
+def _quote(value) -> str:
+    '''
+    Formats value as an IMAP string, or NIL if it is None
+    '''
+
+    if value is None:
+        return 'NIL'
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\r', ' ').replace('\n', ' ')
+    return f'"{value}"'
+
+def _quote_params(params: list) -> str:
+    '''
+    Formats a list of (key, value) pairs as an IMAP parenthesized list
+    '''
+
+    if not params:
+        return 'NIL'
+    return '(' + ' '.join(f'{_quote(k)} {_quote(collapse_rfc2231_value(v))}' for k, v in params) + ')'
+
+def _split(msg) -> tuple:
+    '''
+    Serializes msg with CRLF line endings and splits it into its header and its body
+    '''
+
+    buf = BytesIO()
+    BytesGenerator(buf, mangle_from_=False, policy=_CRLF_POLICY).flatten(msg)
+    data = buf.getvalue()
+    idx = data.find(b'\r\n\r\n')
+    if idx == -1:
+        return data, b''
+    return data[:idx + 4], data[idx + 4:]
+
+
+class LocalMailbox:
+    '''
+    An mbox file or Maildir directory that can be read with the same commands as an imap client
+
+    Attributes:
+        `path`: Path to the mbox file or Maildir directory
+        `is_local`: Always True. Parts of these emails can't be fetched again from the live inbox.
+    '''
+
+    is_local = True
+
+    def __init__(self, path: str, cache_size: int = 64):
+        '''
+        Opens the mailbox at path
+
+        Args:
+            path (str): Path to an mbox file or a Maildir directory
+            cache_size (int, optional): Number of parsed emails to keep in memory. Defaults to 64.
+        '''
+
+        self.path = path
+        if os.path.isdir(path):
+            self._mailbox = mailbox.Maildir(path, factory=None, create=False)
+            self._keys = sorted(self._mailbox.keys())
+        else:
+            self._mailbox = mailbox.mbox(path, factory=None, create=False)
+            self._keys = list(self._mailbox.keys())
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def uids(self) -> range:
+        '''
+        Returns the uids of all the emails in the mailbox
+        '''
+
+        return range(1, len(self._keys) + 1)
+
+    def headers(self, uid: int):
+        '''
+        Returns the headers of the email uid, parsed the same way as fetch_email_headers()
+        '''
+
+        return BytesHeaderParser().parsebytes(self._sections(uid)['HEADER'])
+
+    def release(self, uid: int) -> None:
+        '''
+        Drops the email uid from the cache once it's no longer needed
+        '''
+
+        self._cache.pop(uid, None)
+
+    def _message_bytes(self, uid: int) -> bytes:
+        '''
+        Returns the raw email uid
+        '''
+
+        if uid < 1:
+            raise IndexError(uid)
+        return self._mailbox.get_bytes(self._keys[uid - 1])
+
+    def _sections(self, uid: int) -> dict:
+        '''
+        Parses the email uid into its BODYSTRUCTURE and the contents of each of its IMAP sections
+        '''
+
+        if uid in self._cache:
+            self._cache.move_to_end(uid)
+            return self._cache[uid]
+
+        msg = BytesParser().parsebytes(self._message_bytes(uid))
+        sections = {}
+        header, body = _split(msg)
+        sections['HEADER'] = header
+        sections['TEXT'] = body
+        sections['BODYSTRUCTURE'] = self._structure(msg, '', sections)
+
+        self._cache[uid] = sections
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return sections
+
+    def _structure(self, msg, section: str, sections: dict) -> str:
+        '''
+        Builds the BODYSTRUCTURE of msg, recording the contents of each of its sections
+
+        Args:
+            msg (email.message.Message): The email or one of its parts
+            section (str): The section specifier of msg. '' for the whole email.
+            sections (dict): Where to record the section contents
+
+        Returns:
+            str: The BODYSTRUCTURE of msg
+        '''
+
+        disposition = msg.get('Content-Disposition')
+        if disposition is not None:
+            disp_params = [(k, v) for k, v in msg.get_params(header='Content-Disposition')[1:]]
+            disp = f'({_quote(msg.get_content_disposition())} {_quote_params(disp_params)})'
+        else:
+            disp = 'NIL'
+
+        if msg.is_multipart() and msg.get_content_maintype() == 'multipart':
+            prefix = '' if section == '' else section + '.'
+            children = ''
+            for i, child in enumerate(msg.get_payload()):
+                child_section = f'{prefix}{i + 1}'
+                children += self._structure(child, child_section, sections)
+            if section != '':
+                sections[f'{section}.MIME'], sections[section] = _split(msg)
+            params = [(k, v) for k, v in (msg.get_params() or [])[1:]]
+            return f'({children} {_quote(msg.get_content_subtype())} {_quote_params(params)} {disp} NIL NIL)'
+
+        # A single part email is section 1 of itself
+        if section == '':
+            section = '1'
+            sections['1'] = sections['TEXT']
+        else:
+            sections[f'{section}.MIME'], sections[section] = _split(msg)
+        body = sections[section]
+        params = [(k, v) for k, v in (msg.get_params() or [])[1:]]
+        fields = [_quote(msg.get_content_maintype()), _quote(msg.get_content_subtype()), _quote_params(params),
+                  _quote(msg.get('Content-ID')), _quote(msg.get('Content-Description')),
+                  _quote(msg.get('Content-Transfer-Encoding', '7bit')), str(len(body))]
+        if msg.get_content_maintype() == 'text':
+            fields.append(str(body.count(b'\n')))
+        elif msg.get_content_type() == 'message/rfc822':
+            # The envelope and structure of attached emails aren't needed, only their size
+            fields += ['NIL', '("text" "plain" NIL NIL NIL "7bit" 0 0)', str(body.count(b'\n'))]
+        fields += ['NIL', disp, 'NIL', 'NIL']
+        return '(' + ' '.join(fields) + ')'
+
+    async def uid(self, command: str, uid: str, item: str) -> Response:
+        '''
+        Answers a `UID FETCH` of `(BODYSTRUCTURE)` or `BODY.PEEK[section]<offset.length>`
+        the way an imap server would
+
+        Args:
+            command (str): Only `fetch` is supported
+            uid (str): The uid of a single email
+            item (str): The data item to fetch
+
+        Returns:
+            Response: The imap response
+        '''
+
+        try:
+            uid = int(uid)
+            sections = self._sections(uid)
+        except (ValueError, IndexError, KeyError):
+            return Response('NO', [b'UID FETCH failed: no such message'])
+        if command.lower() != 'fetch':
+            return Response('BAD', [b'Only UID FETCH is supported'])
+
+        if 'BODYSTRUCTURE' in item.upper():
+            line = f'{uid} FETCH (UID {uid} BODYSTRUCTURE {sections["BODYSTRUCTURE"]})'
+            return Response('OK', [line.encode('utf-8'), b'FETCH completed'])
+
+        match = _SECTION_RE.search(item)
+        if match is None:
+            return Response('BAD', [b'Unsupported fetch item'])
+        section, offset, length = match.groups()
+        data = sections.get(section.upper() if section.upper() in ('HEADER', 'TEXT') else section, b'')
+        item_name = f'BODY[{section}]'
+        if offset is not None:
+            data = data[int(offset):int(offset) + int(length)]
+            item_name += f'<{offset}>'
+        if not data:
+            return Response('OK', [f'{uid} FETCH (UID {uid} {item_name} "")'.encode(), b'FETCH completed'])
+        return Response('OK', [f'{uid} FETCH (UID {uid} {item_name} {{{len(data)}}}'.encode(), data, b')',
+                               b'FETCH completed'])
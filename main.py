@@ -1,21 +1,26 @@
 # Discord packages
 import discord as dc
 from discord.ext import commands
+from discord.http import Route
 
 # File manipulation packages
 import json
+import io
 import pandas as pd
 
 # Email packages
 import smtplib
 import aioimaplib
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.parser import BytesHeaderParser, BytesParser
+from email.parser import BytesFeedParser, BytesHeaderParser
+from email.utils import make_msgid
+from mimebuilder import PreparedEmail, text_part
+from imapparts import BodyPart, ImapClientPool, decoded_size, feed_section, fetch_section, parse_bodystructure, select_body_part, stream_section, walk
+from imapparts import filename as part_filename
 
 # Text conversion and parsing packages
 from htmlvalidation import HTMLValidator
+from quotestrip import strip_quoted_html, strip_quoted_text
+from msgchunker import DISCORD_MESSAGE_LIMIT, chunk_message
 from markdownify import markdownify
 import re
 
@@ -26,13 +31,50 @@ from dateutil import parser
 
 # Misc
 import os
-from os.path import basename
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from urllib.parse import quote
 import getpass
 import asyncio
 from asyncio import get_event_loop, wait_for
 from collections import namedtuple
 from typing import Collection, Union
 import logging as log
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+import queue
+import atexit
+from functools import partial
+from deliveryjournal import DeliveryJournal
+from threadindex import ThreadIndex
+from attachmentstore import AttachmentStore
+from attachmentjanitor import AttachmentJanitor
+from imagetransform import ImageTransformer
+from guildrouter import GuildRouter
+from hotprofile import PROFILER, profiled
+from localmailbox import LocalMailbox
+from pipeline import Pipeline, Stage
+from ipclink import Link, LinkError
+from scheduler import BULK, INTERACTIVE, LatencyStats, PriorityLimiter, WorkerPool
+from embedbatch import MAX_EMBEDS, EmbedBatcher, html_colour_value
+
+# Headers fetched for every incoming email
+ID_HEADER_SET = {'Content-Type', 'From', 'To', 'Cc', 'Bcc', 'Date', 'Subject', 'Message-ID', 'In-Reply-To', 'References'}
+FETCH_MESSAGE_DATA_UID = re.compile(rb'.*UID (?P<uid>\d+).*')
+
+# Metrics of the email ingest pipeline stages since the bot started
+INGEST_METRICS = {}
+
+# Concurrent Discord API calls and worker threads, shared between interactive command replies and 
+# bulk email delivery with replies first (see configure_scheduling())
+DISCORD_CALLS = PriorityLimiter('discord', 8, reserved = {INTERACTIVE: 2})
+WORKERS = WorkerPool('deci-worker', 8, reserved = {INTERACTIVE: 2})
+# Time taken by each command (interactive) and to post and forward each email (bulk)
+CLASS_LATENCY = {INTERACTIVE: LatencyStats(), BULK: LatencyStats()}
+# Set while each shard is connected, when the bot is sharded (see shard_ready_event())
+SHARD_READY = {}
 
 # Set global variables
 class DeciConsts:             
@@ -44,7 +86,8 @@ class DeciConsts:
         `email_user`
         `email_pass`
         `COMMAND_PREFIX`
-        `bot` (Only if enter_fields is true)
+        `bot` (Only if enter_fields is true. An AutoShardedBot if `sharded` is set in deci_config)
+        `link` (Only in split mode. The ipclink.Link to the other process)
     '''
     
     def __init__(self, enter_fields = False):
@@ -59,6 +102,11 @@ class DeciConsts:
         self.email_pass = os.getenv('DC_EMAIL_PASS')
         self.bot_token = os.getenv('DISCORD_BOT')
         self.CMD_SYNTAX_ERR = 'Invalid syntax error: The correct syntax for this command is\n'
+        self._journal = None
+        self._embed_batcher = None
+        self._fetch_lock = None
+        # The link to the other process in split mode
+        self.link = None
                       
         # Discord related constants
         intents = dc.Intents.default()
@@ -66,8 +114,14 @@ class DeciConsts:
         self.COMMAND_PREFIX = '$' 
          
         if enter_fields:
-            # Initialize a Discord client
-            self.bot = commands.Bot(command_prefix=self.COMMAND_PREFIX, intents = intents)
+            # Initialize a Discord client, split over several gateway connections if sharding is on
+            discord_conf = read_config_file(self.deci_config_dir).get('discord', {})
+            if discord_conf.get('sharded', False):
+                self.bot = commands.AutoShardedBot(command_prefix=self.COMMAND_PREFIX, 
+                                                   intents = intents, 
+                                                   shard_count = discord_conf.get('shard_count'))
+            else:
+                self.bot = commands.Bot(command_prefix=self.COMMAND_PREFIX, intents = intents)
             if (self.email_user is None):
                 warn_msg = 'No email set in environment variable `DC_EMAIL_ADDR`.\n'
                 warn_msg += 'It\'s recommended that you set that EnvVar as your managing email address\n'
@@ -99,16 +153,108 @@ class DeciConsts:
         imap_client = aioimaplib.IMAP4_SSL(host=imap_host, timeout=30)
         await imap_client.wait_hello_from_server()
         await imap_client.login(self.email_user, self.email_pass)
-        await imap_client.select('INBOX')
+        response = await imap_client.select('INBOX')
+        # Kept so the UIDVALIDITY doesn't need a STATUS, which shouldn't be sent for the selected mailbox
+        imap_client.select_status = parse_mailbox_status(response.lines)
         
         return imap_client
+    
+    @property
+    def thread_index(self) -> ThreadIndex:
+        '''
+        The index between email Message-IDs and Discord messages
+        '''
+        
+        deci_config = read_config_file(self.deci_config_dir)
+        return ThreadIndex.get(deci_config['dir_paths']['thread_index_dir'])
+    
+    @property
+    def att_store(self) -> AttachmentStore:
+        '''
+        The content-addressed store that incoming email attachments are downloaded into
+        '''
+        
+        deci_config = read_config_file(self.deci_config_dir)
+        return AttachmentStore.get(deci_config['dir_paths']['em_atts_dir'], 
+                                   deci_config['dir_paths']['att_store_index_dir'], 
+                                   deci_config.get('att_store', {}))
+    
+    @property
+    def att_janitor(self) -> AttachmentJanitor:
+        '''
+        Deletes orphaned attachment files and old linked attachments, and keeps the attachment 
+        directories under their quota
+        '''
+        
+        deci_config = read_config_file(self.deci_config_dir)
+        return AttachmentJanitor.get(self.att_store, [deci_config['dir_paths']['image_cache_dir']], 
+                                     deci_config.get('att_janitor', {}), [deci_config['dir_paths']['linked_atts_dir']])
+    
+    @property
+    def image_transformer(self) -> ImageTransformer:
+        '''
+        Shrinks large images before they're uploaded to Discord or attached to an email
+        '''
+        
+        deci_config = read_config_file(self.deci_config_dir)
+        return ImageTransformer.get(deci_config['dir_paths']['image_cache_dir'], 
+                                    deci_config.get('image_transform', {}))
+    
+    @property
+    def guild_router(self) -> GuildRouter:
+        '''
+        The index of which servers' mailing lists each email address is on
+        '''
+        
+        deci_config = read_config_file(self.deci_config_dir)
+        chain_users_dir = deci_config['dir_paths']['chain_users_dir']
+        
+        def load():
+            chain_users = read_csv_set_idx(chain_users_dir)
+            return zip(chain_users['Server_ID'].values, chain_users['Email'].values)
+        
+        return GuildRouter.get(chain_users_dir, load, deci_config.get('routing', {}).get('fallback', 'all'))
+    
+    @property
+    def journal(self) -> DeliveryJournal:
+        '''
+        The delivery journal of incoming emails. Opened the first time it is used.
+        '''
+        
+        if self._journal is None:
+            deci_config = read_config_file(self.deci_config_dir)
+            max_attempts = deci_config.get('journal', {}).get('max_attempts', 3)
+            self._journal = DeliveryJournal(deci_config['dir_paths']['journal_dir'], max_attempts)
+        return self._journal
+    
+    @property
+    def embed_batcher(self) -> EmbedBatcher:
+        '''
+        Batches the embeds of emails posted in embed mode. Created the first time it is used.
+        '''
+        
+        if self._embed_batcher is None:
+            self._embed_batcher = EmbedBatcher(send_embeds)
+        return self._embed_batcher
+    
+    @property
+    def fetch_lock(self) -> asyncio.Lock:
+        '''
+        Held while new emails are fetched, so imap_loop() and fetch_new_emails() never fetch 
+        the same emails at once. Created the first time it is used.
+        '''
+        
+        if self._fetch_lock is None:
+            self._fetch_lock = asyncio.Lock()
+        return self._fetch_lock
 
 
-def log_and_print(message: str, level: str = 'info', terminal_print: bool = False) -> None:
+def log_and_print(message: str, *args, level: str = 'info', terminal_print: bool = False) -> None:
     '''
     str, str -> None
     
     Custom function for logging and printing a message. Function doesn't output anything.
+    The message is only formatted with args (`%`-style) if it is actually logged or printed.
     Possible levels:
     - debug
     - info
@@ -118,20 +264,81 @@ def log_and_print(message: str, level: str = 'info', terminal_print: bool = Fals
     '''
     
     if terminal_print:
-        print(message)
+        print(message % args if args else message)
     
     # Encode emojis differently    
     log_message = message#.encode('unicode_escape') # No longer required
     if level == 'debug':
-        log.debug(log_message)
+        log.debug(log_message, *args)
     elif level == 'info':
-        log.info(log_message)
+        log.info(log_message, *args)
     elif level == 'warning':
-        log.warning(log_message)
+        log.warning(log_message, *args)
     elif level == 'error':
-        log.error(log_message)
+        log.error(log_message, *args)
     elif level == 'critical':
-        log.critical(log_message)   
+        log.critical(log_message, *args)   
+
+class TruncatedLogValue:
+    '''
+    Wraps a (possibly very long) value so it's only converted to a string, and cut down 
+    to `max_body_log_chars`, if the log message it's passed to is actually written
+    '''
+    
+    max_chars = 2000
+    
+    def __init__(self, value):
+        self.value = value
+        
+    def __str__(self) -> str:
+        text = str(self.value)
+        if self.max_chars is None or len(text) <= self.max_chars:
+            return text
+        half = self.max_chars // 2
+        return f'{text[:half]}\n[... {len(text) - self.max_chars} characters not logged ...]\n{text[-half:]}'
+
+class _LazyQueueHandler(QueueHandler):
+    '''
+    A QueueHandler that leaves formatting to the listener thread instead of doing it 
+    on the event loop
+    '''
+    
+    def prepare(self, record: log.LogRecord) -> log.LogRecord:
+        return record
+
+def configure_logging(log_file_dir: str, log_conf: dict, log_name: str = 'deci_log') -> QueueListener:
+    '''
+    Sends all log records through a queue to a file handler running on its own thread.
+    The log file rotates at midnight and old files are deleted after `retention_days`.
+
+    Args:
+        log_file_dir (str): Directory to write the log files to
+        log_conf (dict): The `logging` section of deci_config
+        log_name (str, optional): Name of the log file, without `.log`. Defaults to 'deci_log'.
+
+    Returns:
+        QueueListener: The started listener. Stop it to flush the remaining records.
+    '''
+    
+    root_logger = log.getLogger()
+    root_logger.setLevel(log_conf.get('level', 'INFO'))
+    TruncatedLogValue.max_chars = log_conf.get('max_body_log_chars', 2000)
+    
+    log_file_path = os.path.join(log_file_dir, f'{log_name}.log')
+    handler = TimedRotatingFileHandler(log_file_path, 
+                                       when = 'midnight', 
+                                       backupCount = log_conf.get('retention_days', 30),
+                                       encoding = 'utf-8',
+                                       ) 
+    handler.setFormatter(log.Formatter('%(asctime)s [%(levelname)s]: %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler, respect_handler_level = True)
+    root_logger.addHandler(_LazyQueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
+    
+    return listener
 
 def read_config_file(config_dir: str) -> dict:
     '''
@@ -207,6 +414,38 @@ async def is_valid_html_colour(ctx, colour: str) -> bool:
         await ctx.reply(err_msg)
         return False
     
+def find_invalid_html_colours(colours: Collection[str]) -> set:
+    '''
+    Finds which of the given colours are not valid html colour codes
+    
+    All colours are validated with a single request to the validator, one per line of
+    the html document, so the errors can be mapped back to the colours that caused them.
+
+    Args:
+        colours (Collection[str]): string representations of html colour codes
+
+    Returns:
+        set: The colours that are not valid
+    '''
+    
+    colours = list(dict.fromkeys(colours))
+    invalid = {c for c in colours if re.search(r'["<>;]', c)}
+    colours = [c for c in colours if c not in invalid]
+    if colours == []:
+        return invalid
+    
+    html_lines = ['<!DOCTYPE html>', '<html lang="en-us"><head><meta charset="UTF-8"><title>test</title></head><body>']
+    first_line = len(html_lines) + 1
+    html_lines += [f'<p style="color:{c};">test</p>' for c in colours]
+    html_lines.append('</body></html>')
+    hv = HTMLValidator()
+    response_dict = hv.validate_html('\n'.join(html_lines))
+    for msg in response_dict['messages']:
+        idx = msg.get('lastLine', 0) - first_line
+        if 0 <= idx < len(colours):
+            invalid.add(colours[idx])
+    return invalid
+
 async def check_repair_config_files(dcts: DeciConsts):
     '''
     Checks for missing files and creates them if missing
@@ -218,7 +457,6 @@ async def check_repair_config_files(dcts: DeciConsts):
     # Load in required variables
     deci_config_dir = dcts.deci_config_dir
     deci_config = read_config_file(deci_config_dir)
-    imap_host = deci_config['em_srv_parms']['imap_host']
     dir_paths = deci_config['dir_paths']
     
     for k in dir_paths:
@@ -230,36 +468,94 @@ async def check_repair_config_files(dcts: DeciConsts):
             if path_dirname == '' and ('.' not in path):
                 path_dirname = path
             os.makedirs(path_dirname, exist_ok=True)
-            log_and_print(f"Directory {path_dirname} created")
+            log_and_print("Directory %s created", path_dirname)
             
-            # Set the max_uid_path
+            # Start from the current end of the inbox (or from `start_days_ago` days back)
             if k == 'max_uid_path':
-                imap_client = aioimaplib.IMAP4_SSL(host=imap_host, timeout=30)
-                await imap_client.wait_hello_from_server()
-                await imap_client.login(dcts.email_user, dcts.email_pass)
-                await imap_client.select('INBOX')
-                ID_HEADER_SET = {'Content-Type', 'From', 'To', 'Cc', 'Bcc', 'Date', 'Subject', 'Message-ID', 'In-Reply-To', 'References'}
-                FETCH_MESSAGE_DATA_UID = re.compile(rb'.*UID (?P<uid>\d+).*')
-                response = await imap_client.uid('fetch', '%d:*' % (1),
-                                     '(UID FLAGS BODY.PEEK[HEADER.FIELDS (%s)])' % ' '.join(ID_HEADER_SET))
-                for i in range(0, len(response.lines) - 1, 3):
-                    fetch_command_without_literal = b'%s %s' % (response.lines[i], response.lines[i + 2])
-                    uid = int(FETCH_MESSAGE_DATA_UID.match(fetch_command_without_literal).group('uid'))
-                    with open(path, mode='w') as f:
-                        f.write(str(uid))        
-                log_and_print(f'Created {path}')
+                imap_client = await dcts.init_imap_client()
+                try:
+                    max_uid = await discover_start_uid(imap_client, deci_config.get('fetch', {}).get('start_days_ago'))
+                    uid_validity = (await get_mailbox_status(imap_client)).get('UIDVALIDITY')
+                finally:
+                    await imap_client.logout()
+                with open(path, mode='w') as f:
+                    f.write(str(max_uid))
+                if uid_validity is not None:
+                    with open(dir_paths['uid_validity_path'], mode='w') as f:
+                        f.write(str(uid_validity))
+                log_and_print('Created %s', path)
+            elif k == 'uid_validity_path':
+                # Written along with max_uid_path. Older installs get it the next time imap_loop() starts
+                pass
+            elif k == 'journal_dir':
+                with open(path, 'w') as fp:
+                    fp.write('')
+                log_and_print('Created %s', path)
             elif k == 'deci_config_dir':
-                log_and_print(f'Check the GitHub Repo for the latest version of {path}')
-            elif k == 'guilds_dir':
+                log_and_print('Check the GitHub Repo for the latest version of %s', path)
+            elif k in ['guilds_dir', 'deferred_atts_dir', 'att_store_index_dir']:
                 with open(path, 'w') as fp:
                     fp.write('{}')
-                log_and_print(f'Created {path}')
+                log_and_print('Created %s', path)
             elif k == 'chain_users_dir':
                 df = pd.DataFrame(columns = ['Server_ID','User_ID','Name','Email','Colour'])
                 df.to_csv(path, index = False)
-                log_and_print(f'Created {path}')    
+                log_and_print('Created %s', path)    
+
+def connect_smtp(dcts: DeciConsts) -> smtplib.SMTP:
+    '''
+    Connects and logs in to the SMTP server
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot
+
+    Returns:
+        smtplib.SMTP: A logged in SMTP connection. Call quit() on it when done.
+    '''
+    
+    # Read in the necessary variables from deci_config
+    deci_config = read_config_file(dcts.deci_config_dir)
+    smtp_host = deci_config['em_srv_parms']['smtp_host']
+    smtp_port = deci_config['em_srv_parms']['smtp_port']
+    
+    # Connect to SMTP to send email
+    email_server = smtplib.SMTP(host = smtp_host, port = smtp_port)
+    email_server.ehlo()
+    email_server.starttls()
+    email_server.login(dcts.email_user, dcts.email_pass)
+    return email_server
+
+@profiled()
+def send_prepared_email(email_server: smtplib.SMTP, prepared: PreparedEmail, email_recipients: list, subject: str, 
+                        headers: dict = None, with_attachments: bool = True, prefix: str = None) -> str:
+    '''
+    Sends an email whose body and attachments have already been encoded
+
+    Args:
+        email_server (smtplib.SMTP): A logged in SMTP connection, from connect_smtp()
+        prepared (PreparedEmail): The encoded body and attachments
+        email_recipients (list): The emails of all intended recipients of the email.
+        subject (str): Subject of the email to be sent
+        headers (dict, optional): Extra headers for the email. E.g. `Message-ID`, `In-Reply-To`
+        with_attachments (bool, optional): Whether to include the attachments. Defaults to True.
+        prefix (str, optional): Html to show above the body. Defaults to None.
+
+    Returns:
+        str: A confirmation message
+    '''
+    
+    email_user = DeciConsts().email_user
+    prefix_parts = [text_part(prefix)] if prefix is not None else None
+    email_bytes = prepared.envelope(email_user, email_recipients, subject, headers, with_attachments, prefix_parts)
+    
+    # Send the email and a confirmation message
+    email_server.sendmail(email_user, email_recipients, email_bytes)
+    confirm_msg = f'Email [{subject}] successfully sent!'
+    log_and_print(confirm_msg)
+    return confirm_msg
 
-def send_email(email_recipients: list, subject: str, body: str, attachments: list = [], del_atts = True) -> str:
+@profiled()
+def send_email(email_recipients: list, subject: str, body: str, attachments: list = [], del_atts = True, headers: dict = None) -> str:
     '''
     Simple send email script
 
@@ -269,67 +565,43 @@ def send_email(email_recipients: list, subject: str, body: str, attachments: lis
         subject (str): Subject of the email to be sent
         body (str): Body of email to be sent in html format
         attachments (list): List of strings containing the file paths to the attachments
-                            to be sent
-        del_atts (bool): If true, will delete all attachments after execution
+                            to be sent, or (filename, bytes or binary file object) tuples
+        del_atts (bool): If true, will delete (or close) all attachments after execution
+        headers (dict, optional): Extra headers for the email. E.g. `Message-ID`, `In-Reply-To`
 
     Returns:
         str: A confirmation message
     '''
     
-    # Load in required variables
-    dcts = DeciConsts()
-    deci_config = read_config_file(dcts.deci_config_dir)
-    
     # Define email variables
     if subject is None:
         email_subject = body
     else: 
         email_subject = subject
-    email_body = body
-    email_msg = MIMEMultipart()
-    email_user, email_pass = dcts.email_user, dcts.email_pass
-    email_msg['From'] = email_user
-    email_recips = ', '.join(email_recipients)
-    email_msg['To'] = email_recips
-    email_msg['Subject'] = email_subject
-    email_msg.attach(MIMEText(email_body, 'html'))
-
-    # Add attachments
-    for f in attachments or []:
-        with open(f, "rb") as fil:
-            part = MIMEApplication(
-                fil.read(),
-                Name=basename(f)
-            )
-        # After the file is closed
-        part['Content-Disposition'] = 'attachment; filename="%s"' % basename(f)
-        email_msg.attach(part)
-
-    # Read in the necessary variables from deci_config
-    smtp_host = deci_config['em_srv_parms']['smtp_host']
-    smtp_port = deci_config['em_srv_parms']['smtp_port']
-    
-    # Connect to SMTP to send email
-    email_server = smtplib.SMTP(host = smtp_host, port = smtp_port)
-    email_server.ehlo()
-    email_server.starttls()
-    email_server.login(email_user, email_pass)
-    
-    # Send the email and a confirmation message
-    email_server.sendmail(email_user, email_recipients, email_msg.as_string())
-    confirm_msg = f'Email [{email_subject}] successfully sent!'
-    log_and_print(confirm_msg)
-    email_server.quit()
+    prepared = PreparedEmail(body, attachments)
     
-    # Remove each attachment now that we don't need them anymore
-    if del_atts:
-        for i in attachments:
-            os.remove(i)   
-            log_and_print(f'Removed file: {i}')
+    # Send the email
+    try:
+        email_server = connect_smtp(DeciConsts())
+        try:
+            confirm_msg = send_prepared_email(email_server, prepared, list(email_recipients), email_subject, headers)
+        finally:
+            email_server.quit()
+    finally:
+        # Remove each attachment now that we don't need them anymore, even if sending failed
+        if del_atts:
+            for i in attachments:
+                if isinstance(i, tuple):
+                    if hasattr(i[1], 'close'):
+                        i[1].close()
+                    continue
+                if os.path.exists(i):
+                    os.remove(i)   
+                    log_and_print('Removed file: %s', i)
         
     return confirm_msg
 
-def send_disc_msg_as_email(ctx, dcts: DeciConsts, subject: str, body: str, attachments: list) -> str:
+def send_disc_msg_as_email(ctx, dcts: DeciConsts, subject: str, body: str, attachments: list, headers: dict = None) -> str:
     '''
     Simple send email script
 
@@ -340,6 +612,7 @@ def send_disc_msg_as_email(ctx, dcts: DeciConsts, subject: str, body: str, attac
         body (str): Body of email to be sent in html format
         attachments (list): List of strings containing the file paths to the attachments
                             to be sent
+        headers (dict, optional): Extra headers for the email. E.g. `Message-ID`, `In-Reply-To`
 
     Returns:
         str: A confirmation message
@@ -352,13 +625,198 @@ def send_disc_msg_as_email(ctx, dcts: DeciConsts, subject: str, body: str, attac
     email_recipients = chain_usrs.loc[chain_usrs['Server_ID'] == srv_id, 'Email'].values
     
     # Send the email
-    confirm_msg = send_email(email_recipients, subject, body, attachments)
+    confirm_msg = send_email(email_recipients, subject, body, attachments, headers = headers)
         
     return confirm_msg
 
-async def send_email_as_disc_msg(dcts: DeciConsts, subject: str, sender: str, email_msg: str, att_paths: list):
+async def download_disc_attachments(attachments: list, att_policy: dict) -> tuple:
+    '''
+    Downloads the attachments of a Discord message all at once, into temporary files that 
+    stay in memory unless they're large
+    
+    Attachments are taken in order until the message's total would go over `outgoing_max_bytes`.
+    The rest are linked to instead of attached.
+
+    Args:
+        attachments (list): The discord.Attachments of the message
+        att_policy (dict): The `att_policy` section of deci_config
+
+    Returns:
+        tuple: ((filename, file object) tuples for send_email(), html links to the attachments that 
+               were too large)
+    '''
+    
+    max_bytes = att_policy.get('outgoing_max_bytes', 18 * 1024 * 1024)
+    spool_bytes = att_policy.get('outgoing_spool_bytes', 1024 * 1024)
+    
+    to_download = []
+    links = []
+    total = 0
+    for i in attachments:
+        if total + i.size <= max_bytes:
+            to_download.append(i)
+            total += i.size
+        else:
+            links.append(f'[attachment: <a href="{i.url}">{i.filename}</a> ({format_size(i.size)})]')
+            log_and_print('Linked oversized attachment: %s', i.filename)
+    
+    async def download(att):
+        fp = tempfile.SpooledTemporaryFile(max_size = spool_bytes)
+        try:
+            await att.save(fp)
+        except BaseException:
+            fp.close()
+            raise
+        log_and_print('Downloaded %s', att.filename)
+        return att.filename, fp
+    
+    results = await asyncio.gather(*[download(i) for i in to_download], return_exceptions = True)
+    files = [r for r in results if not isinstance(r, BaseException)]
+    for r in results:
+        if isinstance(r, BaseException):
+            for _, fp in files:
+                fp.close()
+            raise r
+    return files, links
+
+def shard_ready_event(shard_id: int, connected: bool = True) -> asyncio.Event:
+    '''
+    Returns the event that is set while shard_id is connected, creating it the first time 
+    as set if connected is true
+    '''
+    
+    if shard_id not in SHARD_READY:
+        SHARD_READY[shard_id] = asyncio.Event()
+        if connected:
+            SHARD_READY[shard_id].set()
+    return SHARD_READY[shard_id]
+
+async def get_guild_channel(bot: commands.Bot, guild_id: int, channel_id: int, timeout: float = 10):
+    '''
+    Looks up a channel in the bot's cache, once the bot is ready
+    
+    If the bot is sharded and the shard that handles the channel's server is disconnected, 
+    first waits up to timeout seconds for the shard to be ready again, since the server's 
+    channels aren't up to date until then. Every delivery to that server waits on the 
+    same event, and all of them go ahead as soon as the shard is back.
+
+    Args:
+        bot (commands.Bot): The Discord client
+        guild_id (int): ID of the server the channel belongs to
+        channel_id (int): ID of the channel
+        timeout (float, optional): Seconds to wait for a disconnected shard. Defaults to 10.
+
+    Returns:
+        discord.TextChannel: The channel, or None if it couldn't be found or its shard 
+                             didn't come back in time
+    '''
+    
+    await bot.wait_until_ready()
+    if not isinstance(bot, commands.AutoShardedBot):
+        return bot.get_channel(channel_id)
+    
+    # A guild's events are handled by shard (guild_id >> 22) % shard_count
+    shard_id = (guild_id >> 22) % bot.shard_count
+    shard = bot.get_shard(shard_id)
+    if shard is not None:
+        ready = shard_ready_event(shard_id, not shard.is_closed())
+        if not ready.is_set():
+            log_and_print('Waiting for shard %s to reconnect', shard_id, level='warning')
+            try:
+                await asyncio.wait_for(ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                log_and_print('Shard %s did not reconnect within %s s', shard_id, timeout, level='warning')
+                return None
+    guild = bot.get_guild(guild_id)
+    if guild is None:
+        return bot.get_channel(channel_id)
+    return guild.get_channel(channel_id)
+
+async def send_bulk(channel: dc.TextChannel, *args, **kwargs) -> dc.Message:
+    '''
+    Sends a message in channel as bulk work, behind any command replies waiting for a Discord call slot. 
+    Takes the same arguments as channel.send().
+    '''
+    
+    async with DISCORD_CALLS.slot(BULK):
+        return await channel.send(*args, **kwargs)
+
+async def send_embeds(channel: dc.TextChannel, embeds: list, reference: dc.MessageReference = None) -> dc.Message:
+    '''
+    Posts up to 10 embeds in one Discord message
+
+    Args:
+        channel (dc.TextChannel): The channel to post in
+        embeds (list): The dc.Embeds
+        reference (dc.MessageReference, optional): The message to reply to. Defaults to None.
+
+    Returns:
+        dc.Message: The message posted
+    '''
+    
+    if len(embeds) == 1:
+        return await send_bulk(channel, embed = embeds[0], reference = reference)
+    
+    # channel.send() only takes one embed in this version of discord.py, so post the message directly
+    payload = {'embeds': [e.to_dict() for e in embeds]}
+    if reference is not None:
+        payload['message_reference'] = reference.to_dict()
+    route = Route('POST', '/channels/{channel_id}/messages', channel_id = channel.id)
+    async with DISCORD_CALLS.slot(BULK):
+        data = await channel._state.http.request(route, json = payload)
+    return channel._state.create_message(channel = channel, data = data)
+
+def build_email_embed(sender: str, subject: str, email_msg: str, colour: str = None, excerpt_length: int = 1000) -> tuple:
+    '''
+    Formats an email as a Discord embed
+
+    Args:
+        sender (str): The sender of the email
+        subject (str): The subject of the email
+        email_msg (str): The body of the email, as markdown
+        colour (str, optional): The sender's html colour from the mailing list. Defaults to None.
+        excerpt_length (int, optional): Most characters of the body to show. Defaults to 1000.
+
+    Returns:
+        tuple: (The embed, whether the body had to be cut short)
+    '''
+    
+    email_msg = email_msg.strip()
+    truncated = len(email_msg) > excerpt_length
+    if truncated:
+        email_msg = email_msg[:max(excerpt_length - 1, 0)].rstrip() + '…'
+    embed = dc.Embed(title = (subject or '(no subject)')[:256], description = email_msg)
+    embed.set_author(name = sender[:256])
+    colour_value = html_colour_value(colour)
+    if colour_value is not None:
+        embed.colour = dc.Colour(colour_value)
+    return embed, truncated
+
+def sender_colour(chain_users: pd.DataFrame, guild_id: int, sender_email: str) -> str:
+    '''
+    Returns the html colour of sender_email on the mailing list of guild_id, or None if they're not on it
+    '''
+    
+    rows = chain_users[(chain_users['Server_ID'].astype(str) == str(guild_id))
+                       & (chain_users['Email'].astype(str).str.strip().str.lower() == sender_email.strip().lower())]
+    if rows.empty:
+        return None
+    return rows['Colour'].iloc[0]
+
+@profiled()
+async def send_email_as_disc_msg(dcts: DeciConsts, subject: str, sender: str, email_msg: str, att_paths: list, del_atts = True, 
+                                 message_id: str = None, in_reply_to: str = None, references: str = None, guild_ids: list = None, 
+                                 progress: dict = None):
     '''
     Sends an email message as a Discord message
+    
+    If `render_mode` is `embed` in the `discord` section of deci_config, the email is posted 
+    as an embed in the sender's colour instead. Emails bound for the same channel within 
+    `embed_batch_window` seconds of each other share a message (see embedbatch), and the 
+    attachments of each email are posted together in as few messages as the upload limit allows.
+    
+    A server whose channel can't be found (deleted, or hidden from the bot) is skipped with an 
+    error in the log, since retrying wouldn't help.
 
     Args:
         dcts (DeciConsts): Class containing global variables for the bot
@@ -368,15 +826,24 @@ async def send_email_as_disc_msg(dcts: DeciConsts, subject: str, sender: str, em
         att_paths (list):   A list of all attachments contained in the email. 
                             Stored as a list of strs representing the filepaths
                             to the attachments.
+        del_atts (bool): If true, will delete all attachments after execution
+        message_id (str, optional): The Message-ID of the email
+        in_reply_to (str, optional): The In-Reply-To header of the email
+        references (str, optional): The References header of the email
+        guild_ids (list, optional): The servers to post the email in. Defaults to every server 
+                                    whose mailing list the sender is on.
+        progress (dict, optional): The number of messages already sent in each server, by server ID.
+                                   Updated after every message, so a failed post can be resumed 
+                                   without sending those messages again. Defaults to None.
     '''
     
     # Read in the necessary variables from deci_config
     bot = dcts.bot
+    thread_index = dcts.thread_index
     deci_config = read_config_file(dcts.deci_config_dir)
+    discord_conf = deci_config.get('discord', {})
     guilds_dir = deci_config['dir_paths']['guilds_dir']
-    chain_users_dir = deci_config['dir_paths']['chain_users_dir']
     guilds_conf = read_config_file(guilds_dir)
-    chain_users = read_csv_set_idx(chain_users_dir)
     
     # Extract the sender's email address
     try:
@@ -384,12 +851,10 @@ async def send_email_as_disc_msg(dcts: DeciConsts, subject: str, sender: str, em
     except:
         sender_email = sender
     
-    # Send the email to all servers that the sender is listed in
-    chain_users = chain_users[chain_users['Email'] == sender_email]
-    guild_ids = chain_users['Server_ID'].values
-    channels = []
-    for i in guild_ids:
-        channels.append(guilds_conf[str(i)]['email_channel'])
+    # Send the email to the given servers, or all servers that the sender is listed in
+    if guild_ids is None:
+        guild_ids = dcts.guild_router.guilds_of(sender_email)
+    guild_ids = [g for g in guild_ids if guilds_conf.get(str(g), {}).get('email_channel') is not None]
             
     # # Modify replying subject string
     # re_subj = 'Re: '
@@ -397,344 +862,1445 @@ async def send_email_as_disc_msg(dcts: DeciConsts, subject: str, sender: str, em
     #     while re_subj in subject:
     #         subject = subject[4:]
     #     subject = re_subj + subject
-            
-    # Set server
-    guild = guild_ids[0]
         
     # Edit the subject line
-    guilds_conf[str(guild)]['currentSubject'] = subject     
+    for g in guild_ids:
+        guilds_conf[str(g)]['currentSubject'] = subject     
     update_config_file(guilds_dir, guilds_conf)
         
-    # Theoretically, this loop allows the bot to send an email to multiple channels
-    # But I've restricted it to only 1 channel when called from other functions in this .py file
-    for ch in channels:
-        channel = bot.get_channel(int(ch))
-        
-        # Format message for Discord
-        if email_msg[-1] == '\n':
-            email_msg = email_msg[:-1]
-        email_msg = email_msg.replace('\n', '\n> ')
-        disc_msg = f'New message from _{sender}_:\n'
-        disc_msg += f'**Subject: {subject}**\n'
-        disc_msg += f'> {email_msg}'
-        
-        # Send body text as Discord message
-        await channel.send(disc_msg)  
-        
-        # Send attachments one by one, then remove them
-        att_paths_len = len(att_paths)
-        if att_paths_len != 0:   
-            for i in att_paths: 
-                with open(i, mode='rb') as f:
-                    await channel.send(f'[image: {i}]', file = dc.File(f)) 
-                os.remove(i)   
-                log_and_print(f'Removed file: {i}')
-
-async def fetch_email_messages(dcts: DeciConsts, imap_client: aioimaplib.IMAP4_SSL, max_uid: int) -> int:
-    '''
-    Fetches new email messages and calls sendEmailAsDiscordMsg() if the email was sent by
-    someone on the mailing list.
+    # Find the Discord message that this email replies to in each server, if there is one
+    parents = {p[0]: p for p in thread_index.find_discord_parent(in_reply_to, references)}
     
-    Args:
-        dcts (DeciConsts): Class containing global variables for the bot.
-        imap_client (IMAP4_SSL): Object representing an imap instance 
-                                 for listening to incoming emails.
-        max_uid (int): The max uid of all emails in the current inbox.
+    embed_mode = discord_conf.get('render_mode', 'text') == 'embed'
+    if embed_mode:
+        chain_users = read_csv_set_idx(deci_config['dir_paths']['chain_users_dir'])
+        body_md = email_msg
+    
+    # Format message for Discord
+    if email_msg[-1:] == '\n':
+        email_msg = email_msg[:-1]
+    email_msg = email_msg.replace('\n', '\n> ')
+    disc_msg = f'New message from _{sender}_:\n'
+    disc_msg += f'**Subject: {subject}**\n'
+    disc_msg += f'> {email_msg}'
+    chunks = chunk_message(disc_msg, discord_conf.get('max_message_length', DISCORD_MESSAGE_LIMIT))
+        
+    if progress is None:
+        progress = {}
+        
+    async def post(g):
+        channel = await get_guild_channel(bot, int(g), int(guilds_conf[str(g)]['email_channel']))
+        if channel is None:
+            log_and_print('Could not find the email channel of server %s, not posting email %s there', 
+                          g, message_id, level='error')
+            return
+        
+        # Send body text as Discord message, as a reply if the email is part of a known thread
+        reference = None
+        parent = parents.get(int(g))
+        if parent is not None and parent[1] == channel.id:
+            reference = dc.MessageReference(message_id = parent[2], channel_id = parent[1], guild_id = parent[0], fail_if_not_exists = False)
+        
+        # Messages sent by an earlier attempt are skipped
+        already_sent = progress.get(int(g), 0)
+        step = 0
+        async def send_step(send, *args, **kwargs):
+            nonlocal step
+            step += 1
+            if step <= already_sent:
+                return None
+            sent_msg = await send(*args, **kwargs)
+            progress[int(g)] = step
+            return sent_msg
+        
+        if embed_mode:
+            await post_embed(g, channel, reference, send_step)
+            return
         
+        # Split messages that are too long for Discord, or attach them as a file if there'd be too many chunks
+        if len(chunks) > discord_conf.get('max_chunks', 5):
+            header = f'New message from _{sender}_:\n**Subject: {subject}**\n'
+            header += f'_This email is too long to post here, the full message is attached._'
+            md_file = dc.File(io.BytesIO(disc_msg.encode('utf-8')), filename = 'email.md')
+            sent_msg = await send_step(send_bulk, channel, header, file = md_file, reference = reference)
+            chunks_left = []
+        else:
+            sent_msg = await send_step(send_bulk, channel, chunks[0], reference = reference)  
+            chunks_left = chunks[1:]
+        # The thread index already has the first message if an earlier attempt sent it
+        if sent_msg is not None:
+            thread_index.add(message_id, int(g), channel.id, sent_msg.id, references, subject)
+        for chunk in chunks_left:
+            await send_step(send_bulk, channel, chunk)
+        
+        # Send attachments one by one
+        for i in att_paths: 
+            await send_step(send_file, channel, i)
+    
+    async def post_embed(g, channel, reference, send_step):
+        embed, truncated = build_email_embed(sender, subject, body_md, sender_colour(chain_users, g, sender_email), 
+                                             discord_conf.get('embed_excerpt_length', 1000))
+        sent_msg = await send_step(dcts.embed_batcher.submit, channel, embed, discord_conf.get('embed_batch_window', 2.0), reference)
+        if sent_msg is not None:
+            thread_index.add(message_id, int(g), channel.id, sent_msg.id, references, subject)
+        
+        # Post the full email if the embed only has an excerpt, then the attachments, as few messages as possible
+        files = [('email.md', lambda: io.BytesIO(disc_msg.encode('utf-8')), len(disc_msg.encode('utf-8')))] if truncated else []
+        files += [(os.path.basename(i), partial(open, i, 'rb'), os.path.getsize(i)) for i in att_paths]
+        upload_limit = get_upload_limit(dcts, [g])
+        group, group_size = [], 0
+        for name, opener, size in files + [(None, None, 0)]:
+            if group and (name is None or len(group) >= MAX_EMBEDS or group_size + size > upload_limit):
+                await send_step(send_group, channel, group)
+                group, group_size = [], 0
+            if name is not None:
+                group.append((name, opener))
+                group_size += size
+    
+    async def send_file(channel, path):
+        with open(path, mode='rb') as f:
+            await send_bulk(channel, f'[image: {path}]', file = dc.File(f)) 
+    
+    async def send_group(channel, group):
+        # The files are only opened if the group is actually sent
+        await send_bulk(channel, f'Attachments of **{subject}**', files = [dc.File(o(), filename = n) for n, o in group])
+    
+    # Post to every server at once
+    results = await asyncio.gather(*[post(g) for g in guild_ids], return_exceptions = True)
+    
+    # Remove the attachments once every server has them
+    if del_atts:
+        for i in att_paths:
+            os.remove(i)   
+            log_and_print('Removed file: %s', i)
+    for r in results:
+        if isinstance(r, BaseException):
+            raise r
+
+def get_upload_limit(dcts: DeciConsts, guild_ids: Collection[int]) -> int:
+    '''
+    Finds the largest file that can be uploaded to every one of the given servers
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot
+        guild_ids (Collection[int]): IDs of the servers the file will be sent to
+
     Returns:
-        The new max_uid (int)
+        int: The upload limit in bytes
     '''
     
-    # The code block that fetches emails. I don't understand this but it works
-    ID_HEADER_SET = {'Content-Type', 'From', 'To', 'Cc', 'Bcc', 'Date', 'Subject', 'Message-ID', 'In-Reply-To', 'References'}
-    FETCH_MESSAGE_DATA_UID = re.compile(rb'.*UID (?P<uid>\d+).*')
-
-    response = await imap_client.uid('fetch', '%d:*' % (max_uid + 1),
-                                     '(UID FLAGS BODY.PEEK[HEADER.FIELDS (%s)])' % ' '.join(ID_HEADER_SET))
-    new_max_uid = max_uid
+    deci_config = read_config_file(dcts.deci_config_dir)
+    upload_limit = deci_config.get('att_policy', {}).get('default_upload_limit', 8 * 1024 * 1024)
+    limits = []
+    for i in guild_ids:
+        guild = dcts.bot.get_guild(int(i)) if hasattr(dcts, 'bot') else None
+        if guild is not None:
+            limits.append(guild.filesize_limit)
+    if limits:
+        upload_limit = min(limits)
+    return upload_limit
+
+def format_size(size: int) -> str:
+    '''
+    Formats a number of bytes as a human readable string. E.g. `25.3 MB`
+    '''
     
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return f'{size:.1f} {unit}' if unit != 'B' else f'{size} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+async def handle_oversized_attachment(imap_client: aioimaplib.IMAP4_SSL, uid: int, part: BodyPart, filename: str, deci_config: dict, 
+                                      srv_ids: list = None, local_path: str = None) -> str:
+    '''
+    Applies the `oversize_action` of the attachment policy to an attachment that is too 
+    large to upload to Discord
     
-    if response.result == 'OK':
-        for i in range(0, len(response.lines) - 1, 3):
-            fetch_command_without_literal = b'%s %s' % (response.lines[i], response.lines[i + 2])
+    Possible actions:
+    - skip: The attachment is not downloaded
+    - link: The attachment is streamed into `linked_atts_dir` and a link to it is posted. 
+            The attachment janitor deletes linked files after `linked_max_age_days`.
+    - defer: The attachment is recorded so it can be emailed later with `get_attachment`, 
+             to members of the servers the email was delivered to.
+             Emails replayed from a local mailbox can't be fetched later, so they're skipped instead.
 
-            # Define variables for important email parameters
-            uid = int(FETCH_MESSAGE_DATA_UID.match(fetch_command_without_literal).group('uid'))
-            
-            # Read in the necessary variables from deci_config
-            deci_config = read_config_file(dcts.deci_config_dir)
-            max_uid_path = deci_config['dir_paths']['max_uid_path']
-            with open(max_uid_path, mode='w') as f:
-                f.write(str(uid))
-                
-            # uid fetch always includes the UID of the last message in the mailbox
-            # cf https://tools.ietf.org/html/rfc3501#page-61
-            if uid > max_uid:
-                message_headers = BytesHeaderParser().parsebytes(response.lines[i + 1])
-                email_from = message_headers.get('from')
-                
-                # Check if sender is in mailing list
-                start = email_from.find('<') + 1
-                end = email_from.find('>')
-                from_email_addr = email_from[start:end]
-                chain_usrs = read_csv_set_idx(deci_config['dir_paths']['chain_users_dir'])
-                email_recipients = chain_usrs['Email']
-                
-                # If not, return with the current uid
-                if (from_email_addr not in email_recipients.values):
-                    log_and_print(f'Email received from an address that\'s not on the mailing list: {from_email_addr}')
-                    return uid
-                
-                # Begin parsing the email's contents
-                log_and_print(f'Incoming email headers:\n{message_headers}')
-                dwnld_resp = await imap_client.uid('fetch', str(uid), 'BODY.PEEK[]')
-                thread_msg = BytesParser().parsebytes(dwnld_resp.lines[1])
-                email_timestamp = parser.parse(thread_msg.get('Date'))
-                html_email = False
-                email_msg = thread_msg
-                
-                # Try to retrieve the HTML representation of the email
-                while email_msg.is_multipart():
-                    if len(email_msg.get_payload()) == 2:
-                        if 'html' in email_msg.get_payload(1).get('Content-Type'):
-                            email_msg = email_msg.get_payload(1)
-                        else:
-                            email_msg = email_msg.get_payload(0)     
-                    else:
-                        email_msg = email_msg.get_payload(0) 
-                        
-                if 'html' in email_msg.get('Content-Type'):
-                    html_email = True                                                     
-
-                # Extract message body
-                msg_body = email_msg
-                email_seen = False 
-                while type(msg_body) != str:
-                    if type(msg_body) == list:
-                        msg_body = msg_body[0]
-                        continue
-                    
-                    # I think this filters out emails that were "just opened by a person on Outlook/GMail"
-                    elif not(msg_body.is_multipart()) and ('Content-Transfer-Encoding' in msg_body.keys()) and (msg_body.get('Content-Transfer-Encoding') != 'quoted-printable'):
-                        email_seen = True
-                        ''' Legacy Code
-                        # msg_body = msg_body.get_payload(decode = True)
-                        # msg_body = msg_body.decode('utf-8')
-                        # msg_body = BeautifulSoup(msg_body, 'html.parser')
-                        # msg_body = msg_body.text
-                        '''
-                        break
-                    msg_body = msg_body.get_payload()
-                    
-                if not(email_seen):
-                    # If html is found, then convert to markdown
-                    if html_email:
-                        x = msg_body.replace('=\r\n', '')
-                        x = x.replace('\r\n', '')
-                        x = x.replace('</div>', '</div><br />')
-                        x = x.replace('<br />', '\n')
-                        x = x.replace('<br>', '\n')
-                        x = x.replace('<u>', '__')
-                        x = x.replace('</u>', '__')
-                        
-                        # Parse image tags
-                        img_tag = '<img'
-                        while img_tag in x:
-                            open_ab = x.find(img_tag)
-                            start = x.find('alt=3D"', open_ab) + 7
-                            end = x.find('"', start )
-                            close_ab = x.find('>', end) + 1
-                            x = x.replace(x[open_ab:close_ab], f'{[x[start:end]]}')
-                            
-                        msg_body = markdownify(x, convert = ['li', 'ol', 'ul', 'b', 'i', 'img'])
-                        msg_body = msg_body.replace('\\_\\_', '__')
-                        
-                        # Remove redundant newlines
-                        while msg_body[-3:] == '  \n':
-                            msg_body = msg_body[:-3]
-                        while msg_body[-1] == '\n':
-                            msg_body = msg_body[:-1]
-                        while msg_body[0] == '\n':
-                            msg_body = msg_body[1:]
-                    
-                    # Remove read threads # Disabled since it doesn't work as intended
-                    # email_thread_line_break = '\r\n\r\n\r\nOn '
-                    # email_thread_line_break2 = ']\r\n\r\nOn '      
-                    email_thread_line_break3 = '\n\nGet Outlook for Android'   
-                    # email_thread_line_break4 = '\n\nOn '                     
-                    # if email_thread_line_break2 in msg_body:
-                    #     idx = msg_body.find(email_thread_line_break2)+1
-                    #     msg_body = msg_body[:idx]
-                    # elif email_thread_line_break in msg_body:
-                    #     idx = msg_body.find(email_thread_line_break)
-                    #     msg_body = msg_body[:idx]
-                    # elif email_thread_line_break3 in msg_body:
-                    if email_thread_line_break3 in msg_body:
-                        idx = msg_body.find(email_thread_line_break3)
-                        msg_body = msg_body[:idx]
-                    # elif email_thread_line_break4 in msg_body:
-                    #     idx = msg_body.find(email_thread_line_break4)
-                    #     msg_body = msg_body[:idx]
-                    log_and_print(f'Email Body:\n{msg_body}\n')
-                    
-                    # Extract attachments
-                    last_msg = thread_msg.get_payload(-1)
-                    if 'image' in last_msg.get_content_type():
-                        last_msg_is_image = True
-                    else:
-                        last_msg_is_image = False
-                    att_paths = []
-                    for part in thread_msg.walk():
-                        if part.get_content_maintype() == 'multipart':
-                            continue
-                        if part.get('Content-Disposition') is None:
-                            continue
-
-                        filename = part.get_filename()
-                        em_atts_dir = deci_config['dir_paths']['em_atts_dir']
-                        att_path = os.path.join(em_atts_dir, filename)
-                        try: 
-                            part_cont_dis = part.get('Content-Disposition')
-                            
-                            try:
-                                idx = part_cont_dis.find('creation-date="')
-                                start = part_cont_dis.find('"', idx) + 1
-                                end = part_cont_dis.find('"', start)
-                                part_timestamp = parser.parse(part_cont_dis[start:end])
-                                outlook_atts_cond = abs(part_timestamp - email_timestamp) <= timedelta(seconds = 60)
-                            except:
-                                outlook_atts_cond = False
-                                
-                            gmail_atts_cond = filename in msg_body or part.get_content_maintype() == 'video'
-                            if outlook_atts_cond or gmail_atts_cond or last_msg_is_image:
-                                with open(att_path, 'wb') as fp:
-                                    fp.write(part.get_payload(decode=True))
-                                att_paths.append(att_path)
-                                log_and_print('Downloaded file:', filename)
-                        except:
-                            pass
-                    if len(att_paths) == 2: 
-                        att_paths = att_paths[::-1]    
-                                 
-                    # Set the subject                                                         
-                    subject = message_headers.get('subject')      
-                    
-                    # If sender is in more than one server, send an error message
-                    try:
-                        sender_email = email_from[email_from.find("<")+1:email_from.find(">")]
-                    except:
-                        sender_email = email_from
-                    sender_df = chain_usrs[chain_usrs['Email'] == sender_email]
-                    sender_srvs = pd.unique(sender_df["Server_ID"].values)
-                    sender_srvs_count = len(sender_srvs)                   
-                    if sender_srvs_count > 1:
-                        err_msg = 'Error: You\'re in more than 1 server mailing list.\n'
-                        err_msg += 'Please remove yourself from all but one server\'s mailing list\n'
-                        err_msg += 'or contact the bot admin.'
-                        send_email(email_recipients = [email_from], subject = f'Re: {subject}', body = err_msg)
-                    
-                    # Forward email to all other emails in server mailing list and to the Discord server
-                    else:
-                        srv_id = sender_srvs[0]
-                        email_recipients = chain_usrs.loc[chain_usrs['Server_ID'] == srv_id, 'Email'].values
-                        email_recipients = list(set(email_recipients) - set([sender_email]))
-                        # Forward emails if there are recipients
-                        if email_recipients != []:
-                            send_email(email_recipients = email_recipients, subject = f'Fw: {subject}', body = msg_body, attachments = att_paths, del_atts = False)
-                            send_email(email_recipients = [sender_email], subject = f'Fw: {subject}', body = 'Email successfully forwarded!\n' + msg_body)
-                        await send_email_as_disc_msg(dcts, subject, email_from, msg_body, att_paths)
-
-                # Set the new max uid
-                new_max_uid = uid
-    else:
-        log_and_print('error %s' % response)
-    return new_max_uid
+    Args:
+        imap_client (IMAP4_SSL): Object representing an imap instance
+        uid (int): The uid of the email containing the attachment
+        part (BodyPart): The attachment part of the email
+        filename (str): The attachment's filename
+        deci_config (dict): Contains the configuration parameters for the bot
+        srv_ids (list, optional): The servers the email is delivered to. Defaults to None.
+        local_path (str, optional): The attachment, if it has already been downloaded. Defaults to None.
 
-async def handle_server_push(push_messages: Collection[str]) -> None: 
-    for msg in push_messages:
-        if msg.endswith(b'EXISTS'):
-            log_and_print('new email: %s' % msg) # could fetch only the message instead of max_uuid:* in the loop
-        elif msg.endswith(b'EXPUNGE'):
-            log_and_print('email removed: %s' % msg)
-        elif b'FETCH' in msg and b'\Seen' in msg:
-            log_and_print('email seen %s' % msg)
+    Returns:
+        str: A note to add to the email body in place of the attachment
+    '''
+    
+    att_policy = deci_config.get('att_policy', {})
+    action = att_policy.get('oversize_action', 'skip')
+    size_str = format_size(decoded_size(part))
+    link_base_url = att_policy.get('link_base_url')
+    
+    if action == 'link' and link_base_url:
+        linked_atts_dir = deci_config['dir_paths']['linked_atts_dir']
+        # The filename comes from the email, so keep it from pointing anywhere but linked_atts_dir
+        safe_name = os.path.basename(filename.replace('\\', '/')) or 'attachment'
+        link_name = f'{uid}_{part.section}_{safe_name}'
+        if local_path is not None:
+            shutil.copyfile(local_path, os.path.join(linked_atts_dir, link_name))
         else:
-            log_and_print('unprocessed push email : %s' % msg)
+            with open(os.path.join(linked_atts_dir, link_name), 'wb') as fp:
+                await stream_section(imap_client, uid, part, fp, att_policy.get('chunk_size', 1 << 20))
+        log_and_print('Linked oversized attachment: %s', link_name)
+        return f'[attachment: {filename} ({size_str}) {link_base_url.rstrip("/")}/{quote(link_name)}]'
+    elif action in ['link', 'defer'] and not getattr(imap_client, 'is_local', False):
+        deferred_atts_dir = deci_config['dir_paths']['deferred_atts_dir']
+        deferred_atts = read_config_file(deferred_atts_dir)
+        att_id = f'{uid}.{part.section}'
+        deferred_atts[att_id] = {
+            'uid': uid,
+            'section': part.section,
+            'encoding': part.encoding,
+            'size': part.size,
+            'filename': filename,
+            'srv_ids': [int(i) for i in srv_ids or []]
+        }
+        update_config_file(deferred_atts_dir, deferred_atts)
+        log_and_print('Deferred oversized attachment: %s (%s)', att_id, filename)
+        return f'[attachment deferred: {filename} ({size_str}). Use `$get_attachment {att_id}` to have it emailed to you]'
+    else:
+        log_and_print('Skipped oversized attachment: %s', filename)
+        return f'[attachment skipped: {filename} ({size_str}) is too large to upload]'
 
-async def imap_loop(dcts: DeciConsts, 
-                    # host: str, 
-                    # user: str, 
+async def fetch_email_body(imap_client: aioimaplib.IMAP4_SSL, uid: int, fetch_conf: dict = None) -> tuple:
+    '''
+    Downloads the structure of an email and the part holding its body (the html one if there is one)
+    
+    The body is parsed as it arrives, `body_chunk_size` octets at a time, so the raw part is 
+    never held in memory next to the parsed one. Only the first `max_body_bytes` octets of 
+    the body are downloaded. Attachments aren't downloaded here, they're streamed to disk 
+    by fetch_email_attachments().
+
+    Args:
+        imap_client (IMAP4_SSL): Object representing an imap instance 
+        uid (int): The uid of the email
+        fetch_conf (dict, optional): The `fetch` section of deci_config. Defaults to None.
+
+    Returns:
+        tuple: (The BODYSTRUCTURE as a BodyPart, the body part as an email.message.Message).
+               None if the structure couldn't be read.
+    '''
+    
+    # Fetch the structure of the email first so only the parts we need are downloaded
+    bs_resp = await imap_client.uid('fetch', str(uid), '(BODYSTRUCTURE)')
+    body_struct = parse_bodystructure(bs_resp.lines)
+    if body_struct is None:
+        log_and_print('Could not read the BODYSTRUCTURE of email %s', uid, level='error')
+        return None
+    
+    # Download the HTML representation of the email if there is one
+    body_part = select_body_part(body_struct)
+    mime_section = 'HEADER' if body_part is body_struct else f'{body_part.section}.MIME'
+    fetch_conf = fetch_conf or {}
+    max_bytes = fetch_conf.get('max_body_bytes')
+    if max_bytes is not None and body_part.size > max_bytes:
+        log_and_print('The body of email %s is %s, only the first %s are kept', uid, format_size(body_part.size), 
+                      format_size(max_bytes), level='warning')
+    parser = BytesFeedParser()
+    parser.feed(await fetch_section(imap_client, uid, mime_section))
+    await feed_section(imap_client, uid, body_part, parser, fetch_conf.get('body_chunk_size', 1 << 18), max_bytes)
+    return body_struct, parser.close()
+
+def convert_email_body(email_msg) -> str:
+    '''
+    Converts the body of an email to Discord markdown and removes any quoted history
+
+    Args:
+        email_msg (email.message.Message): The body part, from fetch_email_body()
+
+    Returns:
+        str: The converted body. None if the email shouldn't be delivered.
+    '''
+    
+    html_email = False
+    if 'html' in email_msg.get('Content-Type'):
+        html_email = True                                                     
+
+    # Extract message body
+    msg_body = email_msg
+    email_seen = False 
+    while type(msg_body) != str:
+        if type(msg_body) == list:
+            msg_body = msg_body[0]
+            continue
+        
+        # I think this filters out emails that were "just opened by a person on Outlook/GMail"
+        elif not(msg_body.is_multipart()) and ('Content-Transfer-Encoding' in msg_body.keys()) and (msg_body.get('Content-Transfer-Encoding') != 'quoted-printable'):
+            email_seen = True
+            ''' Legacy Code
+            # msg_body = msg_body.get_payload(decode = True)
+            # msg_body = msg_body.decode('utf-8')
+            # msg_body = BeautifulSoup(msg_body, 'html.parser')
+            # msg_body = msg_body.text
+            '''
+            break
+        msg_body = msg_body.get_payload()
+        
+    if email_seen:
+        return None
+    
+    # If html is found, then convert to markdown
+    if html_email:
+        x = msg_body.replace('=\r\n', '')
+        x = x.replace('\r\n', '')
+        x = strip_quoted_html(x)
+        x = x.replace('</div>', '</div><br />')
+        x = x.replace('<br />', '\n')
+        x = x.replace('<br>', '\n')
+        x = x.replace('<u>', '__')
+        x = x.replace('</u>', '__')
+        
+        # Parse image tags
+        img_tag = '<img'
+        while img_tag in x:
+            open_ab = x.find(img_tag)
+            start = x.find('alt=3D"', open_ab) + 7
+            end = x.find('"', start )
+            close_ab = x.find('>', end) + 1
+            x = x.replace(x[open_ab:close_ab], f'{[x[start:end]]}')
+            
+        msg_body = markdownify(x, convert = ['li', 'ol', 'ul', 'b', 'i', 'img'])
+        msg_body = msg_body.replace('\\_\\_', '__')
+        
+        # Remove redundant newlines
+        while msg_body[-3:] == '  \n':
+            msg_body = msg_body[:-3]
+        while msg_body[-1] == '\n':
+            msg_body = msg_body[:-1]
+        while msg_body[0] == '\n':
+            msg_body = msg_body[1:]
+    
+    # Remove quoted history from replies
+    msg_body = strip_quoted_text(msg_body)
+    log_and_print('Email Body:\n%s\n', TruncatedLogValue(msg_body))
+    return msg_body
+
+def route_email(dcts: DeciConsts, message_headers) -> list:
+    '''
+    Picks the servers to deliver an email to, since the sender can be on more than one mailing list
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot.
+        message_headers (email.message.Message): The headers of the email
+
+    Returns:
+        list: The IDs of the servers. Empty if the bot couldn't tell which server the email is for.
+    '''
+    
+    deci_config = read_config_file(dcts.deci_config_dir)
+    guilds_conf = read_config_file(deci_config['dir_paths']['guilds_dir'])
+    email_from = message_headers.get('from')
+    parents = dcts.thread_index.find_discord_parent(message_headers.get('In-Reply-To'), message_headers.get('References'))
+    return dcts.guild_router.route(email_from[email_from.find('<') + 1:email_from.find('>')], 
+                                   message_headers.get_all('To', []) + message_headers.get_all('Cc', []), 
+                                   message_headers.get('subject'), guilds_conf, [p[0] for p in parents])
+
+async def fetch_email_attachments(dcts: DeciConsts, imap_client: aioimaplib.IMAP4_SSL, uid: int, message_headers, 
+                                  body_struct: BodyPart, msg_body: str, srv_ids: list) -> tuple:
+    '''
+    Downloads the attachments of an email into the attachment store
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot.
+        imap_client (IMAP4_SSL): Object representing an imap instance 
+        uid (int): The uid of the email
+        message_headers (email.message.Message): The headers of the email
+        body_struct (BodyPart): The BODYSTRUCTURE of the email
+        msg_body (str): The converted body of the email
+        srv_ids (list): The servers the email is delivered to
+
+    Returns:
+        tuple: (File paths of the downloaded attachments, notes about attachments that were too large)
+    '''
+    
+    deci_config = read_config_file(dcts.deci_config_dir)
+    email_from = message_headers.get('from')
+    email_timestamp = parser.parse(message_headers.get('Date'))
+    
+    # Extract attachments
+    if body_struct.maintype == 'multipart' and body_struct.parts[-1].maintype == 'image':
+        last_msg_is_image = True
+    else:
+        last_msg_is_image = False
+    upload_limit = get_upload_limit(dcts, srv_ids or dcts.guild_router.guilds_of(email_from[email_from.find('<') + 1:email_from.find('>')]))
+    att_policy = deci_config.get('att_policy', {})
+    chunk_size = att_policy.get('chunk_size', 1 << 20)
+    att_store = dcts.att_store
+    transformer = dcts.image_transformer
+    att_paths = []
+    att_notes = []
+    for part in walk(body_struct):
+        if part.maintype == 'multipart':
+            continue
+        if part.disposition is None:
+            continue
+
+        named = part_filename(part)
+        filename = named or f'attachment_{part.section}'
+        try: 
+            try:
+                part_timestamp = parser.parse(part.disp_params['creation-date'])
+                outlook_atts_cond = abs(part_timestamp - email_timestamp) <= timedelta(seconds = 60)
+            except:
+                outlook_atts_cond = False
+                
+            gmail_atts_cond = (named is not None and named in msg_body) or part.maintype == 'video'
+            if outlook_atts_cond or gmail_atts_cond or last_msg_is_image:
+                # Attachments too large for Discord are handled by the configured policy, unless they're images that may shrink to fit
+                shrinkable = transformer.enabled and part.maintype == 'image' and decoded_size(part) <= transformer.max_source_bytes
+                if decoded_size(part) > upload_limit and not shrinkable:
+                    att_notes.append(await handle_oversized_attachment(imap_client, uid, part, filename, deci_config, srv_ids))
+                    continue
+                # Store the attachment by its contents, skipping repeated signature images
+                with att_store.writer() as fp:
+                    await stream_section(imap_client, uid, part, fp, chunk_size)
+                att_path = att_store.commit(fp, filename, part.maintype == 'image' and part.disposition == 'inline')
+                if att_path is None:
+                    log_and_print('Skipped repeated inline image: %s', filename)
+                    continue
+                if part.maintype == 'image' and transformer.enabled:
+                    stored_path = att_path
+                    att_path = await WORKERS.run(BULK, transformer.transform_path, stored_path)
+                    if os.path.getsize(att_path) > upload_limit:
+                        # Hand the downloaded copy to the oversize policy instead of downloading it again, then drop it
+                        att_notes.append(await handle_oversized_attachment(imap_client, uid, part, filename, deci_config, 
+                                                                           srv_ids, local_path = stored_path))
+                        att_store.remove(stored_path)
+                        continue
+                att_paths.append(att_path)
+                log_and_print('Downloaded file: %s', filename)
+        except Exception as e:
+            log_and_print('Failed to download attachment %s of email %s: %s', filename, uid, e, level='error')
+            att_notes.append(f'[attachment failed: {filename} could not be downloaded]')
+    if len(att_paths) == 2: 
+        att_paths = att_paths[::-1]    
+    return att_paths, att_notes
+
+def build_rendered_email(message_headers, msg_body: str, att_paths: list, att_notes: list, srv_ids: list) -> dict:
+    '''
+    Puts together the form of an email that is forwarded by email and to Discord
+
+    Returns:
+        dict: The subject, sender, sender_email, body, att_paths and srv_ids (the servers to 
+              deliver to) of the email
+    '''
+    
+    if att_notes:
+        msg_body += '\n\n' + '\n'.join(att_notes)
+    
+    # Set the subject                                                         
+    subject = message_headers.get('subject')      
+    email_from = message_headers.get('from')
+    try:
+        sender_email = email_from[email_from.find("<")+1:email_from.find(">")]
+    except:
+        sender_email = email_from
+    
+    return {
+        'subject': subject,
+        'sender': email_from,
+        'sender_email': sender_email,
+        'body': msg_body,
+        'att_paths': att_paths,
+        'srv_ids': [int(i) for i in srv_ids],
+        'message_id': message_headers.get('Message-ID'),
+        'in_reply_to': message_headers.get('In-Reply-To'),
+        'references': message_headers.get('References')
+    }
+
+def is_from_mailing_list(dcts: DeciConsts, message_headers) -> bool:
+    '''
+    Checks whether the sender of an email is on any server's mailing list
+    '''
+    
+    # Check if sender is in mailing list
+    email_from = message_headers.get('from')
+    start = email_from.find('<') + 1
+    end = email_from.find('>')
+    from_email_addr = email_from[start:end]
+    
+    # If not, skip the email
+    if not dcts.guild_router.guilds_of(from_email_addr):
+        log_and_print('Email received from an address that\'s not on the mailing list: %s', from_email_addr)
+        return False
+    return True
+
+def reusable_rendered(journal: DeliveryJournal, uid: int) -> dict:
+    '''
+    Returns the rendered email that the delivery journal has for uid, unless its attachments 
+    have gone missing since. None if the email needs rendering again.
+    '''
+    
+    rendered = journal.data(uid, 'rendered')
+    if rendered is not None and all(os.path.exists(i) for i in rendered['att_paths']):
+        return rendered
+    return None
+
+async def fetch_email_content(imap_client: aioimaplib.IMAP4_SSL, uid: int, message_headers, fetch_conf: dict) -> tuple:
+    '''
+    Downloads the structure and the body part of an email. The first step of render_email().
+
+    Returns:
+        tuple: (body_struct, email_msg) as returned by fetch_email_body(), or None if the 
+               email has no body that can be posted
+    '''
+    
+    log_and_print('Incoming email headers:\n%s', TruncatedLogValue(message_headers))
+    return await fetch_email_body(imap_client, uid, fetch_conf)
+
+async def convert_email_content(dcts: DeciConsts, message_headers, email_msg) -> tuple:
+    '''
+    Converts the body of an email to markdown in a bulk worker thread and picks the servers 
+    to deliver it to. The second step of render_email().
+
+    Returns:
+        tuple: (msg_body, srv_ids), or None if the body couldn't be converted
+    '''
+    
+    msg_body = await WORKERS.run(BULK, convert_email_body, email_msg)
+    if msg_body is None:
+        return None
+    return msg_body, route_email(dcts, message_headers)
+
+async def fetch_rendered_email(dcts: DeciConsts, imap_client: aioimaplib.IMAP4_SSL, uid: int, message_headers, 
+                               body_struct: BodyPart, msg_body: str, srv_ids: list) -> dict:
+    '''
+    Downloads the attachments of an email and builds the rendered email. The last step of 
+    render_email().
+    '''
+    
+    att_paths, att_notes = await fetch_email_attachments(dcts, imap_client, uid, message_headers, body_struct, msg_body, srv_ids)
+    return build_rendered_email(message_headers, msg_body, att_paths, att_notes, srv_ids)
+
+async def render_email(dcts: DeciConsts, imap_client: aioimaplib.IMAP4_SSL, uid: int, message_headers) -> dict:
+    '''
+    Downloads an email and converts it into the form that is forwarded by email and to Discord
+    
+    Runs the same steps as the filter, fetch_body, render and fetch_attachments stages of the 
+    ingest pipeline (see build_ingest_pipeline()), one after the other.
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot.
+        imap_client (IMAP4_SSL): Object representing an imap instance 
+                                 for listening to incoming emails.
+        uid (int): The uid of the email
+        message_headers (email.message.Message): The headers of the email
+
+    Returns:
+        dict: The subject, sender, sender_email, body, att_paths and srv_ids (the servers to 
+              deliver to) of the email. None if the email shouldn't be delivered.
+    '''
+    
+    if not is_from_mailing_list(dcts, message_headers):
+        return None
+    
+    # Begin parsing the email's contents
+    fetched = await fetch_email_content(imap_client, uid, message_headers, read_config_file(dcts.deci_config_dir).get('fetch', {}))
+    if fetched is None:
+        return None
+    body_struct, email_msg = fetched
+    converted = await convert_email_content(dcts, message_headers, email_msg)
+    if converted is None:
+        return None
+    msg_body, srv_ids = converted
+    return await fetch_rendered_email(dcts, imap_client, uid, message_headers, body_struct, msg_body, srv_ids)
+
+async def forward_email(dcts: DeciConsts, uid: int, rendered: dict) -> None:
+    '''
+    Forwards a rendered email to the mailing lists of the servers it was routed to, or sends 
+    the sender an error message if it couldn't be routed
+    
+    Recorded in the delivery journal as `emailed`.
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot.
+        uid (int): The uid of the email
+        rendered (dict): The rendered email, as returned by render_email()
+    '''
+    
+    journal = dcts.journal
+    if journal.done(uid, 'emailed'):
+        return
+    subject = rendered['subject']
+    email_from = rendered['sender']
+    sender_email = rendered['sender_email']
+    msg_body = rendered['body']
+    att_paths = rendered['att_paths']
+    srv_ids = rendered['srv_ids']
+    
+    # If no server could be picked for the email, send an error message
+    if srv_ids == []:
+        err_msg = 'Error: You\'re in more than 1 server mailing list and the bot couldn\'t tell which one this email is for.\n'
+        err_msg += 'Please send it to the server\'s email alias or add the server\'s subject tag to the subject,\n'
+        err_msg += 'or contact the bot admin.'
+        await WORKERS.run(BULK, send_email, email_recipients = [email_from], subject = f'Re: {subject}', body = err_msg)
+        journal.record(uid, 'emailed')
+        return
+    
+    # Forward emails to everyone else on the servers' mailing lists, encoding the body and attachments only once
+    email_recipients = dcts.guild_router.recipients(srv_ids, exclude = sender_email)
+    fw_headers = ThreadIndex.reply_headers((rendered.get('message_id'), rendered.get('references') or '')) if rendered.get('message_id') else {}
+    if email_recipients != []:
+        prepared = await WORKERS.run(BULK, PreparedEmail, msg_body, att_paths)
+        email_server = await WORKERS.run(BULK, connect_smtp, dcts)
+        try:
+            if not journal.done(uid, 'forwarded'):
+                await WORKERS.run(BULK, send_prepared_email, email_server, prepared, email_recipients, f'Fw: {subject}', fw_headers)
+                journal.record(uid, 'forwarded')
+            await WORKERS.run(BULK, send_prepared_email, email_server, prepared, [sender_email], f'Fw: {subject}', 
+                              with_attachments = False, prefix = 'Email successfully forwarded!<br />')
+        finally:
+            # QUIT is a round trip to the server as well
+            await WORKERS.run(BULK, email_server.quit)
+    journal.record(uid, 'emailed')
+
+async def post_rendered_email(dcts: DeciConsts, rendered: dict, guild_id: int, progress: dict = None) -> None:
+    '''
+    Posts a rendered email in the Discord channel of one server
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot.
+        rendered (dict): The rendered email, as returned by render_email()
+        guild_id (int): The ID of the server
+        progress (dict, optional): `sent`, the number of messages of the email already posted. 
+                                   Those are skipped, and it's updated as more are sent, even 
+                                   if posting fails. Defaults to None.
+    '''
+    
+    sent = {int(guild_id): (progress or {}).get('sent', 0)}
+    try:
+        await send_email_as_disc_msg(dcts, rendered['subject'], rendered['sender'], rendered['body'], rendered['att_paths'], del_atts = False, 
+                                     message_id = rendered.get('message_id'), 
+                                     in_reply_to = rendered.get('in_reply_to'), 
+                                     references = rendered.get('references'),
+                                     guild_ids = [int(guild_id)], 
+                                     progress = sent)
+    finally:
+        if progress is not None:
+            progress['sent'] = sent[int(guild_id)]
+
+async def post_email(dcts: DeciConsts, uid: int, rendered: dict) -> None:
+    '''
+    Posts a rendered email in the Discord channels of the servers it was routed to, all at once
+    
+    In split mode the posts are sent to the bot process over dcts.link. Each server is recorded in the delivery journal as `posted:<server ID>`.
+    If a post fails part way, the number of messages that did go out is recorded as `posting:<server ID>`, 
+    and the next attempt carries on after them.
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot.
+        uid (int): The uid of the email
+        rendered (dict): The rendered email, as returned by render_email()
+    '''
+    
+    journal = dcts.journal
+    # `posted` on its own is from before emails could go to more than one server
+    if journal.done(uid, 'posted'):
+        return
+    
+    async def post(srv_id: int):
+        progress = dict(journal.data(uid, f'posting:{srv_id}') or {'sent': 0})
+        sent_before = progress['sent']
+        try:
+            # In split mode the bot process posts it, and reports how far it got
+            if dcts.link is not None:
+                call_timeout = read_config_file(dcts.deci_config_dir).get('split', {}).get('call_timeout', 60)
+                result = await dcts.link.call('post', timeout = call_timeout, rendered = rendered, guild_id = srv_id, 
+                                              sent = sent_before) or {}
+                error = result.pop('error', None)
+                progress.update(result)
+                if error is not None:
+                    raise LinkError(error)
+            else:
+                await post_rendered_email(dcts, rendered, srv_id, progress)
+        finally:
+            if progress['sent'] > sent_before:
+                journal.record(uid, f'posting:{srv_id}', **progress)
+        journal.record(uid, f'posted:{srv_id}')
+    
+    results = await asyncio.gather(*[post(i) for i in rendered['srv_ids'] if not journal.done(uid, f'posted:{i}')], 
+                                   return_exceptions = True)
+    for r in results:
+        if isinstance(r, BaseException):
+            raise r
+
+async def deliver_email(dcts: DeciConsts, uid: int, rendered: dict) -> None:
+    '''
+    Forwards a rendered email to the mailing lists and Discord channels of the servers it 
+    was routed to
+    
+    The email and Discord steps run concurrently, and so do the posts to each server. Each 
+    one is recorded in the delivery journal, so a resumed delivery only repeats the steps 
+    that never finished.
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot.
+        uid (int): The uid of the email
+        rendered (dict): The rendered email, as returned by render_email()
+    '''
+    
+    results = await asyncio.gather(forward_email(dcts, uid, rendered), post_email(dcts, uid, rendered), 
+                                   return_exceptions = True)
+    for r in results:
+        if isinstance(r, BaseException):
+            raise r
+    
+    # The attachments stay in the attachment store, which evicts them once they're old
+
+async def process_email(dcts: DeciConsts, imap_client: aioimaplib.IMAP4_SSL, uid: int, message_headers) -> None:
+    '''
+    Takes an email through every delivery step that it hasn't completed yet
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot.
+        imap_client (IMAP4_SSL): Object representing an imap instance 
+                                 for listening to incoming emails.
+        uid (int): The uid of the email
+        message_headers (email.message.Message): The headers of the email
+    '''
+    
+    journal = dcts.journal
+    try:
+        # Reuse the rendered email unless its attachments have gone missing since
+        rendered = reusable_rendered(journal, uid)
+        if rendered is None:
+            rendered = await render_email(dcts, imap_client, uid, message_headers)
+            if rendered is None:
+                journal.record(uid, 'done')
+                return
+            journal.record(uid, 'rendered', **rendered)
+        await deliver_email(dcts, uid, rendered)
+        journal.record(uid, 'done')
+    except Exception as e:
+        log_and_print('Failed to deliver email %s: %s', uid, e, level='error')
+        journal.record(uid, 'failed')
+
+async def fetch_email_headers(imap_client: aioimaplib.IMAP4_SSL, uid_range: str) -> list:
+    '''
+    Fetches the headers of the emails in uid_range
+
+    Args:
+        imap_client (IMAP4_SSL): Object representing an imap instance 
+        uid_range (str): The uids to fetch. E.g. `5:*` or `5`
+
+    Returns:
+        list: A list of (uid, message_headers) tuples. None if the fetch failed.
+    '''
+    
+    # The code block that fetches emails. I don't understand this but it works
+    response = await imap_client.uid('fetch', uid_range,
+                                     '(UID FLAGS BODY.PEEK[HEADER.FIELDS (%s)])' % ' '.join(ID_HEADER_SET))
+    if response.result != 'OK':
+        log_and_print('error %s', response)
+        return None
+    
+    headers = []
+    for i in range(0, len(response.lines) - 1, 3):
+        fetch_command_without_literal = b'%s %s' % (response.lines[i], response.lines[i + 2])
+        uid = int(FETCH_MESSAGE_DATA_UID.match(fetch_command_without_literal).group('uid'))
+        headers.append((uid, BytesHeaderParser().parsebytes(response.lines[i + 1])))
+    return headers
+
+async def fetch_retry_headers(dcts: DeciConsts, imap_client: aioimaplib.IMAP4_SSL, uids: list, window_size: int) -> list:
+    '''
+    Fetches the headers of the incomplete emails in uids, window_size at a time. Emails that 
+    are no longer in the inbox can't be delivered, so they're recorded as abandoned.
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot.
+        imap_client (IMAP4_SSL): Object representing an imap instance 
+        uids (list): The uids of the emails
+        window_size (int): Number of uids to fetch at once
+
+    Returns:
+        list: A list of (uid, message_headers) tuples
+    '''
+    
+    found = []
+    for i in range(0, len(uids), window_size):
+        window = uids[i:i + window_size]
+        headers = await fetch_email_headers(imap_client, ','.join(str(uid) for uid in window))
+        if headers is None:
+            continue
+        # uid fetch can include the last email in the mailbox as well
+        headers = {uid: h for uid, h in headers if uid in window}
+        for uid in window:
+            if uid in headers:
+                found.append((uid, headers[uid]))
+            else:
+                log_and_print('Email %s is no longer in the inbox, giving up on delivering it', uid, level='warning')
+                dcts.journal.record(uid, 'abandoned')
+    return found
+
+def parse_mailbox_status(lines: list) -> dict:
+    '''
+    Reads the UIDNEXT (the uid the next email to arrive will get) and the UIDVALIDITY 
+    (which changes if the server renumbers the emails) out of the lines of a SELECT response
+
+    Returns:
+        dict: `UIDNEXT` and `UIDVALIDITY`, for the ones the server reported
+    '''
+    
+    status = {}
+    for line in lines:
+        if isinstance(line, (bytes, bytearray)):
+            for name, value in re.findall(rb'(UIDNEXT|UIDVALIDITY) (\d+)', bytes(line)):
+                status[name.decode()] = int(value)
+    return status
+
+async def fetch_last_uid(imap_client: aioimaplib.IMAP4_SSL) -> int:
+    '''
+    Asks for the uid of the last email in the selected mailbox
+
+    Returns:
+        int: The uid, or None if the mailbox is empty or the fetch failed
+    '''
+    
+    response = await imap_client.uid('fetch', '*', '(UID)')
+    if response.result != 'OK':
+        return None
+    uids = [int(m.group('uid')) for line in response.lines if isinstance(line, (bytes, bytearray)) 
+            for m in [FETCH_MESSAGE_DATA_UID.match(bytes(line))] if m]
+    return max(uids, default = None)
+
+async def get_mailbox_status(imap_client: aioimaplib.IMAP4_SSL) -> dict:
+    '''
+    Finds the UIDNEXT and UIDVALIDITY of the selected mailbox
+    
+    RFC 3501 says not to send STATUS for the selected mailbox, and the UIDNEXT in the SELECT 
+    response goes stale as emails arrive, so the UIDNEXT is worked out from the uid of the 
+    last email instead, with a single `UID FETCH *`.
+
+    Args:
+        imap_client (IMAP4_SSL): Object representing an imap instance with the inbox selected
+
+    Returns:
+        dict: `UIDNEXT` and `UIDVALIDITY`, for the ones that are known
+    '''
+    
+    status = dict(getattr(imap_client, 'select_status', {}))
+    last_uid = await fetch_last_uid(imap_client)
+    if last_uid is not None:
+        # The uids of expunged emails aren't reused, so the SELECT's UIDNEXT can be past the last email
+        status['UIDNEXT'] = max(status.get('UIDNEXT', 0), last_uid + 1)
+    return status
+
+async def discover_start_uid(imap_client: aioimaplib.IMAP4_SSL, since_days: int = None) -> int:
+    '''
+    Finds the uid to start fetching emails after, without downloading anything per email
+    
+    By default only emails that arrive from now on are fetched. If since_days is given,
+    the emails that arrived in the last since_days days are fetched as well.
+
+    Args:
+        imap_client (IMAP4_SSL): Object representing an imap instance with the inbox selected
+        since_days (int, optional): Number of days of old emails to fetch. Defaults to None.
+
+    Returns:
+        int: The uid to use as max_uid
+    '''
+    
+    # An empty mailbox starts at uid 1
+    uidnext = (await get_mailbox_status(imap_client)).get('UIDNEXT', 1)
+    
+    if since_days:
+        since = date.today() - timedelta(days = since_days)
+        months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+        response = await imap_client.uid_search(f'SINCE {since.day}-{months[since.month - 1]}-{since.year}')
+        uids = []
+        if response.result == 'OK':
+            for line in response.lines:
+                tokens = bytes(line).split() if isinstance(line, (bytes, bytearray)) else []
+                if tokens and tokens[0].upper() == b'SEARCH':
+                    tokens = tokens[1:]
+                if tokens and all(t.isdigit() for t in tokens):
+                    uids += [int(t) for t in tokens]
+        if uids:
+            return min(uids) - 1
+    
+    return uidnext - 1
+
+def build_ingest_pipeline(dcts: DeciConsts, imap_client: ImapClientPool, pipeline_conf: dict) -> Pipeline:
+    '''
+    Builds the pipeline that takes new emails from their headers to Discord and the mailing lists
+    
+    Each stage calls the same helpers as render_email() and deliver_email(), which replays use.
+    
+    Stages, in order:
+    - filter: Drops emails from senders that aren't on a mailing list
+    - fetch_body: Downloads the structure and the body part of the email
+    - render: Converts the body to markdown (in a bulk worker thread) and picks the servers to deliver to
+    - fetch_attachments: Downloads the attachments into the attachment store
+    - post: Posts the email in the servers' Discord channels
+    - forward: Forwards the email to the servers' mailing lists
+    
+    Each stage has `concurrency[stage]` workers (1 by default, so emails are posted in the 
+    order they arrived) and a queue of `queue_size` emails in front of it (twice the number 
+    of workers by default). Emails that were rendered before the bot stopped skip straight 
+    to delivery. In embed mode the post stage gets at least 10 workers, so a burst of emails 
+    can share messages. The embed batcher posts them in the order the workers took them.
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot.
+        imap_client (ImapClientPool): The imap connections to download emails with
+        pipeline_conf (dict): The `pipeline` section of deci_config
+
+    Returns:
+        Pipeline: The pipeline. Put {'uid': uid, 'headers': message_headers} items into it.
+    '''
+    
+    journal = dcts.journal
+    deci_config = read_config_file(dcts.deci_config_dir)
+    fetch_conf = deci_config.get('fetch', {})
+    
+    async def filter_stage(item):
+        rendered = reusable_rendered(journal, item['uid'])
+        if rendered is not None:
+            item['rendered'] = rendered
+        elif not is_from_mailing_list(dcts, item['headers']):
+            journal.record(item['uid'], 'done')
+            return None
+        return item
+    
+    async def fetch_body_stage(item):
+        if 'rendered' not in item:
+            fetched = await fetch_email_content(imap_client, item['uid'], item['headers'], fetch_conf)
+            if fetched is None:
+                journal.record(item['uid'], 'done')
+                return None
+            item['body_struct'], item['email_msg'] = fetched
+        return item
+    
+    async def render_stage(item):
+        if 'rendered' not in item:
+            converted = await convert_email_content(dcts, item['headers'], item.pop('email_msg'))
+            if converted is None:
+                journal.record(item['uid'], 'done')
+                return None
+            item['body'], item['srv_ids'] = converted
+        return item
+    
+    async def fetch_attachments_stage(item):
+        if 'rendered' not in item:
+            item['rendered'] = await fetch_rendered_email(dcts, imap_client, item['uid'], item['headers'], 
+                                                          item.pop('body_struct'), item['body'], item['srv_ids'])
+            journal.record(item['uid'], 'rendered', **item['rendered'])
+        return item
+    
+    async def post_stage(item):
+        item['delivery_start'] = time.perf_counter()
+        await post_email(dcts, item['uid'], item['rendered'])
+        return item
+    
+    async def forward_stage(item):
+        await forward_email(dcts, item['uid'], item['rendered'])
+        journal.record(item['uid'], 'done')
+        CLASS_LATENCY[BULK].add(time.perf_counter() - item['delivery_start'])
+        return item
+    
+    def on_error(stage_name, item, e):
+        log_and_print('Failed to deliver email %s at %s: %s', item['uid'], stage_name, e, level='error')
+        journal.record(item['uid'], 'failed')
+    
+    concurrency = dict(pipeline_conf.get('concurrency', {}))
+    queue_size = pipeline_conf.get('queue_size')
+    if deci_config.get('discord', {}).get('render_mode', 'text') == 'embed':
+        concurrency['post'] = max(concurrency.get('post', 1), MAX_EMBEDS)
+    stages = [Stage(name, func, concurrency.get(name, 1), queue_size) for name, func in [
+        ('filter', filter_stage),
+        ('fetch_body', fetch_body_stage),
+        ('render', render_stage),
+        ('fetch_attachments', fetch_attachments_stage),
+        ('post', post_stage),
+        ('forward', forward_stage)
+    ]]
+    return Pipeline(stages, on_error, INGEST_METRICS)
+
+@profiled()
+async def fetch_email_messages(dcts: DeciConsts, imap_client: aioimaplib.IMAP4_SSL, max_uid: int, 
+                               extra_clients: list = None) -> int:
+    '''
+    Fetches new email messages and calls sendEmailAsDiscordMsg() if the email was sent by
+    someone on the mailing list.
+    
+    New emails are fetched in windows of `window_size` uids and fed into the ingest pipeline
+    (see build_ingest_pipeline()). The pipeline's queues are bounded, so the next window 
+    isn't fetched until the stages have room for it, and a large backlog never has more than 
+    a window of headers plus the queued emails in memory. Each window is recorded in the 
+    delivery journal before max_uid is moved past it, so an email is never lost if the bot 
+    stops while delivering it. Emails the journal already has as complete aren't delivered 
+    again. Only one fetch runs at a time (see DeciConsts.fetch_lock).
+    
+    Each fetch starts by putting the emails whose delivery was interrupted or failed back 
+    into the pipeline, once their backoff (`retry_backoff_seconds` in the `journal` section 
+    of deci_config, doubled after every failed attempt) has passed.
+    
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot.
+        imap_client (IMAP4_SSL): Object representing an imap instance 
+                                 for listening to incoming emails.
+        max_uid (int): The max uid of all emails in the current inbox.
+        extra_clients (list, optional): More imap clients for the download stages. If None, 
+                                        `imap_connections` - 1 are opened for this fetch only.
+                                        Defaults to None.
+        
+    Returns:
+        The new max_uid (int)
+    '''
+    
+    journal = dcts.journal
+    deci_config = read_config_file(dcts.deci_config_dir)
+    max_uid_path = deci_config['dir_paths']['max_uid_path']
+    window_size = max(deci_config.get('fetch', {}).get('window_size', 100), 1)
+    pipeline_conf = deci_config.get('pipeline', {})
+    retry_backoff = deci_config.get('journal', {}).get('retry_backoff_seconds', 60)
+    
+    async with dcts.fetch_lock:
+        # Another fetch may have moved past max_uid while this one waited for the lock
+        with open(max_uid_path) as f:
+            new_max_uid = max_uid = max(max_uid, int(f.read() or 0))
+        
+        # Without UIDNEXT there's no way to tell where the backlog ends, so fetch it all at once
+        uidnext = (await get_mailbox_status(imap_client)).get('UIDNEXT')
+        if uidnext is None:
+            log_and_print('Server did not report UIDNEXT, fetching all new emails at once', level='warning')
+        retries = journal.retry_due(retry_backoff)
+        if not retries and uidnext is not None and new_max_uid + 1 >= uidnext:
+            return new_max_uid
+        
+        # Extra connections let the download stages run side by side
+        own_clients = extra_clients is None
+        if own_clients:
+            extra_clients = await open_imap_clients(dcts, pipeline_conf.get('imap_connections', 1) - 1)
+        imap_pool = ImapClientPool([imap_client] + extra_clients)
+        pipeline = build_ingest_pipeline(dcts, imap_pool, pipeline_conf)
+        pipeline.start()
+        try:
+            if retries:
+                log_and_print('Retrying the delivery of %s emails', len(retries))
+            for uid, message_headers in await fetch_retry_headers(dcts, imap_pool, retries, window_size):
+                await pipeline.put({'uid': uid, 'headers': message_headers})
+            
+            while uidnext is None or new_max_uid + 1 < uidnext:
+                first = new_max_uid + 1
+                if uidnext is None:
+                    uid_range, last = '%d:*' % first, None
+                else:
+                    last = min(first + window_size, uidnext) - 1
+                    uid_range = '%d:%d' % (first, last)
+                    if uidnext - first > window_size:
+                        log_and_print('Catching up on emails %s of %s', uid_range, uidnext - 1)
+                headers = await fetch_email_headers(imap_pool, uid_range)
+                if headers is None:
+                    break
+                
+                # uid fetch always includes the UID of the last message in the mailbox
+                # cf https://tools.ietf.org/html/rfc3501#page-61
+                window = [(uid, h) for uid, h in headers if uid > max_uid and (last is None or uid <= last)]
+                del headers
+                
+                # Record the window before checkpointing past it. Empty stretches of uids are skipped too.
+                journal.record_all([uid for uid, _ in window if not journal.has(uid)], 'fetched')
+                window_max_uid = max([uid for uid, _ in window] + ([last] if last is not None else [new_max_uid]))
+                with open(max_uid_path, mode='w') as f:
+                    f.write(str(window_max_uid))
+                
+                # Waits whenever the first stage's queue is full
+                for uid, message_headers in window:
+                    if not journal.is_complete(uid):
+                        await pipeline.put({'uid': uid, 'headers': message_headers})
+                new_max_uid = window_max_uid
+                if uidnext is None:
+                    break
+            await pipeline.join()
+        finally:
+            await pipeline.cancel()
+            if own_clients:
+                for client in extra_clients:
+                    await client.logout()
+        log_and_print('Ingest pipeline: %s', pipeline.stats())
+        
+        # Keep the journal small once everything in it has been delivered
+        if len(journal) > 1000 or journal.incomplete() == []:
+            journal.compact()
+        return new_max_uid
+
+async def open_imap_clients(dcts: DeciConsts, count: int) -> list:
+    '''
+    Opens count imap clients, for the download stages of the ingest pipeline
+    '''
+    
+    return [await dcts.init_imap_client() for _ in range(max(count, 0))]
+
+async def refresh_imap_clients(dcts: DeciConsts, imap_clients: list) -> None:
+    '''
+    Keeps long lived imap clients logged in between fetches, since servers log out clients 
+    that stay quiet for too long. A client that doesn't answer a NOOP is replaced in place.
+    '''
+    
+    for i, client in enumerate(imap_clients):
+        try:
+            if (await client.noop()).result == 'OK':
+                continue
+        except Exception as e:
+            log_and_print('Extra imap connection lost: %s', e, level='warning')
+        try:
+            await client.logout()
+        except Exception:
+            pass
+        imap_clients[i] = await dcts.init_imap_client()
+
+async def handle_server_push(push_messages: Collection[str]) -> None: 
+    for msg in push_messages:
+        if msg.endswith(b'EXISTS'):
+            log_and_print('new email: %s', msg) # could fetch only the message instead of max_uuid:* in the loop
+        elif msg.endswith(b'EXPUNGE'):
+            log_and_print('email removed: %s', msg)
+        elif b'FETCH' in msg and b'\Seen' in msg:
+            log_and_print('email seen %s', msg)
+        else:
+            log_and_print('unprocessed push email : %s', msg)
+
+async def fetch_new_emails(dcts: DeciConsts) -> None:
+    '''
+    Fetches the emails that arrived since the last fetch with a new imap client, outside of 
+    imap_loop()'s idle cycle
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot
+    '''
+    
+    # Set up the imap client
+    imap_client = await dcts.init_imap_client()
+    
+    # Read in the necessary variables from deci_config
+    deci_config = read_config_file(dcts.deci_config_dir)
+    max_uid_path = deci_config['dir_paths']['max_uid_path']
+    
+    try:
+        # Set the current max uid
+        with open(max_uid_path) as f:
+            persistent_max_uid = int(f.read())
+            log_and_print('persistent_max_uid = %s', persistent_max_uid)
+        
+        # Call the email fetch function
+        await fetch_email_messages(dcts, imap_client, persistent_max_uid)
+    finally:
+        await imap_client.logout()
+
+async def imap_loop(dcts: DeciConsts, 
+                    # host: str, 
+                    # user: str, 
                     # password: str
                     ) -> None:
     '''
-    Listens for incoming emails by calling fetch_email_messages()
+    Listens for incoming emails by calling fetch_email_messages()
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot
+        host (str): The address of the email host server
+        user (str): The email used for sending and receiving messages from/to Discord
+        password (str): Password of email address. 
+                        This should NEVER be stored in plain text outside of the program!
+    '''
+    
+    # Set up the imap client
+    log_and_print('Listening for emails using imap_loop...', terminal_print=True)
+    imap_client = await dcts.init_imap_client()
+    user = dcts.email_user
+    
+    # imap_client = aioimaplib.IMAP4_SSL(host=host, timeout=30)
+    # await imap_client.wait_hello_from_server()
+    # await imap_client.login(user, password)
+    # await imap_client.select('INBOX')
+    
+    # Read in the necessary variables from deci_config
+    deci_config = read_config_file(dcts.deci_config_dir)
+    max_uid_path = deci_config['dir_paths']['max_uid_path']
+
+    uid_validity_path = deci_config['dir_paths']['uid_validity_path']
+
+    # Set the current max uid
+    persistent_max_uid = 1
+    with open(max_uid_path) as f:
+        persistent_max_uid = int(f.read())
+        log_and_print('persistent_max_uid = %s', persistent_max_uid)
+    
+    # If the server has renumbered the inbox, the saved max uid means nothing anymore
+    uid_validity = (await get_mailbox_status(imap_client)).get('UIDVALIDITY')
+    saved_uid_validity = None
+    if os.path.exists(uid_validity_path):
+        with open(uid_validity_path) as f:
+            saved_uid_validity = int(f.read() or 0) or None
+    if uid_validity is not None and saved_uid_validity is not None and uid_validity != saved_uid_validity:
+        persistent_max_uid = await discover_start_uid(imap_client)
+        with open(max_uid_path, mode='w') as f:
+            f.write(str(persistent_max_uid))
+        log_and_print('UIDVALIDITY changed from %s to %s, starting again from uid %s', 
+                      saved_uid_validity, uid_validity, persistent_max_uid, level='warning')
+    if uid_validity is not None and uid_validity != saved_uid_validity:
+        with open(uid_validity_path, mode='w') as f:
+            f.write(str(uid_validity))
+    
+    # The extra connections for the download stages stay open for as long as the loop runs
+    extra_clients = await open_imap_clients(dcts, deci_config.get('pipeline', {}).get('imap_connections', 1) - 1)
+        
+    # Loop the email fetch function. Deliveries that were interrupted the last time the bot ran are finished first.
+    try:
+        while True:
+            await refresh_imap_clients(dcts, extra_clients)
+            persistent_max_uid = await fetch_email_messages(dcts, imap_client, persistent_max_uid, extra_clients)
+            log_and_print('%s starting idle', user)
+            idle_task = await imap_client.idle_start(timeout=60)
+            log_and_print('idle_start() executed')
+            await handle_server_push(await imap_client.wait_server_push())
+            log_and_print('handle_server_push() executed')
+            imap_client.idle_done()
+            await wait_for(idle_task, timeout=5)
+            log_and_print('%s ending idle', user)
+    finally:
+        for client in extra_clients:
+            await client.logout()
+
+async def janitor_loop(dcts: DeciConsts) -> None:
+    '''
+    Sweeps the attachment directories every `interval_seconds` of the `att_janitor` section 
+    of deci_config (see attachmentjanitor), logging what each sweep reclaimed
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot
+    '''
+    
+    while True:
+        janitor = dcts.att_janitor
+        if janitor.enabled:
+            try:
+                swept = await janitor.sweep(WORKERS)
+                if swept['reclaimed_bytes']:
+                    log_and_print('Attachment janitor reclaimed %s: %s evicted, %s in %s orphaned files, %s of cache, %s of expired links. %s of %s used', 
+                                  format_size(swept['reclaimed_bytes']), format_size(swept['evicted']), 
+                                  format_size(swept['orphans']), swept['orphan_files'], format_size(swept['cache']), 
+                                  format_size(swept['linked']), format_size(swept['total_bytes']), format_size(swept['max_bytes']))
+            except Exception as e:
+                log_and_print('Attachment janitor failed: %s', e, level='error')
+        await asyncio.sleep(janitor.interval)
+
+async def replay_emails(dcts: DeciConsts, imap_clients: list, emails, dry_run_sink = None) -> dict:
+    '''
+    Pushes a batch of emails through the same render and delivery steps as fetch_email_messages(),
+    one worker per imap client
+    
+    Emails that the delivery journal already has as complete are skipped, so an interrupted
+    replay can be run again to pick up where it stopped.
+
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot.
+        imap_clients (list): One imap client (or LocalMailbox) per worker
+        emails (Iterable): (uid, message_headers) tuples of the emails to replay
+        dry_run_sink (file, optional): If given, emails are only rendered and written to this file 
+                                       as json lines instead of being delivered. Defaults to None.
+
+    Returns:
+        dict: The number of emails that were `delivered`, `rendered`, `skipped`, `failed` 
+              or `already done`
+    '''
+    
+    journal = dcts.journal
+    counts = {}
+    emails = iter(emails)
+    
+    async def worker(imap_client):
+        # Every worker pulls the next email from the shared iterator until there are none left
+        for uid, message_headers in emails:
+            if dry_run_sink is not None:
+                start = time.perf_counter()
+                try:
+                    rendered = await render_email(dcts, imap_client, uid, message_headers)
+                    outcome = 'skipped' if rendered is None else 'rendered'
+                except Exception as e:
+                    log_and_print('Failed to render email %s: %s', uid, e, level='error')
+                    rendered, outcome = {'error': str(e)}, 'failed'
+                entry = {'uid': uid, 'outcome': outcome, 'render_s': round(time.perf_counter() - start, 4), **(rendered or {})}
+                dry_run_sink.write(json.dumps(entry, default = str) + '\n')
+            elif journal.is_complete(uid):
+                outcome = 'already done'
+            else:
+                if not journal.has(uid):
+                    journal.record(uid, 'fetched')
+                await process_email(dcts, imap_client, uid, message_headers)
+                if not journal.done(uid, 'done'):
+                    outcome = 'failed'
+                else:
+                    outcome = 'delivered' if journal.done(uid, 'rendered') else 'skipped'
+            counts[outcome] = counts.get(outcome, 0) + 1
+            if hasattr(imap_client, 'release'):
+                imap_client.release(uid)
+    
+    await asyncio.gather(*[worker(c) for c in imap_clients])
+    return counts
+
+def replay(argv: list = None) -> None:
+    '''
+    Command line entry point that replays emails from an mbox file, a Maildir directory or
+    a range of uids in the inbox through the bot, for catching up after outages or as a 
+    profiling workload. E.g.
+    
+        python main.py replay --mbox export.mbox --concurrency 8 --dry-run rendered.jsonl
+        python main.py replay --uids 1200:1450
+
+    Args:
+        argv (list, optional): The command line arguments after `replay`. Defaults to sys.argv.
+    '''
+    
+    arg_parser = argparse.ArgumentParser(prog = 'main.py replay', 
+                                         description = 'Replays emails through the rendering and delivery steps of the bot')
+    source = arg_parser.add_mutually_exclusive_group(required = True)
+    source.add_argument('--mbox', help = 'Path to an mbox file')
+    source.add_argument('--maildir', help = 'Path to a Maildir directory')
+    source.add_argument('--uids', help = 'Range of uids in the inbox. E.g. `1200:1450` or `1200:*`')
+    arg_parser.add_argument('--concurrency', type = int, default = 4, help = 'Number of emails to process at once (default 4)')
+    arg_parser.add_argument('--dry-run', metavar = 'OUTPUT', nargs = '?', const = '-', 
+                            help = 'Only render the emails and write them as json lines to OUTPUT (default stdout)')
+    arg_parser.add_argument('--journal', help = 'Delivery journal to use. Defaults to one per source next to the live journal')
+    arg_parser.add_argument('--profile', action = 'store_true', help = 'Profile the replay into the log directory')
+    args = arg_parser.parse_args(argv)
+    dry_run = args.dry_run is not None
+    concurrency = max(args.concurrency, 1)
+    
+    local_path = args.mbox or args.maildir
+    
+    # Credentials are only needed for the inbox and for delivering
+    dcts = DeciConsts(enter_fields = not (dry_run and local_path))
+    loop = get_event_loop()
+    loop.run_until_complete(check_repair_config_files(dcts))
+    deci_config = read_config_file(dcts.deci_config_dir)
+    configure_logging(deci_config["dir_paths"]["log_file_dir"], deci_config.get('logging', {}))
+    configure_scheduling(deci_config)
+    
+    # Keep the replay's progress apart from the live inbox's, since the uids don't match
+    if not dry_run:
+        source_name = os.path.basename(os.path.normpath(local_path)) if local_path else 'imap'
+        journal_path = args.journal or os.path.join(os.path.dirname(deci_config['dir_paths']['journal_dir']), 
+                                                    f'replay_journal_{source_name}.jsonl')
+        dcts._journal = DeliveryJournal(journal_path, deci_config.get('journal', {}).get('max_attempts', 3))
+        log_and_print('Replay journal: %s', journal_path, terminal_print=True)
+    
+    async def run() -> dict:
+        imap_clients = []
+        bot_task = None
+        try:
+            if local_path:
+                mailbox = LocalMailbox(local_path, cache_size = 2 * concurrency)
+                clients = [mailbox] * concurrency
+                emails = ((uid, mailbox.headers(uid)) for uid in mailbox.uids())
+            else:
+                first, _, last = args.uids.partition(':')
+                first = int(first)
+                last = first if last == '' else (float('inf') if last == '*' else int(last))
+                imap_clients = [await dcts.init_imap_client() for _ in range(concurrency)]
+                clients = imap_clients
+                headers = await fetch_email_headers(imap_clients[0], args.uids)
+                emails = [(uid, h) for uid, h in headers or [] if first <= uid <= last]
+            
+            if dry_run:
+                sink = sys.stdout if args.dry_run == '-' else open(args.dry_run, mode='w', encoding='utf-8')
+                try:
+                    return await replay_emails(dcts, clients, emails, sink)
+                finally:
+                    if sink is not sys.stdout:
+                        sink.close()
+            bot_task = asyncio.ensure_future(dcts.bot.start(dcts.bot_token))
+            return await replay_emails(dcts, clients, emails)
+        finally:
+            for imap_client in imap_clients:
+                await imap_client.logout()
+            if bot_task is not None:
+                await dcts.bot.close()
+    
+    if args.profile:
+        PROFILER.start(deci_config["dir_paths"]["log_file_dir"], deci_config.get('profiling', {}).get('sample_interval'))
+    start = time.perf_counter()
+    counts = loop.run_until_complete(run())
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    log_and_print('Replayed %s emails in %.1f s (%.2f emails/s): %s', total, elapsed, total / elapsed if elapsed else 0, 
+                  ', '.join(f'{v} {k}' for k, v in sorted(counts.items())), terminal_print=True)
+    for path in PROFILER.stop():
+        log_and_print('Wrote %s', path, terminal_print=True)
+
+class DeciContext(commands.Context):
+    '''
+    Command context whose replies are interactive work, so they go ahead of bulk Discord calls
+    '''
+    
+    async def send(self, *args, **kwargs) -> dc.Message:
+        async with DISCORD_CALLS.slot(INTERACTIVE):
+            return await super().send(*args, **kwargs)
+    
+    async def reply(self, *args, **kwargs) -> dc.Message:
+        async with DISCORD_CALLS.slot(INTERACTIVE):
+            return await super().reply(*args, **kwargs)
+
+async def process_commands(bot: commands.Bot, message: dc.Message) -> None:
+    '''
+    Runs the command in message, like bot.process_commands() but with a DeciContext
+    '''
+    
+    if message.author.bot:
+        return
+    ctx = await bot.get_context(message, cls = DeciContext)
+    await bot.invoke(ctx)
 
-    Args:
-        dcts (DeciConsts): Class containing global variables for the bot
-        host (str): The address of the email host server
-        user (str): The email used for sending and receiving messages from/to Discord
-        password (str): Password of email address. 
-                        This should NEVER be stored in plain text outside of the program!
+def configure_scheduling(deci_config: dict) -> None:
     '''
+    Sizes DISCORD_CALLS and WORKERS from the `scheduling` section of deci_config
     
-    # Set up the imap client
-    log_and_print('Listening for emails using imap_loop...', terminal_print=True)
-    imap_client = await dcts.init_imap_client()
-    user = dcts.email_user
+    - discord_calls: Most Discord API calls at once
+    - workers: Number of worker threads
+    - reserved_interactive: Slots of each that bulk email delivery never takes
+    '''
     
-    # imap_client = aioimaplib.IMAP4_SSL(host=host, timeout=30)
-    # await imap_client.wait_hello_from_server()
-    # await imap_client.login(user, password)
-    # await imap_client.select('INBOX')
+    scheduling_conf = deci_config.get('scheduling', {})
+    reserved = {INTERACTIVE: scheduling_conf.get('reserved_interactive', 2)}
+    DISCORD_CALLS.configure(scheduling_conf.get('discord_calls', 8), reserved)
+    WORKERS.configure(scheduling_conf.get('workers', 8), reserved)
+
+def get_scheduler_stats() -> dict:
+    '''
+    Returns the metrics of each class of work: the waits for DISCORD_CALLS and WORKERS slots 
+    and CLASS_LATENCY
+    '''
     
-    # Read in the necessary variables from deci_config
-    deci_config = read_config_file(dcts.deci_config_dir)
-    max_uid_path = deci_config['dir_paths']['max_uid_path']
+    return {
+        'discord': DISCORD_CALLS.stats(),
+        'workers': WORKERS.stats(),
+        'latency': {cls: stats.as_dict() for cls, stats in CLASS_LATENCY.items()}
+    }
 
-    # Set the current max uid
-    persistent_max_uid = 1
-    with open(max_uid_path) as f:
-        persistent_max_uid = int(f.read())
-        log_and_print(f'persistent_max_uid = {persistent_max_uid}')
-        
-    # Loop the email fetch function
-    while True:
-        persistent_max_uid = await fetch_email_messages(dcts, imap_client, persistent_max_uid)
-        log_and_print('%s starting idle' % user)
-        idle_task = await imap_client.idle_start(timeout=60)
-        log_and_print('idle_start() executed')
-        await handle_server_push(await imap_client.wait_server_push())
-        log_and_print('handle_server_push() executed')
-        imap_client.idle_done()
-        await wait_for(idle_task, timeout=5)
-        log_and_print('%s ending idle' % user)
+def register_handlers(dcts: DeciConsts) -> commands.Bot:
+    '''
+    Registers the bot's commands and events on dcts.bot
 
-def main():    
-    # Initialize the global constants and the bot
-    dcts = DeciConsts(True)
-    bot = dcts.bot
-    bot_token = dcts.bot_token
-    
-    # Repair files
-    tasks = [asyncio.ensure_future(check_repair_config_files(dcts)),] # Create required files if they don't exist
-    loop = get_event_loop()
-    loop.run_until_complete(asyncio.wait(tasks))
+    Args:
+        dcts (DeciConsts): Class containing global variables for the bot. Must have a `bot`.
+
+    Returns:
+        commands.Bot: The bot
+    '''
     
-    # Configure logging
-    root_logger= log.getLogger()
-    root_logger.setLevel(log.INFO) 
-    today = str(date.today())
-    deci_config = read_config_file(dcts.deci_config_dir)
-    log_file_path = deci_config["dir_paths"]["log_file_dir"] + f"/deci_log_{today}.log"
-    if not(os.path.exists(log_file_path)):
-        with open(log_file_path, mode = 'w') as fp:
-            fp.write('')
-    handler = log.FileHandler(log_file_path, 
-                            mode = 'a', 
-                            encoding = 'utf-8',
-                            ) 
-    handler.setFormatter(log.Formatter('%(asctime)s [%(levelname)s]: %(message)s'))
-    root_logger.addHandler(handler)    
+    bot = dcts.bot
     
     # Discord commands vvv
     @bot.command()
@@ -747,9 +2313,9 @@ def main():
             text_to_echo (str): The text you want the bot to echo
         '''
         text_to_echo = ' '.join(text_to_echo)
-        log_and_print(f'echo(text_to_echo={text_to_echo}) was called')
+        log_and_print('echo(text_to_echo=%s) was called', text_to_echo)
         await ctx.reply(text_to_echo)
-        log_and_print(f'Replied to {ctx.author.name} with: \n{text_to_echo}')
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, text_to_echo)
         
     @bot.command(brief = 'Sets the emailing channel')
     async def set_channel(ctx, channel_link):
@@ -770,7 +2336,7 @@ def main():
                                 Must be a mention of the format `#<channel_name>`
         '''
         
-        log_and_print(f'set_channel(channel_link={channel_link}) was called')
+        log_and_print('set_channel(channel_link=%s) was called', channel_link)
         try:
             channel_id = channel_link[2:-1]
             dcts = DeciConsts()
@@ -787,7 +2353,7 @@ def main():
             else:
                 reply_msg = f'Failed to set as the channel for email communication. Contact the bot developer for help.'      
         await ctx.reply(reply_msg)
-        log_and_print(f'Replied to {ctx.author.name} with: \n{reply_msg}')
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
         
         
         
@@ -800,7 +2366,7 @@ def main():
             ctx (Discord.Context): An object representing the message that called this command
         '''
 
-        log_and_print(f'get_email_channel() was called')
+        log_and_print('get_email_channel() was called')
         
         # Read in the necessary variables from deci_config
         dcts = DeciConsts()
@@ -816,7 +2382,49 @@ def main():
             reply_msg = 'No channel is set as the current emailing channel'
             
         await ctx.reply(reply_msg)
-        log_and_print(f'Replied to {ctx.author.name} with: \n{reply_msg}')
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
+            
+    @bot.command(brief = 'Sets how emails from people on several servers are routed here')
+    @commands.guild_only()
+    @commands.has_permissions(administrator = True)
+    async def set_routing(ctx, kind: str = None, *values: str):
+        '''
+        Sets the email aliases or the subject tag that route an email to this server when its 
+        sender is on more than one server's mailing list. Replies with the current routing if 
+        no arguments are given. Only the server's administrators can use this command.
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+            kind (str): `aliases` or `tag`
+            values (str): The email aliases, or the subject tag. Leave empty to clear them.
+        '''
+        
+        log_and_print('set_routing(kind=%s, values=%s) was called', kind, values)
+        
+        # Read in the necessary variables from deci_config
+        dcts = DeciConsts()
+        deci_config = read_config_file(dcts.deci_config_dir)
+        guilds_dir = deci_config['dir_paths']['guilds_dir']
+        guilds_conf = read_config_file(guilds_dir)
+        guild_conf = guilds_conf[str(ctx.guild.id)]
+        
+        if kind == 'aliases':
+            guild_conf['email_aliases'] = list(values)
+            update_config_file(guilds_dir, guilds_conf)
+        elif kind == 'tag':
+            guild_conf['subject_tag'] = ' '.join(values) or None
+            update_config_file(guilds_dir, guilds_conf)
+        elif kind is not None:
+            reply_msg = dcts.CMD_SYNTAX_ERR
+            reply_msg += f'{dcts.COMMAND_PREFIX}set_routing <aliases|tag> <Email aliases or subject tag (optional)>'
+            await ctx.reply(reply_msg)
+            log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
+            return
+        
+        aliases = ', '.join(guild_conf.get('email_aliases') or []) or 'None'
+        reply_msg = f'Email aliases: {aliases}\nSubject tag: {guild_conf.get("subject_tag") or "None"}'
+        await ctx.reply(reply_msg)
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
             
     @bot.command(brief = 'Replies with the current subject line')
     async def current_subject_line(ctx):
@@ -827,7 +2435,7 @@ def main():
             ctx (Discord.Context): An object representing the message that called this command
         '''
         
-        log_and_print(f'current_subject_line() was called')
+        log_and_print('current_subject_line() was called')
         # Read in the necessary variables from deci_config
         dcts = DeciConsts()
         deci_config = read_config_file(dcts.deci_config_dir)
@@ -837,7 +2445,7 @@ def main():
         curr_subj = guilds_conf[guild]['currentSubject']
         reply_msg = f'The subject line is currently set to `{curr_subj}`'
         await ctx.reply(reply_msg)
-        log_and_print(f'Replied to {ctx.author.name} with: \n{reply_msg}')
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
             
     @bot.command()
     async def edit_subject_line(ctx, *subject_line):
@@ -852,7 +2460,7 @@ def main():
         '''
         
         subject_line = ' '.join(subject_line)
-        log_and_print(f'edit_subject_line(subject_line={subject_line}) was called')
+        log_and_print('edit_subject_line(subject_line=%s) was called', subject_line)
         # Read in the necessary variables from deci_config
         guild = str(ctx.guild.id)
         dcts = DeciConsts()
@@ -865,7 +2473,7 @@ def main():
         update_config_file(guilds_dir, guilds_conf)
         reply_msg = f'Subject line successfully switched to `{subject_line}`'
         await ctx.reply(reply_msg)
-        log_and_print(f'Replied to {ctx.author.name} with: \n{reply_msg}')
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
 
     @bot.command()
     async def edit_subject(ctx, *subject_line):
@@ -898,7 +2506,7 @@ def main():
                                     Defaults to 'DarkSlateGray'.
         '''
            
-        log_and_print(f'add_user(mention_user={mention_user}, name={name}, email={email}, colour={colour}) was called')
+        log_and_print('add_user(mention_user=%s, name=%s, email=%s, colour=%s) was called', mention_user, name, email, colour)
         
         dcts = DeciConsts()
         # Check for syntax errors
@@ -906,7 +2514,7 @@ def main():
             reply_msg = dcts.CMD_SYNTAX_ERR
             reply_msg += f'{dcts.COMMAND_PREFIX}add_user <@user> <Name> <Email> <Colour (optional)>'
             await ctx.reply(reply_msg)
-            log_and_print(f'Replied to {ctx.author.name} with: \n{reply_msg}')
+            log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
         
         # Validate html colour
         valid_col = await is_valid_html_colour(ctx, colour)
@@ -944,7 +2552,7 @@ def main():
             reply_msg = f'{mention_user} was successfully added to the mailing list!'
             
         await ctx.reply(reply_msg)
-        log_and_print(f'Replied to {ctx.author.name} with: \n{reply_msg}')
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
         
     @bot.command()
     async def add_me(ctx, name: str = None, email: str = None, colour: str = 'DarkSlateGray'):
@@ -968,7 +2576,7 @@ def main():
             reply_msg = dcts.CMD_SYNTAX_ERR
             reply_msg += f'{dcts.COMMAND_PREFIX}add_me <Name> <Email> <Colour (optional)>'
             await ctx.reply(reply_msg)
-            log_and_print(f'Replied to {ctx.author.name} with: \n{reply_msg}')
+            log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
         
         # Read in the necessary variables from deci_config
         deci_config = read_config_file(dcts.deci_config_dir)
@@ -989,12 +2597,123 @@ def main():
         if user_id in chain_users.index:
             reply_msg = f'{mention_user} is already on the mailing list. Use \n> {dcts.COMMAND_PREFIX}`edit_me` \nto edit your info.'
             await ctx.reply(reply_msg)
-            log_and_print(f'Replied to {ctx.author.name} with: \n{reply_msg}')
+            log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
             return
 
         # HTML colour is validated in add_user!
         await(add_user(ctx, mention_user, name, email, colour))
         
+    @bot.command(brief = 'Adds every user in an attached csv to the mailing list', hidden = True)
+    async def import_users(ctx):
+        '''
+        Adds every user in the attached csv to the mailing list
+        
+        The csv needs the columns `User_ID`, `Name` and `Email`, and optionally `Colour`.
+        `User_ID` can be either the ID of the user or a mention of the form `<@USER>`.
+        Every row is validated before anything is saved, and all valid rows are saved at once.
+        
+        Replies with a summary of the users that were added and the rows that were rejected
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+        '''
+        
+        log_and_print('import_users() was called')
+        
+        # Check for syntax errors
+        if len(ctx.message.attachments) != 1:
+            reply_msg = dcts.CMD_SYNTAX_ERR
+            reply_msg += f'{dcts.COMMAND_PREFIX}import_users (with a csv file attached)'
+            await ctx.reply(reply_msg)
+            log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
+            return
+        
+        # Read in the attached csv
+        try:
+            new_users = pd.read_csv(io.BytesIO(await ctx.message.attachments[0].read()), dtype = str)
+        except Exception as e:
+            await ctx.reply(f'ERROR: Could not read the attached csv.\n{e}')
+            return
+        new_users.columns = new_users.columns.str.strip()
+        missing_cols = {'User_ID', 'Name', 'Email'} - set(new_users.columns)
+        if missing_cols:
+            await ctx.reply(f'ERROR: The csv is missing the column(s): {", ".join(sorted(missing_cols))}')
+            return
+        if 'Colour' not in new_users.columns:
+            new_users['Colour'] = 'DarkSlateGray'
+        new_users = new_users[['User_ID', 'Name', 'Email', 'Colour']].copy()
+        new_users['Colour'] = new_users['Colour'].fillna('DarkSlateGray').str.strip()
+        new_users['Email'] = new_users['Email'].str.strip()
+        # Parsed as Python ints, since going through float64 would round 18 digit IDs
+        user_ids = new_users['User_ID'].fillna('').str.strip().str.strip('<@!>')
+        new_users['User_ID'] = pd.Series([int(i) if valid and int(i) < 2 ** 63 else None 
+                                          for i, valid in zip(user_ids, user_ids.str.fullmatch(r'\d+'))], 
+                                         index = new_users.index, dtype = object)
+        
+        # Read in the necessary variables from deci_config
+        deci_config = read_config_file(dcts.deci_config_dir)
+        chain_users_dir = deci_config['dir_paths']['chain_users_dir']
+        chain_users_idx_keys = deci_config["chain_users_idx_keys"]
+        srv_id = ctx.guild.id
+        chain_users_all = read_csv_set_idx(chain_users_dir, chain_users_idx_keys)
+        
+        # Validate every row at once, keeping the first reason a row is rejected
+        reasons = pd.Series('', index = new_users.index)
+        def reject(mask, reason):
+            reasons[mask & (reasons == '')] = reason
+        reject(new_users['User_ID'].isna(), 'invalid User_ID')
+        reject(new_users['Name'].isna(), 'missing Name')
+        reject(~new_users['Email'].fillna('').str.fullmatch(r'[^@\s<>]+@[^@\s<>]+\.[^@\s<>]+'), 'invalid Email')
+        reject(new_users['User_ID'].duplicated(keep = 'first'), 'duplicate User_ID in csv')
+        existing_ids = chain_users_all.index[chain_users_all.index.get_level_values('Server_ID') == srv_id].get_level_values('User_ID')
+        reject(new_users['User_ID'].isin(existing_ids), 'already on the mailing list')
+        invalid_colours = await WORKERS.run(INTERACTIVE, find_invalid_html_colours, new_users.loc[reasons == '', 'Colour'])
+        reject(new_users['Colour'].isin(invalid_colours), 'invalid Colour')
+        
+        # Save all the valid rows in one write
+        valid_users = new_users[reasons == ''].copy()
+        if len(valid_users) != 0:
+            valid_users['Server_ID'] = srv_id
+            valid_users['User_ID'] = valid_users['User_ID'].astype('int64')
+            valid_users = valid_users.set_index(chain_users_idx_keys)
+            chain_users_all = pd.concat([chain_users_all, valid_users])
+            chain_users_all.to_csv(chain_users_dir)
+        
+        # Reply with a summary
+        rejected = reasons[reasons != '']
+        reply_msg = f'Added {len(valid_users)} user(s) to the mailing list. Rejected {len(rejected)} row(s).\n'
+        for i, reason in list(rejected.items())[:20]:
+            reply_msg += f'- Row {i + 2}: {reason}\n'
+        if len(rejected) > 20:
+            reply_msg += f'...and {len(rejected) - 20} more\n'
+        await ctx.reply(reply_msg)
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
+        
+    @bot.command(brief = 'Sends the server\'s mailing list as a csv', hidden = True)
+    async def export_users(ctx):
+        '''
+        Replies with the server's mailing list as a csv file that can be used with import_users
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+        '''
+        
+        log_and_print('export_users() was called')
+        
+        # Read in the necessary variables from deci_config
+        deci_config = read_config_file(dcts.deci_config_dir)
+        chain_users_dir = deci_config['dir_paths']['chain_users_dir']
+        chain_users_idx_keys = deci_config["chain_users_idx_keys"]
+        srv_id = ctx.guild.id
+        chain_users_all = read_csv_set_idx(chain_users_dir, chain_users_idx_keys)
+        chain_users = chain_users_all[chain_users_all.index.get_level_values('Server_ID') == srv_id]
+        chain_users = chain_users.reset_index(level = 'Server_ID', drop = True)
+        
+        # Write the csv into memory and send it
+        fp = io.BytesIO(chain_users.to_csv().encode('utf-8'))
+        await ctx.reply(f'The mailing list has {len(chain_users)} user(s)', file = dc.File(fp, filename = f'chainUsers_{srv_id}.csv'))
+        log_and_print('Sent the mailing list of %s to %s', srv_id, ctx.author.name)
+        
     @bot.command(brief = 'Retrieves a user\'s mailing list info', hidden = True)
     async def get_user_info(ctx, mention_user):
         '''
@@ -1005,7 +2724,7 @@ def main():
             mention_user (str): A str representing a user mention in Discord of the form `<@USER>`
         '''
         
-        log_and_print(f'get_user_info(mention_user={mention_user}) was called')
+        log_and_print('get_user_info(mention_user=%s) was called', mention_user)
         
         # Read in the necessary variables from deci_config
         dcts = DeciConsts()
@@ -1029,7 +2748,7 @@ def main():
             reply_msg += f'> {dcts.COMMAND_PREFIX}`add_me <Name> <Email Address> <Colour (Optional)>`'
         
         await ctx.reply(reply_msg)
-        log_and_print(f'Replied to {ctx.author.name} with: \n{reply_msg}')
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
     
     @bot.command(brief = 'Retrieves the user\'s mailing list info')
     async def get_my_info(ctx):
@@ -1051,14 +2770,14 @@ def main():
             mention_user (str): A str representing a user mention in Discord of the form `<@USER>`
         '''
         
-        log_and_print(f'edit_user(mention_user={mention_user}) was called. The logging for this function is not comprehensive')
+        log_and_print('edit_user(mention_user=%s) was called. The logging for this function is not comprehensive', mention_user)
         
         # Check for syntax errors
         if mention_user is None:
             reply_msg = 'Invalid syntax error: The correct syntax for this command is\n'
             reply_msg += f'{dcts.COMMAND_PREFIX}edit_user <@user>'
             await ctx.reply(reply_msg)
-            log_and_print(f'Replied to {ctx.author.name} with: \n{reply_msg}')
+            log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
 
         # Read in the necessary variables from deci_config
         dcts = DeciConsts()
@@ -1090,7 +2809,7 @@ def main():
                 except BaseException as e:
                     if type(e) == asyncio.exceptions.TimeoutError:
                         await ctx.reply('Response timed out. Please enter the command again')
-                    log_and_print(f'Error: {e}')
+                    log_and_print('Error: %s', e)
                     return
                 
                 if selected_field in user_info_keys:
@@ -1099,7 +2818,7 @@ def main():
                     err_reply = f'ERROR: Unrecognized info field.\n{choices_msg}'
                     log_and_print(err_reply, level="error", terminal_print=True)
                     await ctx.reply(err_reply)
-                    log_and_print(f'user_response = {user_response}', terminal_print=True)
+                    log_and_print('user_response = %s', user_response, terminal_print=True)
             
             # Ask the user to edit the field
             await ctx.reply(f'Enter the value that you want your `{selected_field}` to change to:')
@@ -1111,7 +2830,7 @@ def main():
                 except BaseException as e:
                     if type(e) == asyncio.exceptions.TimeoutError:
                         await ctx.reply('Response timed out. Please enter the command again')
-                    log_and_print(f'Error: {e}')
+                    log_and_print('Error: %s', e)
                     return
                 
                 # If selected_field is Colour, then validate the entered value
@@ -1157,7 +2876,7 @@ def main():
             mention_user (str): A str representing a user mention in Discord of the form `<@USER>`
         '''
         
-        log_and_print(f'remove_user(mention_user={mention_user}) was called')
+        log_and_print('remove_user(mention_user=%s) was called', mention_user)
         
         # Read in the necessary variables from deci_config
         dcts = DeciConsts()
@@ -1180,7 +2899,7 @@ def main():
             reply_msg = f'User was not found in the mailing list!'
             
         await ctx.reply(reply_msg)
-        log_and_print(f'Replied to {ctx.author.name} with: \n{reply_msg}')
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
                
     @bot.command()
     async def remove_me(ctx):
@@ -1193,6 +2912,63 @@ def main():
         
         await remove_user(ctx, f'<@{ctx.author.id}>')
                
+    @bot.command(brief = 'Emails you an attachment that was too large for Discord')
+    async def get_attachment(ctx, att_id: str = None):
+        '''
+        Emails an attachment that was deferred because it was too large to upload to Discord
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+            att_id (str): The ID of the attachment given in the email's Discord message
+        '''
+        
+        log_and_print('get_attachment(att_id=%s) was called', att_id)
+        
+        # Check for syntax errors
+        if att_id is None:
+            reply_msg = dcts.CMD_SYNTAX_ERR
+            reply_msg += f'{dcts.COMMAND_PREFIX}get_attachment <Attachment ID>'
+            await ctx.reply(reply_msg)
+            log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
+            return
+        
+        # Read in the necessary variables from deci_config
+        deci_config = read_config_file(dcts.deci_config_dir)
+        deferred_atts = read_config_file(deci_config['dir_paths']['deferred_atts_dir'])
+        chain_users_dir = deci_config['dir_paths']['chain_users_dir']
+        chain_users_idx_keys = deci_config['chain_users_idx_keys']
+        chain_users_all = read_csv_set_idx(chain_users_dir, chain_users_idx_keys)
+        
+        # Check that the attachment exists, was delivered to this server and that the user is on its mailing list
+        if ctx.guild is None:
+            reply_msg = 'Use this command in the server that the email was posted in'
+        elif att_id not in deferred_atts or ctx.guild.id not in deferred_atts[att_id].get('srv_ids', []):
+            reply_msg = f'No deferred attachment with ID `{att_id}` was found'
+        elif (ctx.guild.id, ctx.author.id) not in chain_users_all.index:
+            reply_msg = 'You are not on the mailing list. To add yourself, use: \n'
+            reply_msg += f'> {dcts.COMMAND_PREFIX}`add_me <Name> <Email Address> <Colour (Optional)>`'
+        else:
+            # Stream the attachment from the mailbox, then email it to the user
+            att = deferred_atts[att_id]
+            part = BodyPart(att['section'], 'application', 'octet-stream', {}, att['encoding'], att['size'], 'attachment', {}, [])
+            att_path = os.path.join(deci_config['dir_paths']['em_atts_dir'], f'{att_id}_{att["filename"]}')
+            # The janitor deletes the file if it's left behind
+            with dcts.att_janitor.in_use(att_path):
+                imap_client = await dcts.init_imap_client()
+                try:
+                    with open(att_path, 'wb') as fp:
+                        await stream_section(imap_client, att['uid'], part, fp, deci_config.get('att_policy', {}).get('chunk_size', 1 << 20))
+                finally:
+                    await imap_client.logout()
+                user_email = chain_users_all.loc[(ctx.guild.id, ctx.author.id), 'Email']
+                # smtplib blocks, and the attachment is large, so send from a worker thread
+                await WORKERS.run(INTERACTIVE, send_email, [user_email], f'Attachment: {att["filename"]}', 
+                                  f'Here is the attachment {att["filename"]} you requested.', [att_path])
+            reply_msg = f'`{att["filename"]}` has been emailed to you!'
+            
+        await ctx.reply(reply_msg)
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
+               
     @bot.command()
     async def fetch_emails(ctx):
         '''
@@ -1202,43 +2978,163 @@ def main():
             ctx (Discord.Context): An object representing the message that called this command
         '''
         
-        # Set up the imap client
         log_and_print('fetch_emails() was called', terminal_print=True)
-        imap_client = await dcts.init_imap_client()
-        user = dcts.email_user
-        
-        # Read in the necessary variables from deci_config
-        deci_config = read_config_file(dcts.deci_config_dir)
-        max_uid_path = deci_config['dir_paths']['max_uid_path']
-                         
         try:
-            # Set the current max uid
-            persistent_max_uid = 1
-            with open(max_uid_path) as f:
-                persistent_max_uid = int(f.read())
-                log_and_print(f'persistent_max_uid = {persistent_max_uid}')
-            
-            # Call the email fetch function
-            persistent_max_uid = await fetch_email_messages(dcts, imap_client, persistent_max_uid)
-            log_and_print('%s starting idle' % user)
-            # idle_task = await imap_client.idle_start(timeout=60)
-            # log_and_print('idle_start() executed')
-            # await handle_server_push(await imap_client.wait_server_push())
-            # log_and_print('handle_server_push() executed')
-            # imap_client.idle_done()
-            # await wait_for(idle_task, timeout=5)
-            # log_and_print('%s ending idle' % user)
+            # In split mode the ingest process fetches them
+            if dcts.link is not None:
+                await dcts.link.call('fetch_emails', timeout = None)
+            else:
+                await fetch_new_emails(dcts)
             await ctx.reply('Emails successfully fetched!')
         except BaseException as e:
             await ctx.reply(f'Something went wrong... \n{e}')
         
         
+    @bot.command(brief = 'Starts or stops profiling the bot', hidden = True)
+    @commands.is_owner()
+    async def profile(ctx, action: str = None):
+        '''
+        Starts or stops profiling fetch_email_messages, on_message, send_email and send_email_as_disc_msg
+        
+        On stop, a `.pstats` file per function and a collapsed-stack file (for flame graphs) 
+        are written to the log directory. Only the bot's owner can use this command.
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+            action (str): `start`, `stop` or `status`
+        '''
+        
+        log_and_print('profile(action=%s) was called', action)
+        deci_config = read_config_file(dcts.deci_config_dir)
+        if action == 'start':
+            sample_interval = deci_config.get('profiling', {}).get('sample_interval')
+            if PROFILER.start(deci_config['dir_paths']['log_file_dir'], sample_interval):
+                reply_msg = 'Profiling started'
+            else:
+                reply_msg = 'Profiling is already running'
+        elif action == 'stop':
+            summary = PROFILER.summary()
+            paths = PROFILER.stop()
+            if paths:
+                reply_msg = 'Profiling stopped. Wrote:\n' + '\n'.join(f'`{path}`' for path in paths)
+                if summary:
+                    reply_msg += '\n```\n' + summary + '\n```'
+            else:
+                reply_msg = 'Profiling stopped. Nothing was profiled' if PROFILER.output_dir else 'Profiling isn\'t running'
+        elif action == 'status':
+            reply_msg = ('Profiling is running\n```\n' + (PROFILER.summary() or 'Nothing profiled yet') + '\n```'
+                         if PROFILER.running else 'Profiling isn\'t running')
+        else:
+            reply_msg = dcts.CMD_SYNTAX_ERR + f'{dcts.COMMAND_PREFIX}profile <start|stop|status>'
+        await ctx.reply(reply_msg)
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
+
+    @bot.before_invoke
+    async def start_command_timer(ctx):
+        ctx.started_at = time.perf_counter()
+    
+    @bot.after_invoke
+    async def record_command_latency(ctx):
+        if hasattr(ctx, 'started_at'):
+            CLASS_LATENCY[INTERACTIVE].add(time.perf_counter() - ctx.started_at)
+    
+    @bot.command(brief = 'Replies with how long commands and email deliveries wait for capacity', hidden = True)
+    async def scheduler_stats(ctx):
+        '''
+        Replies with the number, latency and waits for Discord call and worker slots of 
+        interactive work (commands) and bulk work (delivering emails)
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+        '''
+        
+        log_and_print('scheduler_stats() was called')
+        processes = {'': get_scheduler_stats()}
+        # In split mode the emails are forwarded by the ingest process
+        if dcts.link is not None:
+            try:
+                processes['ingest '] = await dcts.link.call('scheduler_stats')
+            except ConnectionError as e:
+                log_and_print('Could not reach the ingest process: %s', e, level='warning')
+        reply_msg = '```\n                           count  mean(s)  p95(s)  max(s)  run  wait\n'
+        for prefix, stats in processes.items():
+            for kind in ['latency', 'discord', 'workers']:
+                for cls, m in stats[kind].items():
+                    name = f'{prefix}{kind} {cls}'
+                    reply_msg += (f'{name:<26} {m["count"]:>6} {m["mean_s"]:>8.3f} {m["p95_s"]:>7.3f} {m["max_s"]:>7.3f} '
+                                  f'{m.get("running", ""):>4} {m.get("waiting", ""):>5}\n')
+        reply_msg += '```'
+        await ctx.reply(reply_msg)
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
+    
+    @bot.command(brief = 'Replies with how much disk the attachments use and what the janitor reclaimed', hidden = True)
+    async def storage_stats(ctx):
+        '''
+        Replies with the disk used by the attachment directories and the bytes the attachment 
+        janitor has reclaimed since the bot started
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+        '''
+        
+        log_and_print('storage_stats() was called')
+        # In split mode the janitor runs in the ingest process
+        if dcts.link is not None:
+            try:
+                stats = await dcts.link.call('storage_stats')
+            except ConnectionError as e:
+                stats = None
+                reply_msg = f'Could not reach the ingest process: {e}'
+        else:
+            stats = dcts.att_janitor.stats()
+        if stats is not None:
+            last = stats['last_sweep']
+            reply_msg = f'Sweeps: {stats["sweeps"]}, reclaimed {format_size(stats["reclaimed_bytes"])} '
+            reply_msg += f'({format_size(stats["evicted_bytes"])} evicted, {format_size(stats["orphan_bytes"])} in '
+            reply_msg += f'{stats["orphan_files"]} orphaned files, {format_size(stats["cache_bytes"])} of cache, '
+            reply_msg += f'{format_size(stats["linked_bytes"])} of expired links)'
+            if last:
+                reply_msg += f'\nIn use: {format_size(last["total_bytes"])} of {format_size(last["max_bytes"])}'
+        await ctx.reply(reply_msg)
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
+    
+    @bot.command(brief = 'Replies with the queue depth and timings of each email ingest stage', hidden = True)
+    async def pipeline_stats(ctx):
+        '''
+        Replies with the queue depth, number of emails and time per email of each stage of the
+        email ingest pipeline since the bot started
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+        '''
+        
+        log_and_print('pipeline_stats() was called')
+        # In split mode the pipeline runs in the ingest process
+        if dcts.link is not None:
+            try:
+                stats = await dcts.link.call('pipeline_stats')
+            except ConnectionError as e:
+                stats = None
+                reply_msg = f'Could not reach the ingest process: {e}'
+        else:
+            stats = {name: metrics.as_dict() for name, metrics in INGEST_METRICS.items()}
+        if stats == {}:
+            reply_msg = 'No emails have been through the pipeline yet'
+        elif stats is not None:
+            reply_msg = '```\nstage              queue  busy   done  drop  fail  mean(s)  max(s)\n'
+            for name, m in stats.items():
+                reply_msg += (f'{name:<18} {m["queue_depth"]:>5} {m["in_flight"]:>5} {m["processed"]:>6} {m["dropped"]:>5} '
+                              f'{m["failed"]:>5} {m["mean_s"]:>8.3f} {m["max_s"]:>7.3f}\n')
+            reply_msg += '```'
+        await ctx.reply(reply_msg)
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
+
     @bot.event
     async def on_ready():
         '''
         This function executes when turned on if it was off before
         '''
-        log_and_print(f'Logged in as {bot.user}', terminal_print=True)
+        log_and_print('Logged in as %s', bot.user, terminal_print=True)
 
     ''' Above code is equivalent to:
     async def on_ready():
@@ -1247,6 +3143,50 @@ def main():
     on_ready = bot.event(on_ready)
     '''
 
+    @bot.event
+    async def on_shard_ready(shard_id):
+        '''
+        This function executes when a shard has connected (only if the bot is sharded)
+        '''
+        log_and_print('Shard %s is ready', shard_id, terminal_print=True)
+        shard_ready_event(shard_id).set()
+
+    @bot.event
+    async def on_shard_resumed(shard_id):
+        '''
+        This function executes when a shard has resumed its session after reconnecting
+        '''
+        log_and_print('Shard %s resumed', shard_id)
+        shard_ready_event(shard_id).set()
+
+    @bot.event
+    async def on_shard_disconnect(shard_id):
+        '''
+        This function executes when a shard has lost its connection to Discord
+        '''
+        log_and_print('Shard %s disconnected', shard_id, level='warning')
+        shard_ready_event(shard_id, False).clear()
+
+    @bot.command(brief = 'Replies with the bot\'s latency')
+    async def latency(ctx):
+        '''
+        Replies with the gateway latency of the bot, per shard if the bot is sharded
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+        '''
+        
+        log_and_print('latency() was called')
+        if isinstance(bot, commands.AutoShardedBot):
+            reply_msg = ''
+            for shard_id, shard_latency in bot.latencies:
+                marker = ' (this server)' if ctx.guild is not None and ctx.guild.shard_id == shard_id else ''
+                reply_msg += f'Shard {shard_id}: {shard_latency * 1000:.0f} ms{marker}\n'
+        else:
+            reply_msg = f'Latency: {bot.latency * 1000:.0f} ms'
+        await ctx.reply(reply_msg)
+        log_and_print('Replied to %s with: \n%s', ctx.author.name, reply_msg)
+
     @bot.event
     async def on_guild_join(guild):
         '''
@@ -1265,11 +3205,13 @@ def main():
         guild_info = {
             'name': guild.name,
             'email_channel': None,
-            'currentSubject': None
+            'currentSubject': None,
+            'email_aliases': [],
+            'subject_tag': None
         }
         guilds_conf[guild_id] = guild_info
         update_config_file(guilds_dir, guilds_conf)
-        log_and_print(f'Added to `{guild.name}`')
+        log_and_print('Added to `%s`', guild.name)
         
     @bot.event
     async def on_guild_remove(guild):
@@ -1297,9 +3239,10 @@ def main():
         chain_users_all = chain_users_all.drop(index = guild.id, level = 0)
         chain_users_all.to_csv(chain_users_dir)
         
-        log_and_print(f'Removed from `{popped_guild_name}`')
+        log_and_print('Removed from `%s`', popped_guild_name)
                     
     @bot.event
+    @profiled()
     async def on_message(message: dc.Message):
         '''
         This function executes when a message is received
@@ -1320,7 +3263,6 @@ def main():
         guilds_dir = deci_config['dir_paths']['guilds_dir']
         guilds_conf = read_config_file(guilds_dir)
         email_channel = guilds_conf[guild]["email_channel"]
-        email_attachments_dir = deci_config['dir_paths']['em_atts_dir']
         subject = guilds_conf[guild]["currentSubject"]
         chain_users_dir = deci_config["dir_paths"]["chain_users_dir"]
         chain_users_idx_keys = deci_config["chain_users_idx_keys"]
@@ -1328,7 +3270,7 @@ def main():
         # If email_channel is None, prompt user to add an email_channel
         if email_channel is None:
             if message.content.startswith(dcts.COMMAND_PREFIX):
-                await bot.process_commands(message)
+                await process_commands(bot, message)
             else:
                 msg_re = 'No channel is set for email communications. Please set a channel using\n'
                 msg_re += f'> {dcts.COMMAND_PREFIX}`set_channel <#channel>`'
@@ -1351,7 +3293,7 @@ def main():
                 msg_re += 'I recommend that you use another channel since most messages that are sent here\n'
                 msg_re += 'will be sent to the email chain!'
                 await message.reply(msg_re)
-            await bot.process_commands(message)
+            await process_commands(bot, message)
             return
         
         # Read in the chain_users dataframe
@@ -1383,16 +3325,13 @@ def main():
                 await message.reply(msg_re)
                 return
 
-            # If attachments are present, save them
-            disc_atts = []
-            for i in message.attachments:
-                ext_idx = i.filename.find('.')
-                file_extension = i.filename[ext_idx:]
-                filename = f'{email_attachments_dir}/{message.channel.name}_{i.id}{file_extension}'
-                with open(filename, mode = 'wb') as fp:
-                    await i.save(fp)
-                    log_and_print(f'Downloaded to {filename}')
-                disc_atts.append(filename)
+            # If attachments are present, download them all at once. Ones that don't fit in the email are linked to instead
+            disc_atts, att_links = await download_disc_attachments(message.attachments, deci_config.get('att_policy', {}))
+            # Shrink large images before they're attached
+            transformer = dcts.image_transformer
+            if transformer.enabled:
+                disc_atts = [await WORKERS.run(INTERACTIVE, transformer.transform_file, filename, fp) 
+                             for filename, fp in disc_atts]
             
             # Convert message to html format
             msg_raw = message.content
@@ -1430,14 +3369,153 @@ def main():
             author_colour = chain_users.loc[message.author.id, 'Colour']
             email_body = f'''<strong>New message from <span style="text-decoration: underline;">{author_name}</span>: </strong> <br /> <br />'''
             email_body += f'<p style="color:{author_colour};">{msg_raw}</p>'
-            confirm_msg = send_disc_msg_as_email(message, dcts, subject, email_body, disc_atts)
+            if att_links:
+                email_body += '<p>' + '<br />'.join(att_links) + '</p>'
+            
+            # Thread the email under the email that the message replies to, or the latest one with the same subject
+            thread_index = dcts.thread_index
+            reply_to_id = message.reference.message_id if message.reference is not None else None
+            parent = thread_index.find_email_parent(reply_to_id, message.channel.id, subject)
+            email_headers = ThreadIndex.reply_headers(parent)
+            email_headers['Message-ID'] = make_msgid(domain = dcts.email_user.split('@')[-1])
+            # smtplib blocks, so send from a worker thread to keep the Discord connection responsive
+            confirm_msg = await WORKERS.run(INTERACTIVE, send_disc_msg_as_email, message, dcts, subject, email_body, 
+                                            disc_atts, headers = email_headers)
+            thread_index.add(email_headers['Message-ID'], message.guild.id, message.channel.id, message.id, 
+                             email_headers.get('References', ''), subject)
             await message.reply(confirm_msg)
             await message.add_reaction('\N{INCOMING ENVELOPE}')
             print('')
         else:
-            log_and_print(f'Message detected in the restricted channel: {channel_sent_from}')
+            log_and_print('Message detected in the restricted channel: %s', channel_sent_from)
         
-        await bot.process_commands(message)
+        await process_commands(bot, message)
+    # Discord commands ^^^
+    
+    return bot
+
+def run_process(role: str) -> None:
+    '''
+    Runs one of the two processes of split mode. The processes talk over the Unix socket at 
+    `socket_path` in the `split` section of deci_config (see ipclink).
+    
+    - bot: The Discord bot. Posts the emails that the ingest process sends it.
+    - ingest: Listens for emails and renders and forwards them. Sends them to the bot process 
+              to be posted, and answers the bot's `fetch_emails` and `pipeline_stats` commands.
+    
+    The process exits if its main task stops, so supervise() can restart it.
+
+    Args:
+        role (str): `bot` or `ingest`
+    '''
+    
+    dcts = DeciConsts(True)
+    loop = get_event_loop()
+    deci_config = read_config_file(dcts.deci_config_dir)
+    split_conf = deci_config.get('split', {})
+    configure_logging(deci_config["dir_paths"]["log_file_dir"], deci_config.get('logging', {}), f'deci_{role}')
+    configure_scheduling(deci_config)
+    
+    # Keep each process on its own cores if asked to
+    cpus = split_conf.get('cpu_affinity', {}).get(role)
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    
+    profiling_conf = deci_config.get('profiling', {})
+    if profiling_conf.get('enabled', False):
+        PROFILER.start(os.path.join(deci_config["dir_paths"]["log_file_dir"], role), profiling_conf.get('sample_interval'))
+        atexit.register(PROFILER.stop)
+    
+    socket_path = split_conf.get('socket_path', 'DynamicMemoryFiles/deci.sock')
+    log_and_print('Starting the %s process (pid %s)', role, os.getpid(), terminal_print=True)
+    if role == 'bot':
+        async def post(rendered: dict, guild_id: int, sent: int = 0) -> dict:
+            # How far it got is sent back even if posting fails, so the ingest process can carry on from there
+            progress = {'sent': sent}
+            try:
+                await post_rendered_email(dcts, rendered, guild_id, progress)
+            except Exception as e:
+                return dict(progress, error = f'{type(e).__name__}: {e}')
+            return progress
+        
+        dcts.link = Link({'post': post})
+        register_handlers(dcts)
+        loop.run_until_complete(dcts.link.serve(socket_path))
+        loop.run_until_complete(dcts.bot.start(dcts.bot_token))
+    elif role == 'ingest':
+        async def fetch_emails():
+            await fetch_new_emails(dcts)
+        
+        async def pipeline_stats():
+            return {name: metrics.as_dict() for name, metrics in INGEST_METRICS.items()}
+        
+        async def scheduler_stats():
+            return get_scheduler_stats()
+        
+        async def storage_stats():
+            return dcts.att_janitor.stats()
+        
+        dcts.link = Link({'fetch_emails': fetch_emails, 'pipeline_stats': pipeline_stats, 'scheduler_stats': scheduler_stats, 
+                          'storage_stats': storage_stats})
+        asyncio.ensure_future(dcts.link.connect(socket_path))
+        asyncio.ensure_future(janitor_loop(dcts))
+        loop.run_until_complete(imap_loop(dcts))
+    else:
+        raise ValueError(f'Unknown process role: {role}')
+
+def supervise() -> None:
+    '''
+    Runs the bot in split mode: the Discord bot and the email ingester as two processes (see 
+    run_process()), each restarted on its own whenever it exits. A process that exits within 
+    a minute of starting waits twice as long before the next restart, up to 5 minutes.
+    '''
+    
+    # Ask for any missing credentials once and pass them on to both processes
+    dcts = DeciConsts(True)
+    loop = get_event_loop()
+    loop.run_until_complete(check_repair_config_files(dcts))
+    deci_config = read_config_file(dcts.deci_config_dir)
+    configure_logging(deci_config["dir_paths"]["log_file_dir"], deci_config.get('logging', {}), 'deci_supervisor')
+    restart_delay = deci_config.get('split', {}).get('restart_delay', 5)
+    env = dict(os.environ, DC_EMAIL_ADDR = dcts.email_user, DC_EMAIL_PASS = dcts.email_pass, DISCORD_BOT = dcts.bot_token)
+    
+    async def keep_running(role: str):
+        delay = restart_delay
+        while True:
+            started = time.monotonic()
+            process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), role, env = env)
+            return_code = await process.wait()
+            delay = min(delay * 2, 300) if time.monotonic() - started < 60 else restart_delay
+            log_and_print('The %s process exited with code %s, restarting it in %s s', role, return_code, delay, 
+                          level='warning', terminal_print=True)
+            await asyncio.sleep(delay)
+    
+    loop.run_until_complete(asyncio.gather(keep_running('bot'), keep_running('ingest')))
+
+def main():    
+    # Initialize the global constants and the bot
+    dcts = DeciConsts(True)
+    bot = dcts.bot
+    bot_token = dcts.bot_token
+    
+    # Repair files
+    tasks = [asyncio.ensure_future(check_repair_config_files(dcts)),] # Create required files if they don't exist
+    loop = get_event_loop()
+    loop.run_until_complete(asyncio.wait(tasks))
+    
+    # Configure logging
+    deci_config = read_config_file(dcts.deci_config_dir)
+    configure_logging(deci_config["dir_paths"]["log_file_dir"], deci_config.get('logging', {}))
+    configure_scheduling(deci_config)
+    
+    # Profile the hot paths from startup if asked to
+    profiling_conf = deci_config.get('profiling', {})
+    if profiling_conf.get('enabled', False):
+        PROFILER.start(deci_config["dir_paths"]["log_file_dir"], profiling_conf.get('sample_interval'))
+        atexit.register(PROFILER.stop)
+    
+    # Register the Discord commands and events
+    register_handlers(dcts)
     
     # Read in the necessary variables from deci_config
     deci_config = read_config_file(dcts.deci_config_dir)
@@ -1445,11 +3523,18 @@ def main():
     tasks = [
         # asyncio.ensure_future(imap_loop(dcts, imap_host, dcts.email_user, dcts.email_pass)), # Email Listener Task
         asyncio.ensure_future(imap_loop(dcts)), # Email Listener Task
+        asyncio.ensure_future(janitor_loop(dcts)), # Attachment Cleanup Task
         asyncio.ensure_future(dcts.bot.start(bot_token)) # Discord Bot Task
     ]
     loop = get_event_loop()
     loop.run_until_complete(asyncio.wait(tasks))
-    # Discord commands ^^^
     
 if __name__ == '__main__':        
-    main()
+    if sys.argv[1:2] == ['replay']:
+        replay(sys.argv[2:])
+    elif sys.argv[1:2] == ['split']:
+        supervise()
+    elif sys.argv[1:2] in [['bot'], ['ingest']]:
+        run_process(sys.argv[1])
+    else:
+        main()
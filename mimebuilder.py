@@ -0,0 +1,130 @@
+'''
+Builds an outgoing email's MIME parts once so they can be sent in several envelopes.
+
+The body and every attachment are read, encoded and serialized to bytes a single time.
+Each envelope (different recipients, subject or extra headers) only adds its own headers
+and the multipart boundaries around the shared, already encoded parts.
+
+Run this file directly to check that attachments with non-ASCII filenames can be built:
+
+    python mimebuilder.py
+'''
+
+import io
+import os
+import secrets
+from email.generator import BytesGenerator
+from email.mime.application import MIMEApplication
+from email.mime.text import MIMEText
+from email.policy import SMTP
+from email.utils import formatdate
+
+
+def _serialize(part) -> bytes:
+    '''
+    Serializes a MIME part (headers and encoded body) to bytes with CRLF line endings
+    '''
+
+    buf = io.BytesIO()
+    BytesGenerator(buf, mangle_from_=False, policy=SMTP).flatten(part)
+    return buf.getvalue()
+
+def text_part(body: str, subtype: str = 'html') -> bytes:
+    '''
+    Encodes body as a serialized text part
+
+    Args:
+        body (str): The text of the part
+        subtype (str, optional): The text subtype. Defaults to 'html'.
+
+    Returns:
+        bytes: The serialized part
+    '''
+
+    return _serialize(MIMEText(body, subtype, 'utf-8'))
+
+
+class PreparedEmail:
+    '''
+    An email body and attachments that have been encoded once, ready to be sent many times
+
+    Attributes:
+        `body_part`: The serialized body part
+        `att_parts`: The serialized attachment parts
+    '''
+
+    def __init__(self, body: str, attachments: list = None, subtype: str = 'html'):
+        '''
+        Encodes the body and reads and encodes every attachment
+
+        Args:
+            body (str): Body of the email
+            attachments (list, optional): File paths of the attachments, or (filename, bytes or 
+                                          binary file object) tuples. Defaults to None.
+            subtype (str, optional): The text subtype of the body. Defaults to 'html'.
+        '''
+
+        self.body_part = text_part(body, subtype)
+        self.att_parts = []
+        for f in attachments or []:
+            if isinstance(f, tuple):
+                # Already downloaded into memory or a temporary file
+                name, data = f
+                part = MIMEApplication(data.read() if hasattr(data, 'read') else data, Name=name)
+            else:
+                name = os.path.basename(f)
+                with open(f, 'rb') as fil:
+                    part = MIMEApplication(fil.read(), Name=name)
+            # After the file is closed. add_header() encodes non-ASCII names as in RFC 2231
+            part.add_header('Content-Disposition', 'attachment', filename=name)
+            self.att_parts.append(_serialize(part))
+
+    def envelope(self, from_addr: str, to_addrs: list, subject: str, headers: dict = None,
+                 with_attachments: bool = True, prefix_parts: list = None) -> bytes:
+        '''
+        Wraps the shared parts in the headers of one envelope
+
+        Args:
+            from_addr (str): The sender of the email
+            to_addrs (list): The recipients of the email
+            subject (str): Subject of the email
+            headers (dict, optional): Extra headers. E.g. `Message-ID`, `In-Reply-To`. Defaults to None.
+            with_attachments (bool, optional): Whether to include the attachments. Defaults to True.
+            prefix_parts (list, optional): Serialized parts to put before the body, from text_part().
+                                           Defaults to None.
+
+        Returns:
+            bytes: The complete email, ready for SMTP
+        '''
+
+        parts = list(prefix_parts or []) + [self.body_part]
+        if with_attachments:
+            parts += self.att_parts
+
+        # Pick a boundary that doesn't appear in any of the parts
+        boundary = '=' * 15 + secrets.token_hex(16)
+        while any(boundary.encode() in p for p in parts):
+            boundary = '=' * 15 + secrets.token_hex(16)
+
+        hdrs = [('From', from_addr), ('To', ', '.join(to_addrs)), ('Subject', subject),
+                ('Date', formatdate(localtime=True))]
+        hdrs += list((headers or {}).items())
+        hdrs += [('MIME-Version', '1.0'), ('Content-Type', f'multipart/mixed; boundary="{boundary}"')]
+
+        delimiter = b'--' + boundary.encode()
+        out = [SMTP.header_factory(k, v).fold(policy=SMTP).encode('ascii') for k, v in hdrs] + [b'\r\n']
+        for p in parts:
+            out += [delimiter, b'\r\n', p, b'\r\n']
+        out += [delimiter, b'--\r\n']
+        return b''.join(out)
+
+
+if __name__ == '__main__':
+    import sys
+    from email import message_from_bytes
+
+    name = 'Résumé ü.pdf'
+    raw = PreparedEmail('<p>hi</p>', [(name, b'%PDF-1.4')]).envelope('a@example.com', ['b@example.com'], 'Test')
+    names = [part.get_filename() for part in message_from_bytes(raw).walk() if part.get_filename()]
+    print(f'Attachment filenames: {names}')
+    sys.exit(0 if names == [name] else 1)
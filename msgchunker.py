@@ -0,0 +1,113 @@
+'''
+Splits long Discord messages into chunks that fit under Discord's message length limit.
+
+Chunks are split on paragraph, then line, then word boundaries. Formatting that is still
+open at the end of a chunk is closed there and reopened at the start of the next chunk,
+so code blocks, `> ` quotes and `**`/`__`/`~~`/`||` spans render the same as they would
+have in a single message. Single `*`/`_` italics are left alone since underscores are
+too common in names and email addresses to track reliably.
+'''
+
+import re
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+_FENCE_RE = re.compile(r'^(?:> )?```(\S*)', re.M)
+_INLINE_CODE_RE = re.compile(r'`[^`\n]*`')
+_SPAN_MARKERS = ['**', '__', '~~', '||']
+_SPAN_RE = re.compile('|'.join(re.escape(m) for m in _SPAN_MARKERS))
+
+# Room kept free in every chunk for the markers that close it
+_CLOSING_RESERVE = 4 + 2 * len(_SPAN_MARKERS)
+
+
+def _open_state(text: str) -> tuple:
+    '''
+    Finds the formatting that is still open at the end of text
+
+    Returns:
+        tuple: (Language of the open code block or None, list of open span markers)
+    '''
+
+    fence_lang = None
+    in_fence = False
+    outside_code = []
+    pos = 0
+    for match in _FENCE_RE.finditer(text):
+        if not in_fence:
+            outside_code.append(text[pos:match.start()])
+            fence_lang = match.group(1)
+        in_fence = not in_fence
+        pos = match.end()
+    if not in_fence:
+        outside_code.append(text[pos:])
+
+    open_spans = []
+    for marker in _SPAN_RE.findall(_INLINE_CODE_RE.sub('', ''.join(outside_code))):
+        if marker in open_spans:
+            open_spans.remove(marker)
+        else:
+            open_spans.append(marker)
+
+    return (fence_lang if in_fence else None), open_spans
+
+def _split_point(text: str, budget: int) -> tuple:
+    '''
+    Finds the best place to split text so that the first part is at most budget long
+
+    Returns:
+        tuple: (Length of the first part, length of the separator to drop)
+    '''
+
+    window = text[:budget + 1]
+    for sep in ['\n\n', '\n', ' ']:
+        idx = window.rfind(sep, 0, budget + 1)
+        # Don't split so early that the chunk is mostly empty
+        if idx > budget // 4:
+            return idx, len(sep)
+    return budget, 0
+
+def chunk_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> list:
+    '''
+    Splits text into chunks of at most limit characters
+
+    Args:
+        text (str): The Discord message (markdown)
+        limit (int, optional): Maximum length of a chunk. Defaults to 2000.
+
+    Returns:
+        list: The chunks, in order
+    '''
+
+    chunks = []
+    reopen = ''
+    remaining = text
+    while remaining:
+        if len(reopen) + len(remaining) <= limit:
+            chunks.append(reopen + remaining)
+            break
+
+        budget = max(limit - len(reopen) - _CLOSING_RESERVE, 1)
+        cut, sep_len = _split_point(remaining, budget)
+        body = remaining[:cut]
+        remaining = remaining[cut + sep_len:]
+        chunk = reopen + body
+
+        # Close whatever is still open and carry it over to the next chunk
+        fence_lang, open_spans = _open_state(chunk)
+        last_line = chunk[chunk.rfind('\n') + 1:]
+        quote = '> ' if last_line.startswith('>') and sep_len != 2 and not remaining.startswith('>') else ''
+        if fence_lang is not None:
+            in_quote = '> ' if last_line.startswith('>') else ''
+            closing = f'\n{in_quote}```'
+            reopen = f'{in_quote}```{fence_lang}\n{quote}'
+        else:
+            closing = ''.join(reversed(open_spans))
+            reopen = quote + ''.join(open_spans)
+            # Spans have to be reopened after the quote prefix of the next line
+            if not quote and remaining.startswith('> '):
+                remaining = '> ' + reopen + remaining[2:]
+                reopen = ''
+        chunks.append(chunk + closing)
+
+    return chunks
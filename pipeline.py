@@ -0,0 +1,185 @@
+'''
+A chain of asyncio stages connected by bounded queues.
+
+Each stage runs its own pool of workers, so a slow stage can be given more workers
+without changing the others, and a slow stage never blocks the stages before it for
+longer than it takes to fill its queue. Once a queue is full, putting more items into
+the pipeline waits, which keeps memory bounded however many items are pending.
+
+Every stage keeps metrics (queue depth, items processed, dropped and failed, and the
+time spent per item) to show which stage to scale.
+'''
+
+import asyncio
+import time
+
+
+class StageMetrics:
+    '''
+    Counters for one stage of a pipeline
+
+    Attributes:
+        `processed`: Number of items the stage passed on
+        `dropped`: Number of items the stage filtered out
+        `failed`: Number of items the stage raised an exception for
+        `busy_s`: Total seconds spent processing items
+        `max_s`: Longest time spent on one item
+    '''
+
+    def __init__(self):
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.busy_s = 0.0
+        self.max_s = 0.0
+        self.queue_depth = 0
+        self.in_flight = 0
+
+    def add(self, elapsed: float, outcome: str) -> None:
+        '''
+        Records one processed item
+        '''
+
+        setattr(self, outcome, getattr(self, outcome) + 1)
+        self.busy_s += elapsed
+        self.max_s = max(self.max_s, elapsed)
+
+    def as_dict(self) -> dict:
+        '''
+        Returns the metrics, including the mean time per item
+        '''
+
+        count = self.processed + self.dropped + self.failed
+        return {
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'mean_s': self.busy_s / count if count else 0.0,
+            'max_s': self.max_s,
+            'busy_s': self.busy_s
+        }
+
+
+class Stage:
+    '''
+    One step of a pipeline
+
+    Attributes:
+        `name`: Name of the stage, used in the metrics
+        `func`: Coroutine function taking an item and returning the item to pass on,
+                or None to drop it
+        `concurrency`: Number of workers
+        `queue_size`: Maximum number of items waiting for the stage
+    '''
+
+    def __init__(self, name: str, func, concurrency: int = 1, queue_size: int = None):
+        self.name = name
+        self.func = func
+        self.concurrency = max(int(concurrency), 1)
+        self.queue_size = queue_size if queue_size is not None else 2 * self.concurrency
+
+
+class Pipeline:
+    '''
+    Runs items through a list of stages, each with its own bounded input queue
+    '''
+
+    def __init__(self, stages: list, on_error=None, metrics: dict = None):
+        '''
+        Creates the pipeline. Call start() before putting items in.
+
+        Args:
+            stages (list): The Stages, in order
+            on_error (Callable, optional): Called with (stage name, item, exception) when a
+                                           stage raises. The item is dropped. Defaults to None.
+            metrics (dict, optional): StageMetrics by stage name to add to, so metrics can be
+                                      kept across runs. Defaults to None.
+        '''
+
+        self.stages = stages
+        self.on_error = on_error
+        self.metrics = metrics if metrics is not None else {}
+        for stage in stages:
+            self.metrics.setdefault(stage.name, StageMetrics())
+        self._queues = []
+        self._workers = []
+
+    def start(self) -> None:
+        '''
+        Starts the workers of every stage
+        '''
+
+        self._queues = [asyncio.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        for i, stage in enumerate(self.stages):
+            for _ in range(stage.concurrency):
+                self._workers.append(asyncio.ensure_future(self._work(i)))
+
+    async def put(self, item) -> None:
+        '''
+        Puts an item into the first stage, waiting while its queue is full
+        '''
+
+        await self._queues[0].put(item)
+        self.metrics[self.stages[0].name].queue_depth = self._queues[0].qsize()
+
+    async def join(self) -> None:
+        '''
+        Waits until every item put in so far has been through every stage, then stops the workers
+        '''
+
+        for queue in self._queues:
+            await queue.join()
+        await self.cancel()
+
+    async def cancel(self) -> None:
+        '''
+        Stops the workers without waiting for the queues to empty
+        '''
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _work(self, index: int) -> None:
+        '''
+        Worker loop of stage index
+        '''
+
+        stage = self.stages[index]
+        queue = self._queues[index]
+        metrics = self.metrics[stage.name]
+        next_queue = self._queues[index + 1] if index + 1 < len(self._queues) else None
+        while True:
+            item = await queue.get()
+            metrics.queue_depth = queue.qsize()
+            metrics.in_flight += 1
+            start = time.perf_counter()
+            try:
+                result = await stage.func(item)
+                outcome = 'dropped' if result is None else 'processed'
+            except Exception as e:
+                result, outcome = None, 'failed'
+                if self.on_error is not None:
+                    self.on_error(stage.name, item, e)
+            finally:
+                metrics.in_flight -= 1
+            metrics.add(time.perf_counter() - start, outcome)
+            try:
+                if result is not None and next_queue is not None:
+                    # Waits here while the next stage is backed up
+                    await next_queue.put(result)
+                    self.metrics[self.stages[index + 1].name].queue_depth = next_queue.qsize()
+            finally:
+                queue.task_done()
+
+    def stats(self) -> dict:
+        '''
+        Returns the metrics of each stage, in order
+        '''
+
+        for stage, queue in zip(self.stages, self._queues):
+            self.metrics[stage.name].queue_depth = queue.qsize()
+        return {stage.name: self.metrics[stage.name].as_dict() for stage in self.stages}
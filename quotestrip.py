@@ -0,0 +1,224 @@
+'''
+Removes the quoted history that mail clients append to replies, so that only the new
+part of each email is posted to Discord and forwarded to the mailing list.
+
+All client patterns are combined into a single precompiled regex, so each body is
+scanned once and cut at the first place any client's quote starts. Whether a body ends in
+a block of ">" quoted lines is worked out with one backward scan over its lines.
+
+Run this file directly to check the patterns against the labelled corpus in
+quote_corpus.json, and time them:
+
+    python quotestrip.py [path/to/quote_corpus.json]
+'''
+
+import json
+import re
+import sys
+import time
+
+# Where quoted history starts in plain text or markdown bodies, per client
+TEXT_QUOTE_PATTERNS = {
+    # Gmail, Apple Mail, Thunderbird: "On Mon, 1 Jan 2024 at 10:00, Name <a@b.c> wrote:".
+    # Checked by _attribution_ends_body, since only the quoted lines may follow it.
+    'on_wrote': r'^[ \t]*(?:\*\*|__)?On\b[^\n]{0,300}?(?:\n[^\n]{0,300}?)?\bwrote:(?:\*\*|__)?[ \t\r]*$',
+    # Localized versions of the above
+    'on_wrote_fr': r'^[ \t]*Le\b[^\n]{0,300}?(?:\n[^\n]{0,300}?)?\ba écrit[ \t]?:[ \t\r]*$',
+    'on_wrote_de': r'^[ \t]*Am\b[^\n]{0,300}?(?:\n[^\n]{0,300}?)?\bschrieb[^\n]{0,100}:[ \t\r]*$',
+    # Outlook desktop and web: "From: ... Sent: ..." header block, optionally after a rule
+    'outlook_header': r'^[ \t]*(?:_{5,}[ \t\r]*\n\s*)?(?:\*\*|__)?From:(?:\*\*|__)?[ \t]+[^\n]+\n(?:[^\n]*\n){0,3}?[ \t]*(?:\*\*|__)?(?:Sent|Date):(?:\*\*|__)?[ \t]',
+    'original_message': r'^[ \t]*-{2,}[ \t]*Original Message[ \t]*-{2,}',
+    # Mobile signatures
+    'mobile_signature': (r'^[ \t]*(?:Sent from my (?:iPhone|iPad|Android|Samsung|Galaxy|BlackBerry|mobile)'
+                         r'|Get Outlook for (?:Android|iOS)'
+                         r'|Sent from (?:Yahoo Mail|Mail for Windows|Outlook for (?:Android|iOS)))\b'),
+}
+# A block of ">" quoted lines that runs to the end of the body is found by _quoted_tail_start
+
+# Where quoted history starts in html bodies. The raw (quoted-printable) html can have `=3D` for `=`
+_EQ = r'(?:=3D|=)'
+HTML_QUOTE_PATTERNS = {
+    'outlook_div': rf'(?:<hr[^>]*>\s*)?<div[^>]*\bid{_EQ}["\']?(?:divRplyFwdMsg|appendonsend)\b',
+    'gmail_quote': rf'<div[^>]*\bclass{_EQ}["\']?gmail_quote\b',
+    'yahoo_quote': rf'<div[^>]*\bclass{_EQ}["\']?yahoo_quoted\b',
+    # Checked by _quote_runs_to_end, since replies can also be written between blockquotes
+    'blockquote': r'<blockquote\b',
+}
+
+_BLOCKQUOTE_TAG_RE = re.compile(r'<(/?)blockquote\b[^>]*>', re.I)
+# Whitespace and closing tags, e.g. of the div the blockquote is in
+_HTML_TAIL_RE = re.compile(r'(?:\s|</[a-z][^>]*>)*\Z', re.I)
+
+TEXT_QUOTE_RE = re.compile('|'.join(f'(?P<{k}>{v})' for k, v in TEXT_QUOTE_PATTERNS.items()), re.M | re.I)
+HTML_QUOTE_RE = re.compile('|'.join(f'(?P<{k}>{v})' for k, v in HTML_QUOTE_PATTERNS.items()), re.I)
+
+
+def _quoted_tail_start(body: str) -> int:
+    '''
+    Finds where the block of ">" quoted and blank lines at the end of body starts, scanning
+    its lines backwards once
+
+    Returns:
+        int: Index of the first line of the block. len(body) if body doesn't end in one.
+    '''
+
+    start = end = len(body)
+    while end >= 0:
+        line_start = body.rfind('\n', 0, end) + 1
+        line = body[line_start:end]
+        if not line.startswith('>') and line.strip(' \t\r'):
+            break
+        start = line_start
+        end = line_start - 1
+    return start
+
+def _angle_quote_start(body: str, tail: int) -> int:
+    '''
+    Returns the index of the first ">" quoted line at or after tail, or None if there isn't one
+    '''
+
+    if body.startswith('>', tail):
+        return tail
+    found = body.find('\n>', tail)
+    return None if found == -1 else found + 1
+
+def _attribution_ends_body(body: str, match: re.Match, tail: int) -> bool:
+    '''
+    Checks that only ">" quoted and blank lines follow an "On ... wrote:" line
+    '''
+
+    return match.end() == len(body) or match.end() + 1 >= tail
+
+def _quote_runs_to_end(body: str, match: re.Match, tail: int) -> bool:
+    '''
+    Checks that the blockquote opened at the match is followed by nothing but whitespace
+    and closing tags once it's closed. An unclosed blockquote runs to the end.
+    '''
+
+    depth = 0
+    for tag in _BLOCKQUOTE_TAG_RE.finditer(body, match.start()):
+        depth += -1 if tag.group(1) else 1
+        if depth == 0:
+            return _HTML_TAIL_RE.match(body, tag.end()) is not None
+    return True
+
+# Patterns whose matches are only quotes if these also agree
+_QUOTE_CHECKS = {
+    'on_wrote': _attribution_ends_body,
+    'on_wrote_fr': _attribution_ends_body,
+    'on_wrote_de': _attribution_ends_body,
+    'blockquote': _quote_runs_to_end
+}
+
+def _cut(body: str, regex: re.Pattern, angle_quotes: bool = False) -> tuple:
+    '''
+    Cuts body at the first match of regex, or with angle_quotes at the block of ">" quoted
+    lines that ends the body if that comes first, unless that would leave nothing behind
+
+    Returns:
+        tuple: (The cut body, name of the pattern that matched or None)
+    '''
+
+    tail = _quoted_tail_start(body)
+    match = regex.search(body)
+    while match is not None and match.lastgroup in _QUOTE_CHECKS \
+            and not _QUOTE_CHECKS[match.lastgroup](body, match, tail):
+        match = regex.search(body, match.end())
+    start, name = (match.start(), match.lastgroup) if match is not None else (None, None)
+
+    angle = _angle_quote_start(body, tail) if angle_quotes else None
+    if angle is not None and (start is None or angle < start):
+        start, name = angle, 'angle_quote'
+    if start is None:
+        return body, None
+    kept = body[:start].rstrip()
+    if kept.strip() == '':
+        return body, None
+    return kept, name
+
+def strip_quoted_text(body: str) -> str:
+    '''
+    Removes quoted history from a plain text or markdown email body
+
+    Args:
+        body (str): The email body
+
+    Returns:
+        str: body without the quoted history. Unchanged if no quote was found, or if the
+             whole body is a quote.
+    '''
+
+    return _cut(body, TEXT_QUOTE_RE, angle_quotes=True)[0]
+
+def strip_quoted_html(body: str) -> str:
+    '''
+    Removes quoted history from an html email body
+
+    Everything from the start of the quote onwards is dropped. Unclosed tags are fine
+    since the result is only converted to markdown.
+
+    Args:
+        body (str): The html email body
+
+    Returns:
+        str: body without the quoted history
+    '''
+
+    return _cut(body, HTML_QUOTE_RE)[0]
+
+def evaluate(corpus_path: str = 'quote_corpus.json', repeat: int = 200) -> dict:
+    '''
+    Checks the patterns against a labelled corpus and times them
+
+    Each corpus entry has a `kind` (`text` or `html`), a `body` and the `expected`
+    result of stripping it. Entries can also have a `repeat` of [text, count], which is
+    repeated count times in place of `{repeat}` in the body and expected result, and a
+    `max_seconds` that stripping the entry once has to take less than.
+
+    Args:
+        corpus_path (str, optional): File path to the corpus. Defaults to 'quote_corpus.json'.
+        repeat (int, optional): Number of times to strip the corpus when timing. Defaults to 200.
+
+    Returns:
+        dict: The number of `correct` entries, the `total`, the names of the `failures`
+              and the throughput in `mb_per_s`
+    '''
+
+    with open(corpus_path, encoding='utf-8') as fp:
+        corpus = json.load(fp)
+
+    for c in corpus:
+        if 'repeat' in c:
+            text, count = c['repeat']
+            c['body'] = c['body'].replace('{repeat}', text * count)
+            c['expected'] = c['expected'].replace('{repeat}', text * count)
+
+    strip = {'text': strip_quoted_text, 'html': strip_quoted_html}
+    failures = []
+    for c in corpus:
+        start = time.perf_counter()
+        stripped = strip[c['kind']](c['body'])
+        if stripped != c['expected'] or time.perf_counter() - start > c.get('max_seconds', float('inf')):
+            failures.append(c['name'])
+
+    size = sum(len(c['body']) for c in corpus) * repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for c in corpus:
+            strip[c['kind']](c['body'])
+    elapsed = time.perf_counter() - start
+
+    return {
+        'correct': len(corpus) - len(failures),
+        'total': len(corpus),
+        'failures': failures,
+        'mb_per_s': size / 1e6 / elapsed if elapsed else float('inf')
+    }
+
+
+if __name__ == '__main__':
+    results = evaluate(*sys.argv[1:2])
+    print(f'{results["correct"]}/{results["total"]} correct, {results["mb_per_s"]:.1f} MB/s')
+    for name in results['failures']:
+        print(f'FAILED: {name}')
+    sys.exit(1 if results['failures'] else 0)
@@ -0,0 +1,196 @@
+'''
+Shares limited capacity (concurrent Discord API calls, worker threads) between classes of
+work in priority order, so interactive command replies stay fast while a backlog of emails
+is being delivered.
+
+Each `PriorityLimiter` has a number of slots. Work acquires a slot for its class before
+running and releases it when done. When a slot frees up, it goes to the waiting work of the
+highest priority class first. Classes can also reserve slots that lower priority classes
+never take, so bulk work can't fill every slot and make an interactive reply wait for a
+bulk call to finish.
+
+Every class keeps metrics (how many ran, are running and are waiting, and how long they
+waited for a slot) and `LatencyStats` records end-to-end latencies, e.g. of commands.
+'''
+
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+
+class LatencyStats:
+    '''
+    Count, mean, percentiles and max of a stream of durations. Percentiles are over the
+    most recent `window` durations.
+    '''
+
+    def __init__(self, window: int = 1000):
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self._recent = deque(maxlen=window)
+
+    def add(self, elapsed: float) -> None:
+        self.count += 1
+        self.total_s += elapsed
+        self.max_s = max(self.max_s, elapsed)
+        self._recent.append(elapsed)
+
+    def percentile(self, pct: float) -> float:
+        if not self._recent:
+            return 0.0
+        values = sorted(self._recent)
+        return values[min(int(pct / 100 * len(values)), len(values) - 1)]
+
+    def as_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'mean_s': self.total_s / self.count if self.count else 0.0,
+            'p50_s': self.percentile(50),
+            'p95_s': self.percentile(95),
+            'max_s': self.max_s
+        }
+
+
+class PriorityLimiter:
+    '''
+    A number of slots shared between classes of work in priority order
+
+    Attributes:
+        `name`: Name of the limiter, used in the metrics
+        `capacity`: Number of slots
+        `priorities`: The classes of work, highest priority first
+        `reserved`: Number of slots each class keeps from the classes after it
+    '''
+
+    def __init__(self, name: str, capacity: int, priorities: tuple = (INTERACTIVE, BULK), reserved: dict = None):
+        self.name = name
+        self.priorities = list(priorities)
+        self._waiters = {cls: deque() for cls in self.priorities}
+        self._in_use = {cls: 0 for cls in self.priorities}
+        self.waits = {cls: LatencyStats() for cls in self.priorities}
+        self.configure(capacity, reserved)
+
+    def configure(self, capacity: int, reserved: dict = None) -> None:
+        '''
+        Changes the number of slots and the reservations. Work already running keeps its slot.
+        '''
+
+        self.capacity = max(int(capacity), 1)
+        self.reserved = dict(reserved or {})
+        self._limits = {}
+        kept = 0
+        for cls in self.priorities:
+            self._limits[cls] = max(self.capacity - kept, 1)
+            kept += self.reserved.get(cls, 0)
+        self._wake()
+
+    @property
+    def in_use(self) -> int:
+        return sum(self._in_use.values())
+
+    def _can_take(self, cls: str) -> bool:
+        return self.in_use < self._limits[cls]
+
+    def _take(self, cls: str) -> None:
+        self._in_use[cls] += 1
+
+    def _wake(self) -> None:
+        '''
+        Hands free slots to the waiting work, highest priority first
+        '''
+
+        for cls in self.priorities:
+            waiters = self._waiters[cls]
+            while waiters and self._can_take(cls):
+                future = waiters.popleft()
+                if future.done():
+                    continue
+                self._take(cls)
+                future.set_result(None)
+
+    async def acquire(self, cls: str) -> None:
+        '''
+        Waits for a slot for work of class cls
+        '''
+
+        if cls not in self._in_use:
+            raise ValueError(f'Unknown class of work: {cls}')
+        start = time.perf_counter()
+        ahead = any(self._waiters[c] for c in self.priorities[:self.priorities.index(cls) + 1])
+        if not ahead and self._can_take(cls):
+            self._take(cls)
+        else:
+            future = asyncio.get_event_loop().create_future()
+            self._waiters[cls].append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The slot was handed over just as the wait was cancelled
+                    self.release(cls)
+                raise
+        self.waits[cls].add(time.perf_counter() - start)
+
+    def release(self, cls: str) -> None:
+        '''
+        Gives back a slot of class cls
+        '''
+
+        self._in_use[cls] -= 1
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, cls: str):
+        '''
+        Holds a slot for work of class cls for the duration of the `async with` block
+        '''
+
+        await self.acquire(cls)
+        try:
+            yield
+        finally:
+            self.release(cls)
+
+    def stats(self) -> dict:
+        '''
+        Returns the metrics of each class, in priority order
+        '''
+
+        return {cls: dict(self.waits[cls].as_dict(), running=self._in_use[cls], waiting=len(self._waiters[cls]))
+                for cls in self.priorities}
+
+
+class WorkerPool(PriorityLimiter):
+    '''
+    A thread pool whose threads are handed out to classes of work in priority order
+    '''
+
+    def __init__(self, name: str, capacity: int, priorities: tuple = (INTERACTIVE, BULK), reserved: dict = None):
+        self._executor = None
+        super().__init__(name, capacity, priorities, reserved)
+
+    def configure(self, capacity: int, reserved: dict = None) -> None:
+        old_executor = self._executor
+        if old_executor is None or max(int(capacity), 1) != self.capacity:
+            self._executor = ThreadPoolExecutor(max(int(capacity), 1), thread_name_prefix=self.name)
+            if old_executor is not None:
+                old_executor.shutdown(wait=False)
+        super().configure(capacity, reserved)
+
+    async def run(self, cls: str, func, *args, **kwargs):
+        '''
+        Runs func(*args, **kwargs) in one of the pool's threads once a slot is free for class cls
+
+        Returns:
+            The result of func
+        '''
+
+        async with self.slot(cls):
+            return await asyncio.get_event_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
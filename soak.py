@@ -0,0 +1,571 @@
+'''
+Soak test that runs the bot for a long time against stand-ins and fails if it keeps growing.
+
+Builds on loadgen: the bot runs with the real handlers against a fake Discord client and a
+fake SMTP server in a scratch copy of its files. On top of the Discord messages that loadgen
+sends, a stand-in IMAP server makes up incoming emails (plain, html, with attachments and
+a share of malformed ones) and the real ingest pipeline (main.fetch_new_emails()) fetches
+and delivers them. Some of the emails sent fail, like a flaky SMTP server. E.g.
+
+    python soak.py --emails 200000 --messages 200000 --email-rate 200 --message-rate 200
+    python soak.py --emails 20000 --messages 20000 --malformed 0.3 --json soak.json
+
+Every `--sample-interval` seconds, records the RSS, the open file descriptors, the number of
+asyncio tasks and the number and size of the files in the attachment directory. After the
+warmup, compares the first and last thirds of the samples, and fails (exit code 1) if any of
+them grew by more than its limit.
+'''
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import resource
+import smtplib
+import statistics
+import sys
+import time
+from collections import Counter, OrderedDict, deque
+from email.utils import formatdate
+
+from aioimaplib import Response
+
+import main
+from loadgen import DEFAULT_MIX, FakeSMTP, LoadGenerator, parse_mix
+from localmailbox import LocalMailbox
+
+# The kinds of incoming emails, with their share of the well formed ones
+EMAIL_MIX = {
+    'plain': 0.5,
+    'html': 0.3,
+    'attachments': 0.2
+}
+
+# The kinds of malformed emails, sent in equal shares
+MALFORMED_KINDS = ['no_date', 'bad_date', 'no_from', 'bad_from', 'bad_boundary', 'bad_base64', 'bad_charset', 'truncated']
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do']
+
+# The metrics that are checked for growth, with their units
+METRICS = OrderedDict([
+    ('rss_bytes', 'bytes'),
+    ('open_fds', 'fds'),
+    ('tasks', 'tasks'),
+    ('att_files', 'files'),
+    ('att_bytes', 'bytes')
+])
+
+
+def rss_bytes() -> int:
+    '''
+    Returns the resident set size of this process. Where /proc isn't available, returns the
+    peak RSS instead.
+    '''
+
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+def open_fds() -> int:
+    '''
+    Returns the number of open file descriptors of this process, or None if they can't be listed
+    '''
+
+    for fd_dir in ['/proc/self/fd', '/dev/fd']:
+        try:
+            return len(os.listdir(fd_dir))
+        except OSError:
+            continue
+    return None
+
+def dir_usage(path: str) -> tuple:
+    '''
+    Returns (number of files, total bytes) under path
+    '''
+
+    files = size = 0
+    for dir_path, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dir_path, filename))
+            except OSError:
+                continue
+            files += 1
+    return files, size
+
+def slope_per_hour(samples: list, key: str) -> float:
+    '''
+    Returns the least squares slope of key over time, per hour
+    '''
+
+    points = [(s['t'], s[key]) for s in samples if s[key] is not None]
+    if len(points) < 2:
+        return 0.0
+    mean_t = statistics.mean(t for t, _ in points)
+    mean_v = statistics.mean(v for _, v in points)
+    var_t = sum((t - mean_t) ** 2 for t, _ in points)
+    if var_t == 0:
+        return 0.0
+    return 3600 * sum((t - mean_t) * (v - mean_v) for t, v in points) / var_t
+
+def check_growth(samples: list, limits: dict, warmup: float) -> dict:
+    '''
+    Compares the median of each metric over the first and the last third of the samples taken
+    after the warmup
+
+    Args:
+        samples (list): The samples, in the order they were taken
+        limits (dict): The most each metric may grow, by metric
+        warmup (float): Share of the samples to leave out at the start
+
+    Returns:
+        dict: For each metric: its median before and after, how much it grew, its slope per
+              hour, its limit and whether it stayed within it. Empty if there are too few samples.
+    '''
+
+    steady = samples[int(len(samples) * warmup):]
+    third = len(steady) // 3
+    if third < 2:
+        return {}
+    results = OrderedDict()
+    for key, limit in limits.items():
+        before = [s[key] for s in steady[:third] if s[key] is not None]
+        after = [s[key] for s in steady[-third:] if s[key] is not None]
+        if not before or not after:
+            continue
+        growth = statistics.median(after) - statistics.median(before)
+        results[key] = {
+            'before': statistics.median(before),
+            'after': statistics.median(after),
+            'growth': growth,
+            'per_hour': slope_per_hour(steady, key),
+            'limit': limit,
+            'passed': growth <= limit
+        }
+    return results
+
+
+class SoakMailbox(LocalMailbox):
+    '''
+    A stand-in IMAP inbox whose emails are made up as they're fetched
+
+    Answers the uid and header fetches of fetch_email_messages() as well as the fetches
+    LocalMailbox answers. New emails arrive when deliver() is called.
+    '''
+
+    is_local = True
+    # What init_imap_client() keeps from the SELECT response
+    select_status = {'UIDVALIDITY': 1}
+
+    def __init__(self, build, cache_size: int = 64):
+        '''
+        Args:
+            build (Callable): Takes a uid and returns the raw email
+            cache_size (int, optional): Number of parsed emails to keep in memory. Defaults to 64.
+        '''
+
+        self.path = '<soak>'
+        self.count = 0
+        self._build = build
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def deliver(self, count: int) -> None:
+        self.count += count
+
+    def uids(self) -> range:
+        return range(1, self.count + 1)
+
+    def _message_bytes(self, uid: int) -> bytes:
+        if not 1 <= uid <= self.count:
+            raise IndexError(uid)
+        return self._build(uid)
+
+    def _resolve(self, uid_range: str) -> range:
+        '''
+        Returns the uids in a uid set like `5`, `5:9`, `5:*` or `*`
+        '''
+
+        if uid_range == '*':
+            return range(self.count, self.count + 1) if self.count else range(0)
+        first, _, last = uid_range.partition(':')
+        first = int(first)
+        if last == '*':
+            # n:* always includes the last email, even when n is past it
+            return range(min(first, self.count), self.count + 1) if self.count else range(0)
+        last = int(last) if last else first
+        return range(max(first, 1), min(last, self.count) + 1)
+
+    async def uid(self, command: str, uid: str, item: str) -> Response:
+        if item.upper() == '(UID)':
+            if not self.count:
+                return Response('NO', [b'UID FETCH failed: mailbox is empty'])
+            lines = [f'{i} FETCH (UID {i})'.encode() for i in self._resolve(uid)]
+            return Response('OK', lines + [b'FETCH completed'])
+        if 'HEADER.FIELDS' not in item.upper():
+            return await super().uid(command, uid, item)
+        lines = []
+        for i in self._resolve(uid):
+            data = self._message_bytes(i)
+            header = data[:data.find(b'\r\n\r\n') + 4] if b'\r\n\r\n' in data else data
+            lines += [f'{i} FETCH (UID {i} FLAGS () BODY[HEADER] {{{len(header)}}}'.encode(), header, b')']
+        lines.append(b'FETCH completed')
+        return Response('OK', lines)
+
+    async def logout(self) -> None:
+        pass
+
+
+class FlakySMTP(FakeSMTP):
+    '''
+    A FakeSMTP that fails a share of the emails it's given
+    '''
+
+    def sendmail(self, from_addr: str, to_addrs: list, msg: bytes) -> dict:
+        if self._harness.random.random() < self._harness.args.smtp_failures:
+            time.sleep(self._harness.smtp_latency)
+            self._harness.smtp_failures += 1
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        return super().sendmail(from_addr, to_addrs, msg)
+
+
+class SoakTest(LoadGenerator):
+    '''
+    Runs the bot's message handler and ingest pipeline for a long time and samples how much
+    it holds on to
+    '''
+
+    def __init__(self, args: argparse.Namespace):
+        super().__init__(args)
+        # Only the latest records are kept, so the harness itself doesn't grow
+        self.records = deque(maxlen=1000)
+        self.ops = Counter()
+        self.op_errors = Counter()
+        self.smtp_failures = 0
+        self.fetch_errors = 0
+        self.samples = []
+        self.members = []
+        self.att_dir = None
+        self.mailbox = SoakMailbox(self.build_email)
+
+    def setup_files(self) -> None:
+        '''
+        Creates the scratch files like loadgen, with the attachment store and logging
+        settings of the soak test
+        '''
+
+        super().setup_files()
+        deci_config = main.read_config_file('deci_config.json')
+        deci_config.setdefault('att_store', {}).update({
+            'max_bytes': self.args.att_store_mb * 1024 * 1024,
+            'grace_seconds': self.args.att_grace
+        })
+        deci_config.setdefault('logging', {})['level'] = self.args.log_level
+        main.update_config_file('deci_config.json', deci_config)
+        with open(deci_config['dir_paths']['max_uid_path'], mode='w') as fp:
+            fp.write('0')
+        self.att_dir = os.path.abspath(deci_config['dir_paths']['em_atts_dir'])
+        self.members = [user for _, _, _, users in self.guilds for user in users[:max(len(users) // 2, 1)]]
+
+    def setup_bot(self):
+        '''
+        Builds the bot like loadgen, with the stand-in inbox and a flaky SMTP server
+        '''
+
+        bot = super().setup_bot()
+
+        async def init_imap_client():
+            return self.mailbox
+        self.dcts.init_imap_client = init_imap_client
+        main.connect_smtp = lambda dcts: FlakySMTP(self)
+        return bot
+
+    def build_email(self, uid: int) -> bytes:
+        '''
+        Makes up the raw email uid. The same uid always gives the same email.
+        '''
+
+        rng = random.Random(f'{self.args.seed}:{uid}')
+        if rng.random() < self.args.malformed:
+            kind = rng.choice(MALFORMED_KINDS)
+        else:
+            kind = rng.choices(list(EMAIL_MIX), list(EMAIL_MIX.values()))[0]
+
+        user = rng.choice(self.members)
+        headers = OrderedDict([
+            ('From', f'{user.name} <{user.name}@example.invalid>'),
+            ('To', 'deci@example.invalid'),
+            ('Subject', f'Soak {uid} ({kind})'),
+            ('Date', formatdate(time.time(), localtime=True)),
+            ('Message-ID', f'<soak{uid}@example.invalid>'),
+            ('MIME-Version', '1.0')
+        ])
+        if uid > 1 and rng.random() < 0.2:
+            headers['In-Reply-To'] = f'<soak{rng.randint(1, uid - 1)}@example.invalid>'
+        if kind == 'no_date':
+            del headers['Date']
+        elif kind == 'bad_date':
+            headers['Date'] = 'sometime last week'
+        elif kind == 'no_from':
+            del headers['From']
+        elif kind == 'bad_from':
+            headers['From'] = f'{user.name}@example.invalid (no brackets'
+
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, self.args.words)))
+        if kind in ['html', 'bad_boundary']:
+            boundary = f'alt{uid}'
+            headers['Content-Type'] = f'multipart/alternative; boundary="{boundary}"'
+            if kind == 'bad_boundary':
+                boundary = f'other{uid}'
+            body = (f'--{boundary}\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n{text}\r\n'
+                    f'--{boundary}\r\nContent-Type: text/html; charset=utf-8\r\n\r\n<p><b>{text}</b></p>\r\n'
+                    f'--{boundary}--\r\n').encode()
+        elif kind in ['attachments', 'bad_base64', 'truncated']:
+            boundary = f'mixed{uid}'
+            headers['Content-Type'] = f'multipart/mixed; boundary="{boundary}"'
+            names = [f'file{uid}_{i}.bin' for i in range(rng.randint(1, 3))]
+            body = f'--{boundary}\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n{text} {" ".join(names)}\r\n'.encode()
+            for name in names:
+                # Draw the contents from a small pool, so some attachments repeat
+                pool_rng = random.Random(rng.randrange(self.args.attachment_pool))
+                size = pool_rng.randint(1, self.args.attachment_size)
+                data = pool_rng.getrandbits(size * 8).to_bytes(size, 'little')
+                encoded = '!!not base64!!' if kind == 'bad_base64' else base64.encodebytes(data).decode().replace('\n', '\r\n')
+                body += (f'--{boundary}\r\nContent-Type: application/octet-stream; name="{name}"\r\n'
+                         f'Content-Disposition: attachment; filename="{name}"\r\n'
+                         f'Content-Transfer-Encoding: base64\r\n\r\n{encoded}\r\n').encode()
+            body += f'--{boundary}--\r\n'.encode()
+            if kind == 'truncated':
+                body = body[:len(body) // 2]
+        elif kind == 'bad_charset':
+            headers['Content-Type'] = 'text/plain; charset="x-unknown"'
+            body = text.encode() + b' \xff\xfe\xfd\r\n'
+        else:
+            headers['Content-Type'] = 'text/plain; charset=utf-8'
+            body = f'{text}\r\n'.encode()
+
+        header = ''.join(f'{k}: {v}\r\n' for k, v in headers.items())
+        return header.encode() + b'\r\n' + body
+
+    async def run_op(self, kind: str) -> None:
+        await super().run_op(kind)
+        record = self.records[-1]
+        self.ops[kind] += 1
+        if record.error is not None:
+            self.op_errors[kind] += 1
+
+    def sample(self, elapsed: float) -> dict:
+        att_files, att_bytes = dir_usage(self.att_dir)
+        return {
+            't': round(elapsed, 3),
+            'rss_bytes': rss_bytes(),
+            'open_fds': open_fds(),
+            'tasks': len(asyncio.all_tasks()),
+            'att_files': att_files,
+            'att_bytes': att_bytes,
+            'emails': self.mailbox.count,
+            'messages': sum(self.ops.values())
+        }
+
+    async def send_messages(self) -> None:
+        '''
+        Sends `messages` Discord messages at `message_rate` a second, with at most
+        `max_in_flight` being handled at once
+        '''
+
+        mix = self.args.mix
+        kinds, weights = list(mix), list(mix.values())
+        in_flight = asyncio.Semaphore(self.args.max_in_flight)
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        tasks = set()
+        for i in range(self.args.messages):
+            delay = start + i / self.args.message_rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await in_flight.acquire()
+            task = asyncio.ensure_future(self.run_op(self.random.choices(kinds, weights)[0]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda _: in_flight.release())
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def receive_emails(self, interval: float = 1.0) -> None:
+        '''
+        Delivers `emails` emails to the stand-in inbox at `email_rate` a second and fetches
+        them with the ingest pipeline
+        '''
+
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        while self.mailbox.count < self.args.emails:
+            due = min(int((loop.time() - start) * self.args.email_rate) + 1, self.args.emails)
+            self.mailbox.deliver(max(due - self.mailbox.count, 0))
+            try:
+                await main.fetch_new_emails(self.dcts)
+            except Exception as e:
+                self.fetch_errors += 1
+                main.log_and_print('Soak fetch failed: %s', e, level='error')
+            await asyncio.sleep(interval)
+        await main.fetch_new_emails(self.dcts)
+
+    async def watch_resources(self, start: float) -> None:
+        '''
+        Takes a sample every `sample_interval` seconds, until cancelled
+        '''
+
+        loop = asyncio.get_event_loop()
+        while True:
+            self.samples.append(self.sample(loop.time() - start))
+            await asyncio.sleep(self.args.sample_interval)
+
+    async def run(self) -> float:
+        '''
+        Sends the Discord messages and the emails side by side, then waits for every one of them
+        to be handled
+
+        Returns:
+            float: The wall time in seconds
+        '''
+
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        watchers = [asyncio.ensure_future(self.watch_loop()), asyncio.ensure_future(self.watch_resources(start))]
+        try:
+            await asyncio.gather(self.send_messages(), self.receive_emails())
+            await self.dcts.embed_batcher.flush_all()
+            # Let the command error events run
+            await asyncio.sleep(0.1)
+        finally:
+            for watcher in watchers:
+                watcher.cancel()
+        elapsed = loop.time() - start
+        self.samples.append(self.sample(elapsed))
+        return elapsed
+
+    def soak_report(self, elapsed: float, limits: dict) -> dict:
+        growth = check_growth(self.samples, limits, self.args.warmup)
+        return {
+            'elapsed_s': elapsed,
+            'emails': self.mailbox.count,
+            'messages': dict(self.ops),
+            'message_errors': dict(self.op_errors),
+            'fetch_errors': self.fetch_errors,
+            'emails_sent': self.emails_sent,
+            'smtp_failures': self.smtp_failures,
+            'discord_calls': self.discord_calls,
+            'pipeline': {name: metrics.as_dict() for name, metrics in main.INGEST_METRICS.items()},
+            'event_loop': {
+                'blocked_s': self.blocked_s,
+                'stalls': self.stalls,
+                'max_stall_ms': self.max_stall_s * 1000
+            },
+            'growth': growth,
+            'passed': bool(growth) and all(g['passed'] for g in growth.values()),
+            'samples': self.samples
+        }
+
+
+def format_soak_report(report: dict) -> str:
+    '''
+    Formats report as a table
+    '''
+
+    lines = [f'{report["emails"]} emails and {sum(report["messages"].values())} messages in {report["elapsed_s"]:.1f} s',
+             f'{sum(report["message_errors"].values())} message errors, {report["fetch_errors"]} fetch errors, '
+             f'{report["emails_sent"]} emails sent, {report["smtp_failures"]} SMTP failures, {report["discord_calls"]} Discord calls',
+             f'Event loop stalled {report["event_loop"]["stalls"]} times, longest {report["event_loop"]["max_stall_ms"]:.1f} ms']
+    if not report['growth']:
+        lines.append('Too few samples after the warmup to check for growth. Run longer or sample more often.')
+        return '\n'.join(lines)
+    lines.append(f'{"metric":<10} {"before":>14} {"after":>14} {"growth":>14} {"per hour":>14} {"limit":>14}')
+    for key, g in report['growth'].items():
+        lines.append(f'{key:<10} {g["before"]:>14.0f} {g["after"]:>14.0f} {g["growth"]:>14.0f} '
+                     f'{g["per_hour"]:>14.0f} {g["limit"]:>14.0f}  {"ok" if g["passed"] else "GREW " + METRICS[key]}')
+    lines.append('PASSED' if report['passed'] else 'FAILED')
+    return '\n'.join(lines)
+
+def main_cli(argv: list = None) -> dict:
+    '''
+    Command line entry point
+
+    Args:
+        argv (list, optional): The command line arguments. Defaults to sys.argv.
+
+    Returns:
+        dict: The report
+    '''
+
+    arg_parser = argparse.ArgumentParser(description='Runs the bot against stand-ins for a long time and checks that it stops growing')
+    arg_parser.add_argument('--emails', type=int, default=200000, help='Number of incoming emails (default 200000)')
+    arg_parser.add_argument('--messages', type=int, default=200000, help='Number of Discord messages (default 200000)')
+    arg_parser.add_argument('--email-rate', type=float, default=200, help='Incoming emails per second (default 200)')
+    arg_parser.add_argument('--message-rate', type=float, default=200, help='Discord messages per second (default 200)')
+    arg_parser.add_argument('--max-in-flight', type=int, default=200, help='Most Discord messages handled at once (default 200)')
+    arg_parser.add_argument('--malformed', type=float, default=0.1, help='Share of malformed emails (default 0.1)')
+    arg_parser.add_argument('--smtp-failures', type=float, default=0.02, help='Share of emails the SMTP server fails (default 0.02)')
+    arg_parser.add_argument('--guilds', type=int, default=20, help='Number of synthetic servers (default 20)')
+    arg_parser.add_argument('--users', type=int, default=10, help='Number of users per server (default 10)')
+    arg_parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                            help='Share of each kind of Discord message, e.g. `message=5,get_my_info=1`. '
+                                 f'Kinds: {", ".join(DEFAULT_MIX)}')
+    arg_parser.add_argument('--words', type=int, default=80, help='Most words in a message or email (default 80)')
+    arg_parser.add_argument('--attachments', type=float, default=0.1,
+                            help='Share of emailed messages with 1-3 attachments (default 0.1)')
+    arg_parser.add_argument('--attachment-size', type=int, default=64 * 1024, help='Most bytes per attachment (default 64 KiB)')
+    arg_parser.add_argument('--attachment-pool', type=int, default=1000,
+                            help='Number of distinct email attachment contents (default 1000)')
+    arg_parser.add_argument('--att-store-mb', type=int, default=64, help='Size limit of the attachment store in MiB (default 64)')
+    arg_parser.add_argument('--att-grace', type=int, default=30,
+                            help='Seconds before a stored attachment may be evicted (default 30)')
+    arg_parser.add_argument('--discord-latency', type=float, default=0.001, help='Seconds per Discord API call (default 0.001)')
+    arg_parser.add_argument('--smtp-latency', type=float, default=0.001, help='Seconds per email sent (default 0.001)')
+    arg_parser.add_argument('--sample-interval', type=float, default=5, help='Seconds between samples (default 5)')
+    arg_parser.add_argument('--warmup', type=float, default=0.2, help='Share of the samples to leave out at the start (default 0.2)')
+    arg_parser.add_argument('--max-rss-growth', type=float, default=64, help='Most the RSS may grow, in MiB (default 64)')
+    arg_parser.add_argument('--max-fd-growth', type=int, default=16, help='Most the open file descriptors may grow (default 16)')
+    arg_parser.add_argument('--max-task-growth', type=int, default=50, help='Most the asyncio tasks may grow (default 50)')
+    arg_parser.add_argument('--max-att-file-growth', type=int, default=100,
+                            help='Most the files in the attachment directory may grow (default 100)')
+    arg_parser.add_argument('--max-att-growth', type=float, default=16,
+                            help='Most the attachment directory may grow, in MiB (default 16)')
+    arg_parser.add_argument('--log-level', default='WARNING', help='Log level of the bot (default WARNING)')
+    arg_parser.add_argument('--seed', type=int, default=0, help='Random seed (default 0)')
+    arg_parser.add_argument('--workdir', help='Scratch directory for the bot\'s files. Defaults to a new temporary directory')
+    arg_parser.add_argument('--json', metavar='OUTPUT', help='Also write the report, with every sample, as json to OUTPUT')
+    args = arg_parser.parse_args(argv)
+    json_path = os.path.abspath(args.json) if args.json else None
+    limits = {
+        'rss_bytes': args.max_rss_growth * 1024 * 1024,
+        'open_fds': args.max_fd_growth,
+        'tasks': args.max_task_growth,
+        'att_files': args.max_att_file_growth,
+        'att_bytes': args.max_att_growth * 1024 * 1024
+    }
+
+    harness = SoakTest(args)
+    harness.setup_files()
+    harness.setup_bot()
+    deci_config = main.read_config_file('deci_config.json')
+    main.configure_logging(deci_config['dir_paths']['log_file_dir'], deci_config.get('logging', {}), 'deci_soak')
+    main.configure_scheduling(deci_config)
+
+    elapsed = asyncio.get_event_loop().run_until_complete(harness.run())
+    report = harness.soak_report(elapsed, limits)
+    print(format_soak_report(report))
+    print(f'Scratch files are in {harness.workdir}')
+    if json_path:
+        with open(json_path, mode='w', encoding='utf-8') as fp:
+            json.dump(report, fp, indent=4, default=str)
+    return report
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main_cli()['passed'] else 1)
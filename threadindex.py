@@ -0,0 +1,186 @@
+'''
+A persistent index between email Message-IDs and Discord messages, used to keep email
+threads and Discord replies in step with each other.
+
+Incoming emails are looked up by their In-Reply-To/References headers to find the
+Discord message they should reply to. Outgoing emails are looked up by the Discord
+message they reply to so they can carry the right In-Reply-To/References headers.
+Both lookups go through a primary key, so they take constant time however large the
+index grows. An email delivered to several servers has a Discord message in each of them.
+'''
+
+import re
+import sqlite3
+
+
+class ThreadIndex:
+    '''
+    Maps email Message-IDs to Discord messages and back, stored in an sqlite database
+
+    Attributes:
+        `path`: File path to the database
+    '''
+
+    _instances = {}
+
+    def __init__(self, path: str):
+        '''
+        Opens (and creates if needed) the index at path
+
+        Args:
+            path (str): File path to the database
+        '''
+
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._migrate()
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS email_to_discord (
+                message_id TEXT,
+                guild_id INTEGER,
+                channel_id INTEGER,
+                discord_msg_id INTEGER,
+                PRIMARY KEY (message_id, guild_id)
+            );
+            CREATE TABLE IF NOT EXISTS discord_to_email (
+                discord_msg_id INTEGER PRIMARY KEY,
+                channel_id INTEGER,
+                message_id TEXT,
+                refs TEXT,
+                subject TEXT
+            );
+            CREATE INDEX IF NOT EXISTS discord_to_email_channel
+                ON discord_to_email (channel_id, subject);
+        ''')
+        self._conn.commit()
+
+    def _migrate(self) -> None:
+        '''
+        Rekeys an email_to_discord table made by older versions, which kept one Discord
+        message per email, on (message_id, guild_id)
+        '''
+
+        columns = self._conn.execute('PRAGMA table_info(email_to_discord)').fetchall()
+        if [c[1] for c in columns if c[5]] != ['message_id']:
+            return
+        self._conn.executescript('''
+            ALTER TABLE email_to_discord RENAME TO email_to_discord_old;
+            CREATE TABLE email_to_discord (
+                message_id TEXT,
+                guild_id INTEGER,
+                channel_id INTEGER,
+                discord_msg_id INTEGER,
+                PRIMARY KEY (message_id, guild_id)
+            );
+            INSERT INTO email_to_discord SELECT message_id, guild_id, channel_id, discord_msg_id
+                FROM email_to_discord_old;
+            DROP TABLE email_to_discord_old;
+        ''')
+        self._conn.commit()
+
+    @classmethod
+    def get(cls, path: str) -> 'ThreadIndex':
+        '''
+        Returns the shared ThreadIndex for path, opening it the first time
+        '''
+
+        if path not in cls._instances:
+            cls._instances[path] = cls(path)
+        return cls._instances[path]
+
+    @staticmethod
+    def normalize_subject(subject: str) -> str:
+        '''
+        Strips any `Re:`/`Fw:`/`Fwd:` prefixes from subject
+        '''
+
+        return re.sub(r'^(\s*(re|fw|fwd)\s*:\s*)+', '', subject or '', flags=re.I).strip()
+
+    def add(self, message_id: str, guild_id: int, channel_id: int, discord_msg_id: int,
+            refs: str = '', subject: str = None) -> None:
+        '''
+        Records that the email message_id and the Discord message discord_msg_id are the same message
+
+        Args:
+            message_id (str): The Message-ID of the email
+            guild_id (int): ID of the server the Discord message is in
+            channel_id (int): ID of the channel the Discord message is in
+            discord_msg_id (int): ID of the Discord message
+            refs (str, optional): The References header of the email. Defaults to ''.
+            subject (str, optional): The subject of the email. Defaults to None.
+        '''
+
+        if not message_id:
+            return
+        self._conn.execute('INSERT OR REPLACE INTO email_to_discord VALUES (?, ?, ?, ?)',
+                           (message_id, guild_id, channel_id, discord_msg_id))
+        self._conn.execute('INSERT OR REPLACE INTO discord_to_email VALUES (?, ?, ?, ?, ?)',
+                           (discord_msg_id, channel_id, message_id, refs or '',
+                            self.normalize_subject(subject)))
+        self._conn.commit()
+
+    def find_discord_parent(self, in_reply_to: str, refs: str) -> list:
+        '''
+        Finds the Discord messages that an incoming email replies to, one per server the
+        thread was posted in
+
+        Args:
+            in_reply_to (str): The In-Reply-To header of the email
+            refs (str): The References header of the email
+
+        Returns:
+            list: (guild_id, channel_id, discord_msg_id) of the closest known message of the
+                  thread in each server. Empty if the email isn't a reply to a known message.
+        '''
+
+        # The most direct parent first, then the rest of the thread from newest to oldest
+        candidates = re.findall(r'<[^>]+>', in_reply_to or '') + re.findall(r'<[^>]+>', refs or '')[::-1]
+        parents = {}
+        for message_id in dict.fromkeys(candidates):
+            for row in self._conn.execute('SELECT guild_id, channel_id, discord_msg_id FROM email_to_discord '
+                                          'WHERE message_id = ?', (message_id,)):
+                parents.setdefault(row[0], row)
+        return list(parents.values())
+
+    def find_email_parent(self, discord_msg_id: int = None, channel_id: int = None, subject: str = None) -> tuple:
+        '''
+        Finds the email that an outgoing Discord message replies to
+
+        If discord_msg_id is given, that message is looked up. Otherwise the latest email
+        in channel_id with the same subject is used.
+
+        Returns:
+            tuple: (message_id, refs) of the parent email, or None if there isn't one
+        '''
+
+        if discord_msg_id is not None:
+            row = self._conn.execute('SELECT message_id, refs FROM discord_to_email '
+                                     'WHERE discord_msg_id = ?', (discord_msg_id,)).fetchone()
+            if row is not None:
+                return row
+        if channel_id is not None and subject is not None:
+            return self._conn.execute('SELECT message_id, refs FROM discord_to_email '
+                                      'WHERE channel_id = ? AND subject = ? '
+                                      'ORDER BY discord_msg_id DESC LIMIT 1',
+                                      (channel_id, self.normalize_subject(subject))).fetchone()
+        return None
+
+    @staticmethod
+    def reply_headers(parent: tuple) -> dict:
+        '''
+        Builds the In-Reply-To and References headers for a reply to parent
+
+        Args:
+            parent (tuple): (message_id, refs) of the email being replied to, or None
+
+        Returns:
+            dict: The headers to add to the reply. Empty if parent is None.
+        '''
+
+        if parent is None:
+            return {}
+        message_id, refs = parent
+        return {
+            'In-Reply-To': message_id,
+            'References': f'{refs} {message_id}'.strip()
+        }